@@ -0,0 +1,21 @@
+"""
+性能計測（ベンチマーク）用のパッケージ。
+合成データ(datagen)を作り、集計レポート(利用者別サマリーの新旧の実装の比較を含む)・アチーブメント判定・初期データ/記録一覧APIの処理時間を計測して、
+結果をJSONに保存する。保存した結果どうしを比較して、コミット間で遅くなった処理を確認できる。
+
+計測は pytest-benchmark と同じ書き方（benchmark(func) / benchmark.pedantic(...)）で bench_*.py に記述するが、
+pytest などの追加のパッケージは使わない（requirements.txt のパッケージだけで動く）。
+
+コマンドラインからの実行例（作成者用_untouchable フォルダで実行）:
+    python -m benchmarks run
+    python -m benchmarks run --classes 6 --years 3 --filter report
+    python -m benchmarks compare benchmarks/results/前回.json benchmarks/results/今回.json
+"""
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# アプリ本体のモジュール(py フォルダ)は平らな import で互いを読み込むため、py フォルダにパスを通す
+PY_DIR = os.path.join(BASE_DIR, '..', 'py')
+if PY_DIR not in sys.path:
+    sys.path.insert(0, PY_DIR)
@@ -0,0 +1,91 @@
+"""
+python -m benchmarks <コマンド>（作成者用_untouchable フォルダで実行）
+    generate  合成データを作成する
+    run       合成データを作成（パラメータが同じ作成済みのものがあれば使用）して計測し、結果をJSONに保存する
+    compare   保存した2つの結果を比較する（遅くなった計測がある場合は終了コード 1）
+"""
+import os
+import sys
+import argparse
+import datetime
+
+from . import BASE_DIR, datagen, harness
+
+
+def default_data_dir():
+    return os.path.join(BASE_DIR, 'data')
+
+def _parse_now(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'基準日時は YYYY-MM-DDTHH:MM の形式で指定してください: {text}')
+
+def _add_dataset_arguments(parser):
+    parser.add_argument('--classes', type=int, default=4, help='1学年あたりの組数 (既定: 4)')
+    parser.add_argument('--class-size', type=int, default=35, help='1組の人数 (既定: 35)')
+    parser.add_argument('--years', type=int, default=1, help='作成する年度数。基準日時の年度から遡る (既定: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード (既定: 1)')
+    parser.add_argument('--now', type=_parse_now, default=None,
+                        help='データの基準日時 YYYY-MM-DDTHH:MM (JST。既定: 今日の17:30)')
+    parser.add_argument('--data-dir', default=default_data_dir(), help='合成データの保存先フォルダ')
+
+def _load_dataset(args):
+    return datagen.load_or_generate(os.path.abspath(args.data_dir), classes=args.classes, class_size=args.class_size,
+                                    years=args.years, seed=args.seed, now=args.now)
+
+def _print_counts(dataset):
+    counts = ', '.join(f'{name} {count}件' for name, count in dataset.meta['counts'].items())
+    print(f"合成データ: {dataset.data_dir}\n  {counts}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='合成データで処理時間を計測します。')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='合成データを作成する')
+    _add_dataset_arguments(generate_parser)
+
+    run_parser = subparsers.add_parser('run', help='計測して結果をJSONに保存する')
+    _add_dataset_arguments(run_parser)
+    run_parser.add_argument('--filter', help='「グループ名.計測名」にこの文字列を含む計測だけを実行する (例: report, api.logs)')
+    run_parser.add_argument('--rounds', type=int, help='各計測の回数（省略時は計測ごとの既定の回数）')
+    run_parser.add_argument('--output', help='結果の保存先 (既定: benchmarks/results/日時_コミットID.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='2つの結果を比較する')
+    compare_parser.add_argument('base', help='比較元の結果 (JSON)')
+    compare_parser.add_argument('new', help='比較先の結果 (JSON)')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='この割合(%%)を超えて遅くなった計測を報告する (既定: 10)')
+    compare_parser.add_argument('--stat', choices=['median', 'min', 'mean'], default='median', help='比較する値 (既定: median)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        base, new = harness.load_results(args.base), harness.load_results(args.new)
+        rows, regressions = harness.compare(base, new, threshold=args.threshold / 100, stat=args.stat)
+        print(harness.format_comparison(rows, base, new, args.threshold / 100, stat=args.stat))
+        if not rows:
+            print('両方の結果にある計測がありません。')
+        if regressions:
+            print(f'{len(regressions)} 件の計測が {args.threshold:g}% を超えて遅くなりました。')
+        return 1 if regressions else 0
+
+    dataset = _load_dataset(args)
+    _print_counts(dataset)
+    if args.command == 'generate':
+        return 0
+
+    output = os.path.abspath(args.output) if args.output else None
+    # 作成したレポートは合成データのフォルダに保存する（管理者用_touchable/logs に計測用のファイルを残さない）
+    os.environ['REPORT_OUTPUT_DIR'] = os.path.join(dataset.data_dir, 'reports')
+    # 相対パスに書き出す処理があっても合成データのフォルダに収まるようにする
+    os.chdir(dataset.data_dir)
+    results = harness.run(dataset, name_filter=args.filter, rounds=args.rounds)
+    if not results:
+        print('該当する計測がありません。')
+        return 1
+    print(f'結果を保存しました: {harness.save_results(results, dataset, path=output)}')
+    return 1 if any(result['error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+アチーブメント判定(achievement_logic の _check_*)の計測。
+判定は現在時刻を基準にするため、基準日時が現在の合成データで計測する。
+判定による書き込みは毎回ロールバックし、どの回も同じデータで判定する。
+対象の生徒は、今月の利用回数が最も多い生徒（判定のクエリが扱う記録が最も多い）。
+"""
+import datetime
+
+import achievement_logic
+from achievement_logic import JST, UTC
+
+
+def _start_of_month_utc():
+    start = datetime.datetime.now(JST).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return start.astimezone(UTC).isoformat()
+
+def _busiest_student(conn):
+    row = conn.execute('''
+        SELECT system_id FROM attendance_logs WHERE entry_time >= ?
+        GROUP BY system_id ORDER BY COUNT(*) DESC, system_id LIMIT 1
+    ''', (_start_of_month_utc(),)).fetchone()
+    if row is None:
+        row = conn.execute('SELECT system_id FROM attendance_logs GROUP BY system_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+    return row['system_id']
+
+def _latest_completed_log(conn, system_id):
+    return conn.execute('SELECT MAX(id) FROM attendance_logs WHERE system_id = ? AND exit_time IS NOT NULL',
+                        (system_id,)).fetchone()[0]
+
+def _measure(benchmark, dataset, check, *args, setup=None, rounds=20):
+    """conn を先頭の引数として check を計測する（各回の後にロールバックする）。"""
+    conn = dataset.connect()
+    try:
+        args = tuple(arg(conn) if callable(arg) else arg for arg in args)
+        benchmark.extra_info['args'] = list(args)
+        benchmark.pedantic(check, args=(conn,) + args, setup=(lambda: setup(conn)) if setup else None,
+                           teardown=conn.rollback, rounds=rounds, warmup_rounds=2)
+    finally:
+        conn.close()
+
+
+def bench_check_monthly_ranking(benchmark, dataset):
+    def forget_monthly_check(conn):
+        # 今月の確認済みの記録を消し、前月のランキングを集計する処理まで実行させる
+        conn.execute("DELETE FROM achievements_tracker WHERE code = 'monthly_rank_check' AND achieved_at >= ?",
+                     (datetime.datetime.now(JST).date().replace(day=1),))
+    _measure(benchmark, dataset, achievement_logic._check_monthly_ranking, _busiest_student, setup=forget_monthly_check)
+
+def bench_check_consecutive_days(benchmark, dataset):
+    _measure(benchmark, dataset, achievement_logic._check_consecutive_days, _busiest_student)
+
+def bench_check_monthly_hours(benchmark, dataset):
+    conn = dataset.connect()
+    try:
+        system_id = _busiest_student(conn)
+        log_id = _latest_completed_log(conn, system_id)
+    finally:
+        conn.close()
+    _measure(benchmark, dataset, achievement_logic._check_monthly_hours, system_id, log_id)
+
+def bench_check_monthly_visits(benchmark, dataset):
+    _measure(benchmark, dataset, achievement_logic._check_monthly_visits, _busiest_student)
+
+def bench_check_first_arrival(benchmark, dataset):
+    _measure(benchmark, dataset, achievement_logic._check_first_arrival)
+
+def bench_check_weekend_warrior(benchmark, dataset):
+    _measure(benchmark, dataset, achievement_logic._check_weekend_warrior, _busiest_student)
+
+def bench_check_late_finisher(benchmark, dataset):
+    _measure(benchmark, dataset, achievement_logic._check_late_finisher, _busiest_student)
+
+def bench_check_achievements_check_in(benchmark, dataset):
+    """入室時の判定全体（各判定を順に呼び出し、達成がなければ格言を選ぶ）。"""
+    _measure(benchmark, dataset, achievement_logic.check_achievements, _busiest_student, 'check_in')
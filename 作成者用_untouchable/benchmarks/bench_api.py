@@ -0,0 +1,91 @@
+"""
+初期データ(/api/initial_data)・記録一覧(/api/logs)の計測。Flask のテストクライアントでリクエストを送る。
+app をインポートすると起動時の処理（名簿の同期・スケジューラの開始など）が行われるため、
+インポートする前に database の DB と名簿Excelのパスを合成データのものにする（同じプロセスでは最初の合成データを使い続ける）。
+応答のキャッシュは、キャッシュを使う場合を計測するもの以外は毎回消してから計測する。
+"""
+import importlib
+from urllib.parse import urlencode
+
+import database
+
+_app_module = None
+
+
+def _app(dataset):
+    global _app_module
+    if _app_module is None:
+        database.DB_PATH = dataset.db_path
+        database.STUDENT_EXCEL_PATH_PATTERN = dataset.roster_path
+        _app_module = importlib.import_module('app')
+    if database.DB_PATH != dataset.db_path:
+        raise RuntimeError('同じプロセスで別の合成データのAPIは計測できません。')
+    return _app_module
+
+def _get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f'{url}: HTTP {response.status_code}')
+    return response
+
+def _measure_logs(benchmark, dataset, params, rounds=20):
+    app = _app(dataset)
+    client = app.app.test_client()
+    benchmark.extra_info['params'] = params
+    response = benchmark.pedantic(_get, args=(client, f'/api/logs?{urlencode(params)}'), setup=app._log_count_cache.clear,
+                                  rounds=rounds, warmup_rounds=2)
+    benchmark.extra_info['total'] = response.get_json()['total']
+
+
+def bench_initial_data(benchmark, dataset):
+    """名簿を含む初期データ（端末の起動時）。"""
+    app = _app(dataset)
+    client = app.app.test_client()
+    benchmark.pedantic(_get, args=(client, '/api/initial_data'), setup=app._initial_data_cache.clear,
+                       rounds=20, warmup_rounds=2)
+
+def bench_initial_data_presence(benchmark, dataset):
+    """名簿を保持している端末への、在室状況だけの初期データ。"""
+    app = _app(dataset)
+    client = app.app.test_client()
+    benchmark.pedantic(_get, args=(client, f"/api/initial_data?{urlencode({'roster_version': app.roster_version})}"),
+                       setup=app._initial_data_cache.clear, rounds=20, warmup_rounds=2)
+
+def bench_initial_data_cached(benchmark, dataset):
+    """データが変わっていない間の2台目以降の端末（シリアライズ済みの応答を使い回す）。"""
+    app = _app(dataset)
+    client = app.app.test_client()
+    benchmark.pedantic(_get, args=(client, '/api/initial_data'), rounds=50, warmup_rounds=2)
+
+def bench_logs_first_page(benchmark, dataset):
+    _measure_logs(benchmark, dataset, {'page': 1, 'per_page': 100, 'sort': 'id', 'dir': 'desc'})
+
+def bench_logs_deep_page_offset(benchmark, dataset):
+    """ページ番号で50ページ目を取得する（OFFSET で読み飛ばす互換用の取得方法）。"""
+    _measure_logs(benchmark, dataset, {'page': 50, 'per_page': 100, 'sort': 'entry_time', 'dir': 'desc'})
+
+def bench_logs_deep_page_cursor(benchmark, dataset):
+    """前のページのカーソルを使って50ページ目を取得する。"""
+    client = _app(dataset).app.test_client()
+    params = {'per_page': 100, 'sort': 'entry_time', 'dir': 'desc'}
+    for _ in range(49):
+        params['cursor'] = _get(client, f'/api/logs?{urlencode(params)}').get_json()['next_cursor']
+    _measure_logs(benchmark, dataset, params)
+
+def bench_logs_sorted_by_name(benchmark, dataset):
+    _measure_logs(benchmark, dataset, {'page': 1, 'per_page': 100, 'sort': 'name', 'dir': 'asc'})
+
+def bench_logs_filtered(benchmark, dataset):
+    """今月・1学年分に絞り込んだ一覧。"""
+    today = dataset.now.date()
+    _measure_logs(benchmark, dataset, {'page': 1, 'per_page': 100, 'sort': 'entry_time', 'dir': 'desc', 'grade': 3,
+                                       'start': today.replace(day=1).isoformat(), 'end': today.isoformat()})
+
+def bench_logs_name_search(benchmark, dataset):
+    """氏名(姓名の間の空白なし)で検索する（全文検索インデックスを使う長さ）。"""
+    conn = dataset.connect()
+    try:
+        name = conn.execute('SELECT name FROM students ORDER BY system_id LIMIT 1').fetchone()['name'].replace('　', '')
+    finally:
+        conn.close()
+    _measure_logs(benchmark, dataset, {'page': 1, 'per_page': 100, 'sort': 'id', 'dir': 'desc', 'name': name})
@@ -0,0 +1,64 @@
+"""
+集計レポート(report_generator.create_report)の計測。
+集計済みテーブル(report_rollups)を使う通常の作成は、1回目(ウォームアップ)で集計を最新にしてからの時間を計測する。
+"""
+import sqlite3
+import datetime
+
+import report_generator
+
+
+def _create_report(dataset, start_date, end_date, **kwargs):
+    file_path, message = report_generator.create_report(dataset.db_path, start_date.isoformat(), end_date.isoformat(),
+                                                        **kwargs)
+    if file_path is None:
+        raise RuntimeError(message)
+    return file_path
+
+def _last_month(dataset):
+    end = dataset.now.date().replace(day=1) - datetime.timedelta(days=1)
+    return end.replace(day=1), end
+
+def _school_year(dataset):
+    today = dataset.now.date()
+    return datetime.date(today.year if today.month >= 4 else today.year - 1, 4, 1), today
+
+def _clear_rollups(dataset):
+    conn = sqlite3.connect(dataset.db_path)
+    try:
+        conn.execute('DELETE FROM report_rollup_days')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def bench_create_report_last_month(benchmark, dataset):
+    start, end = _last_month(dataset)
+    benchmark.extra_info.update(start_date=start.isoformat(), end_date=end.isoformat())
+    benchmark.pedantic(_create_report, args=(dataset, start, end), kwargs={'use_rollups': True},
+                       rounds=5, warmup_rounds=1)
+
+def bench_create_report_school_year(benchmark, dataset):
+    start, end = _school_year(dataset)
+    benchmark.extra_info.update(start_date=start.isoformat(), end_date=end.isoformat())
+    benchmark.pedantic(_create_report, args=(dataset, start, end), kwargs={'use_rollups': True},
+                       rounds=3, warmup_rounds=1)
+
+def bench_create_report_school_year_cold(benchmark, dataset):
+    """集計済みテーブルが空の状態から作る場合（期間内の全日付の集計を作り直す）。"""
+    start, end = _school_year(dataset)
+    benchmark.extra_info.update(start_date=start.isoformat(), end_date=end.isoformat())
+    benchmark.pedantic(_create_report, args=(dataset, start, end), kwargs={'use_rollups': True},
+                       setup=lambda: _clear_rollups(dataset), rounds=3)
+
+def bench_create_report_school_year_raw(benchmark, dataset):
+    """集計済みテーブルを使わず、記録から直接集計する場合。"""
+    start, end = _school_year(dataset)
+    benchmark.extra_info.update(start_date=start.isoformat(), end_date=end.isoformat())
+    benchmark.pedantic(_create_report, args=(dataset, start, end), kwargs={'use_rollups': False}, rounds=3)
+
+def bench_create_report_all_years(benchmark, dataset):
+    start, end = datetime.date.fromisoformat(dataset.meta['first_day']), dataset.now.date()
+    benchmark.extra_info.update(start_date=start.isoformat(), end_date=end.isoformat())
+    benchmark.pedantic(_create_report, args=(dataset, start, end), kwargs={'use_rollups': True},
+                       rounds=3, warmup_rounds=1)
@@ -0,0 +1,79 @@
+"""
+「利用者別サマリー」の集計(report_generator._user_summary)の計測。
+生徒ごとのラムダで最頻値(x.mode()[0])を求めていた以前の実装と、件数表で求める現在の実装を、
+約1,000人・1年度分の合成データ（6学年×5組×34人。実行時の合成データとは別に、同じシードで
+基準日時の前年度末(3月31日)までの1年度分を作る）で比べる。
+計測の前に、両方の実装からシートの表が同じになることを確認する（異なる場合は計測を失敗にする）。
+"""
+import os
+import datetime
+
+import pandas as pd
+
+import report_generator
+
+from . import datagen
+
+CLASSES, CLASS_SIZE = 5, 34
+
+_prepared = {}
+
+
+def _user_summary_lambda_mode(df, num_weeks):
+    """以前の実装（生徒ごとのラムダで最頻値を求め、曜日別利用日数を crosstab と結合で付け加える）。"""
+    # 氏名はカテゴリ型で読み込むため、実際の組み合わせだけをグループにする（現在の実装と同じ）
+    df_daily_unique_users = df.drop_duplicates(subset=['date', 'system_id'])
+    df_user_summary = df.groupby(['grade_jp', 'class', 'student_number', 'name', 'system_id'], observed=True).agg(
+        total_checkins=('system_id', 'count'),
+        unique_days_attended=('date', 'nunique'),
+        total_stay_minutes=('stay_minutes', 'sum'),
+        avg_stay_minutes=('stay_minutes', 'mean'),
+        most_used_dow=('day_of_week_jp', lambda x: x.mode()[0]),
+        first_use_date=('date', 'min'),
+        most_used_hour=('entry_hour_jp', lambda x: x.mode()[0])
+    ).reset_index()
+    dow_counts = pd.crosstab(df_daily_unique_users['system_id'], df_daily_unique_users['day_of_week_jp'])
+    dow_order = ['月', '火', '水', '木', '金', '土', '日']
+    dow_counts = dow_counts.reindex(columns=dow_order, fill_value=0)
+    df_user_summary = pd.merge(df_user_summary, dow_counts, on='system_id', how='left')
+    df_user_summary[dow_order] = df_user_summary[dow_order].fillna(0).astype(int)
+    df_user_summary.drop(columns=['system_id'], inplace=True)
+    df_user_summary['weekly_avg_checkins'] = round(df_user_summary['unique_days_attended'] / num_weeks, 1)
+    return df_user_summary
+
+def _prepare(benchmark, dataset):
+    """1,000人規模の合成データの1年度分の記録を、レポート作成時と同じ前処理をした (記録, 週数) で返す。"""
+    seed = dataset.meta['params']['seed']
+    year_end = datetime.datetime(datagen.school_year(dataset.now.date()), 3, 31, 17, 30)
+    key = (os.path.dirname(dataset.data_dir), seed, year_end)
+    if key not in _prepared:
+        large = datagen.load_or_generate(os.path.dirname(dataset.data_dir), classes=CLASSES, class_size=CLASS_SIZE,
+                                         years=1, seed=seed, now=year_end)
+        start = datetime.date(year_end.year - 1, 4, 1)
+        conn = large.connect()
+        try:
+            df = report_generator.load_report_logs(conn, start, year_end.date())
+        finally:
+            conn.close()
+        df, _ = report_generator._prepare_raw_logs(df)
+        total_open_days = df['date'].nunique()
+        num_weeks = total_open_days / 7 if total_open_days >= 7 else 1
+
+        expected = report_generator._user_summary_sheet(_user_summary_lambda_mode(df, num_weeks))
+        actual = report_generator._user_summary_sheet(report_generator._user_summary(df, num_weeks))
+        pd.testing.assert_frame_equal(actual, expected)
+        _prepared[key] = (df, num_weeks, {'students': int(df['system_id'].nunique()), 'logs': len(df),
+                                          'start_date': start.isoformat(), 'end_date': year_end.date().isoformat()})
+    df, num_weeks, info = _prepared[key]
+    benchmark.extra_info.update(info)
+    return df, num_weeks
+
+
+def bench_lambda_mode_1k_students(benchmark, dataset):
+    """以前の実装（比較用）。"""
+    df, num_weeks = _prepare(benchmark, dataset)
+    benchmark.pedantic(_user_summary_lambda_mode, args=(df, num_weeks), rounds=5, warmup_rounds=1)
+
+def bench_count_matrix_1k_students(benchmark, dataset):
+    df, num_weeks = _prepare(benchmark, dataset)
+    benchmark.pedantic(report_generator._user_summary, args=(df, num_weeks), rounds=5, warmup_rounds=1)
@@ -0,0 +1,398 @@
+"""
+ベンチマーク用の合成データの作成。
+同じパラメータ（学校の規模・年数・乱数のシード・基準日時）からは、常に同じデータを作る。
+- students: 学年(中1〜高3)×組×番号の名簿。生徒ごとに利用頻度の差をつける（受験学年は多め）
+- attendance_logs: 開室日（日曜・お盆・年末年始は休み）ごとの入退室。平日は放課後、土曜・長期休暇中は日中に利用する
+  退室し忘れ（退室時刻なし）と、通信が切れていた間の記録を翌日にまとめて登録したもの（オフライン同期。
+  記録IDが入室時刻の順にならない）を含む。基準日時の当日分は、その時点で在室中の生徒を入室中として残す
+- achievements_tracker: 記録から、achievement_logic の判定と同じ条件で達成したものを作る
+- questions: 質問管理アプリ(school_qna)の質問。在室中の生徒が登録したものとして、別のDBファイルに作る
+"""
+import os
+import json
+import sqlite3
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import database
+
+JST_OFFSET = datetime.timedelta(hours=9)
+# 作成するデータの形式を変えた場合は上げる（保存済みのデータを使い回さないようにする）
+DATA_FORMAT = 1
+DATASET_FILE_NAME = 'dataset.json'
+
+GRADES = [1, 2, 3, 4, 5, 6]
+EXAM_GRADES = {3, 6}
+OPEN_MINUTE, CLOSE_MINUTE = 9 * 60, 20 * 60 + 30
+AFTER_SCHOOL_MINUTE = 15 * 60 + 30
+MAX_SEAT_NUMBER = 72
+FORGOT_EXIT_RATE = 0.02
+SECOND_VISIT_RATE = 0.08
+OFFLINE_DAY_RATE = 0.04
+QR_RATE = 0.65
+QUESTION_RATE = 0.12
+
+SURNAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤', '吉田', '山田', '佐々木', '山口',
+            '松本', '井上', '木村', '林', '斎藤', '清水', '山崎', '森', '池田', '橋本', '阿部', '石川', '前田', '藤田', '小川', '岡田']
+GIVEN_NAMES = ['太郎', '翔', '蓮', '湊', '陽翔', '大和', '悠真', '颯', '樹', '蒼', '健太', '拓海', '大輝', '隼人', '優斗',
+               '花子', '陽菜', '凛', '結衣', '芽依', '葵', 'さくら', '美咲', '彩花', '七海', 'ひなた', '莉子', '真央', '千尋', '愛']
+SUBJECTS = {
+    '数学Ⅰ': ['数と式', '二次関数', '図形と計量', 'データの分析'],
+    '数学A': ['場合の数と確率', '整数の性質', '図形の性質'],
+    '英語': ['文法', '長文読解', '英作文', 'リスニング'],
+    '国語': ['現代文', '古文', '漢文'],
+    '物理': ['力学', '波動', '電磁気'],
+    '化学': ['理論化学', '無機化学', '有機化学'],
+}
+
+# 質問管理アプリの questions テーブル（school_qna/database.py と同じ定義）
+QUESTIONS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        grade INTEGER NOT NULL,
+        class_num INTEGER NOT NULL,
+        student_num INTEGER NOT NULL,
+        seat_num INTEGER,
+        problem_num TEXT,
+        subject TEXT NOT NULL,
+        sub_category TEXT NOT NULL,
+        details TEXT,
+        image_path TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        submission_type TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
+        client_id TEXT
+    )
+"""
+
+
+class Dataset:
+    """作成済みの合成データ（ファイルの場所と、作成時のパラメータ・件数）。"""
+
+    def __init__(self, data_dir, meta):
+        self.data_dir = data_dir
+        self.meta = meta
+        self.db_path = os.path.join(data_dir, 'students.db')
+        self.questions_db_path = os.path.join(data_dir, 'questions.db')
+        # アプリの起動時に名簿を同期するExcel（DBの名簿と同じ内容）
+        self.roster_path = os.path.join(data_dir, '生徒情報_benchmark.xlsx')
+
+    @property
+    def now(self):
+        """データの基準日時(JST, タイムゾーンなし)。"""
+        return datetime.datetime.fromisoformat(self.meta['params']['now'])
+
+    def connect(self):
+        """アプリ(app.get_db_connection)と同じ設定でDBに接続する。"""
+        conn = sqlite3.connect(self.db_path, timeout=10, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+def school_year(day):
+    """日付の年度（4月始まり）を返す。"""
+    return day.year if day.month >= 4 else day.year - 1
+
+def default_now():
+    """
+    基準日時の既定値（今日の17:30。放課後の在室者が多い時間帯）。
+    アチーブメント判定は現在時刻を基準にするため、今日の日付にする（同じ日の間は同じデータを使い回せる）。
+    """
+    return datetime.datetime.combine((datetime.datetime.utcnow() + JST_OFFSET).date(), datetime.time(17, 30))
+
+def load_or_generate(base_dir, classes=4, class_size=35, years=1, seed=1, now=None):
+    """
+    パラメータが同じ作成済みのデータがあればそれを、なければ作成して返す。
+    データは base_dir 内のパラメータごとのフォルダに保存する。
+    """
+    now = now or default_now()
+    params = {'classes': classes, 'class_size': class_size, 'years': years, 'seed': seed,
+              'now': now.isoformat(timespec='minutes'), 'format': DATA_FORMAT}
+    data_dir = os.path.join(base_dir, f"c{classes}x{class_size}_y{years}_s{seed}_{now.strftime('%Y%m%d%H%M')}")
+    meta_path = os.path.join(data_dir, DATASET_FILE_NAME)
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('params') == params:
+            return Dataset(data_dir, meta)
+    return generate(data_dir, classes=classes, class_size=class_size, years=years, seed=seed, now=now)
+
+def generate(data_dir, classes=4, class_size=35, years=1, seed=1, now=None):
+    """
+    合成データを data_dir に作成して返す（既存のファイルは作り直す）。
+    classes は1学年あたりの組数、class_size は1組の人数、years は now の年度から遡って作る年度数。
+    """
+    now = (now or default_now()).replace(second=0, microsecond=0)
+    os.makedirs(data_dir, exist_ok=True)
+    params = {'classes': classes, 'class_size': class_size, 'years': years, 'seed': seed,
+              'now': now.isoformat(timespec='minutes'), 'format': DATA_FORMAT}
+    dataset = Dataset(data_dir, {'params': params})
+    for path in (dataset.db_path, dataset.questions_db_path, dataset.roster_path):
+        if os.path.exists(path):
+            os.remove(path)
+    rng = np.random.default_rng(seed)
+
+    students = _make_students(rng, classes, class_size, school_year(now.date()))
+    first_day = datetime.date(school_year(now.date()) - years + 1, 4, 1)
+    logs = _make_logs(rng, students, first_day, now)
+    achievements, titles = _make_achievements(logs, _open_days(first_day, now.date()))
+    questions = _make_questions(rng, logs, students, now)
+
+    conn = sqlite3.connect(dataset.db_path)
+    try:
+        database.create_tables(conn)
+        _write_students(conn, students, titles)
+        _write_logs(conn, logs, now)
+        conn.executemany('INSERT INTO achievements_tracker (system_id, code, achieved_at, context) VALUES (?, ?, ?, ?)',
+                         achievements)
+        conn.commit()
+        database.rebuild_name_index(conn)
+    finally:
+        conn.close()
+    conn = sqlite3.connect(dataset.questions_db_path)
+    try:
+        conn.execute(QUESTIONS_SCHEMA)
+        conn.executemany('''
+            INSERT INTO questions (grade, class_num, student_num, seat_num, problem_num, subject, sub_category, details,
+                image_path, status, submission_type, created_at, client_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?, ?)
+        ''', questions)
+        conn.commit()
+    finally:
+        conn.close()
+    students.rename(columns={
+        'system_id': 'システムID', 'enrollment_year': '入学年度', 'grade': '学年', 'class': '組',
+        'student_number': '番号', 'name': '生徒氏名', 'guardian_email': 'メールアドレス',
+    }).drop(columns=['propensity']).to_excel(dataset.roster_path, index=False, engine='openpyxl')
+
+    dataset.meta['counts'] = {
+        'students': len(students),
+        'attendance_logs': len(logs),
+        'forgotten_exits': int(logs['forgot_exit'].sum()),
+        'offline_backfills': int(logs['offline'].sum()),
+        'present_now': int(logs['present'].sum()),
+        'achievements_tracker': len(achievements),
+        'questions': len(questions),
+    }
+    dataset.meta['first_day'] = first_day.isoformat()
+    with open(os.path.join(data_dir, DATASET_FILE_NAME), 'w', encoding='utf-8') as f:
+        json.dump(dataset.meta, f, ensure_ascii=False, indent=2)
+    return dataset
+
+
+# --- 名簿 ---
+def _make_students(rng, classes, class_size, current_school_year):
+    rows = []
+    for grade in GRADES:
+        enrollment_year = current_school_year - grade + 1
+        for class_number in range(1, classes + 1):
+            for student_number in range(1, class_size + 1):
+                system_id = enrollment_year * 10000 + class_number * 100 + student_number
+                rows.append((system_id, enrollment_year, grade, class_number, student_number))
+    students = pd.DataFrame(rows, columns=['system_id', 'enrollment_year', 'grade', 'class', 'student_number'])
+    students['name'] = [f'{sei}　{mei}' for sei, mei in zip(rng.choice(SURNAMES, len(students)),
+                                                           rng.choice(GIVEN_NAMES, len(students)))]
+    students['guardian_email'] = 'guardian' + students['system_id'].astype(str) + '@example.com'
+    # 1日あたりの利用確率（少数のよく使う生徒と、たまに使う多くの生徒）
+    propensity = rng.beta(0.8, 4.0, len(students))
+    propensity[students['grade'].isin(EXAM_GRADES).to_numpy()] *= 1.5
+    students['propensity'] = np.minimum(propensity, 0.9)
+    return students
+
+def _write_students(conn, students, titles):
+    conn.executemany('''
+        INSERT INTO students (system_id, enrollment_year, grade, class, student_number, name, guardian_email, title)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(int(row.system_id), int(row.enrollment_year), int(row.grade), int(row['class']), int(row.student_number),
+           row['name'], row.guardian_email, titles.get(int(row.system_id)))
+          for _, row in students.iterrows()])
+
+
+# --- 入退室記録 ---
+def _is_closed(day):
+    return day.weekday() == 6 or (day.month == 8 and 13 <= day.day <= 16) \
+        or (day.month == 12 and day.day >= 29) or (day.month == 1 and day.day <= 3)
+
+def _is_vacation(day):
+    return (day.month == 7 and day.day >= 21) or day.month == 8 \
+        or (day.month == 12 and day.day >= 24) or (day.month == 1 and day.day <= 7) \
+        or (day.month == 3 and day.day >= 25) or (day.month == 4 and day.day <= 7)
+
+def _open_days(first_day, last_day):
+    days, day = [], first_day
+    while day <= last_day:
+        if not _is_closed(day):
+            days.append(day)
+        day += datetime.timedelta(days=1)
+    return days
+
+def _make_logs(rng, students, first_day, now):
+    """開室日ごとに入退室を作り、入室時刻順の DataFrame で返す（時刻はJST・タイムゾーンなし）。"""
+    system_ids = students['system_id'].to_numpy()
+    propensity = students['propensity'].to_numpy()
+    exam_grade = students['grade'].isin(EXAM_GRADES).to_numpy()
+    frames = []
+    for day in _open_days(first_day, now.date()):
+        daytime = day.weekday() == 5 or _is_vacation(day)
+        factor = np.where(exam_grade & (day.month in (1, 2, 7, 8, 12)), 1.3, 1.0) * (0.6 if day.weekday() == 5 else 1.0)
+        visitors = np.flatnonzero(rng.random(len(system_ids)) < propensity * factor)
+        if daytime:
+            entry = OPEN_MINUTE + rng.uniform(0, 7 * 60, len(visitors))
+        else:
+            entry = AFTER_SCHOOL_MINUTE + np.minimum(rng.exponential(45, len(visitors)), 210)
+        stay = np.clip(rng.lognormal(np.log(100), 0.5, len(visitors)), 15, 300)
+        exit_ = np.minimum(entry + stay, CLOSE_MINUTE)
+        # 一度退室してから、同じ日にもう一度来る生徒
+        again = (rng.random(len(visitors)) < SECOND_VISIT_RATE) & (exit_ + 60 < CLOSE_MINUTE - 60)
+        entry2 = exit_[again] + rng.uniform(20, 60, again.sum())
+        exit2 = np.minimum(entry2 + np.clip(rng.lognormal(np.log(60), 0.5, again.sum()), 15, 180), CLOSE_MINUTE)
+        visitors = np.concatenate([visitors, visitors[again]])
+        entry, exit_ = np.concatenate([entry, entry2]), np.concatenate([exit_, exit2])
+
+        base = np.datetime64(day.isoformat(), 'us')
+        # 端末からの時刻はマイクロ秒まで入る（オフライン同期分は後で端末の時刻(ミリ秒単位)にする）
+        entry_at = base + (entry * 60e6).astype('int64').astype('timedelta64[us]') + rng.integers(0, 10**6, len(entry)).astype('timedelta64[us]')
+        exit_at = base + (exit_ * 60e6).astype('int64').astype('timedelta64[us]') + rng.integers(0, 10**6, len(entry)).astype('timedelta64[us]')
+        frame = pd.DataFrame({'system_id': system_ids[visitors], 'entry_time': entry_at, 'exit_time': exit_at})
+        frame['forgot_exit'] = rng.random(len(frame)) < FORGOT_EXIT_RATE
+        frame['seat_number'] = np.where(rng.random(len(frame)) < QR_RATE, '指定なし',
+                                        rng.integers(1, MAX_SEAT_NUMBER + 1, len(frame)).astype(str))
+        # 通信が切れていた時間帯の記録は、翌日にまとめて登録されたものとする
+        frame['offline'] = False
+        if day < now.date() and rng.random() < OFFLINE_DAY_RATE:
+            start = base + np.timedelta64(int(rng.uniform(OPEN_MINUTE if daytime else AFTER_SCHOOL_MINUTE, 19 * 60)), 'm')
+            length = np.timedelta64(int(rng.uniform(30, 120)), 'm')
+            frame['offline'] = (frame['entry_time'] >= start) & (frame['entry_time'] < start + length)
+        frames.append(frame)
+
+    logs = pd.concat(frames, ignore_index=True)
+    now64 = np.datetime64(now.isoformat(), 'us')
+    logs = logs[logs['entry_time'] < now64].sort_values('entry_time', kind='stable').reset_index(drop=True)
+    logs['day'] = logs['entry_time'].dt.date
+    # 基準日時の時点でまだ退室していない当日の記録は在室中（退室し忘れではない）
+    logs['present'] = logs['exit_time'] > now64
+    logs.loc[logs['present'], 'forgot_exit'] = False
+    logs.loc[logs['present'] | logs['forgot_exit'], 'exit_time'] = pd.NaT
+    for column in ('entry_time', 'exit_time'):
+        logs.loc[logs['offline'], column] = logs.loc[logs['offline'], column].dt.floor('ms')
+    return logs
+
+def _utc_iso(times):
+    # アプリと同じく、UTCの datetime.isoformat() と同じ形式にする（マイクロ秒が0の場合は小数部を付けない）
+    return [None if pd.isna(t) else (t.to_pydatetime() - JST_OFFSET).isoformat() + '+00:00' for t in times]
+
+def _write_logs(conn, logs, now):
+    # オフライン同期分は翌日の開室前に登録されたものとして、登録順(記録ID)を入室時刻の順からずらす
+    next_morning = (logs['day'] + datetime.timedelta(days=1)).astype('datetime64[us]') + pd.Timedelta(hours=8)
+    registered = logs['entry_time'].where(~logs['offline'], next_morning)
+    ordered = logs.assign(registered=registered).sort_values(['registered', 'entry_time'], kind='stable')
+    conn.executemany('INSERT INTO attendance_logs (system_id, entry_time, exit_time, seat_number) VALUES (?, ?, ?, ?)',
+                     zip(ordered['system_id'].astype(int).tolist(), _utc_iso(ordered['entry_time']),
+                         _utc_iso(ordered['exit_time']), ordered['seat_number'].tolist()))
+    # 在室中の生徒は入室中の記録を持つ（アプリの入室処理と同じ）
+    start_of_day = (datetime.datetime.combine(now.date(), datetime.time.min) - JST_OFFSET).isoformat() + '+00:00'
+    conn.execute('''
+        UPDATE students SET is_present = 1, current_log_id = (
+            SELECT MAX(id) FROM attendance_logs al
+            WHERE al.system_id = students.system_id AND al.entry_time >= ? AND al.exit_time IS NULL
+        )
+        WHERE system_id IN (SELECT system_id FROM attendance_logs WHERE entry_time >= ? AND exit_time IS NULL)
+    ''', (start_of_day, start_of_day))
+
+
+# --- アチーブメント ---
+def _make_achievements(logs, open_days):
+    """
+    記録から、achievement_logic の判定と同じ条件で達成したもの(system_id, code, 達成日, context)と、
+    月間ランキングで得た称号 {system_id: 称号} を返す。
+    """
+    rows = []
+    completed = logs[logs['exit_time'].notna()]
+    visits = logs[['system_id', 'day']].drop_duplicates().sort_values(['system_id', 'day']).reset_index(drop=True)
+    visits['month'] = pd.to_datetime(visits['day']).dt.to_period('M')
+
+    # 土曜の利用・18時以降の退室
+    saturdays = visits[pd.to_datetime(visits['day']).dt.weekday == 5]
+    rows += [(sid, day, 'weekend_warrior', str(day)) for sid, day in zip(saturdays['system_id'], saturdays['day'])]
+    late = completed[completed['exit_time'].dt.hour >= 18]
+    late = late.assign(exit_day=late['exit_time'].dt.date)[['system_id', 'exit_day']].drop_duplicates()
+    rows += [(sid, day, 'late_finisher', str(day)) for sid, day in zip(late['system_id'], late['exit_day'])]
+
+    # 月間の利用日数が10・20・30日に達した日
+    visits['nth'] = visits.groupby(['system_id', 'month']).cumcount() + 1
+    milestones = visits[visits['nth'].isin([10, 20, 30])]
+    rows += [(sid, day, f'monthly_visits_{n}', str(n))
+             for sid, day, n in zip(milestones['system_id'], milestones['day'], milestones['nth'])]
+
+    # 月間の利用時間が10時間ごとの区切り(100時間まで)を超えた日
+    hours = completed.sort_values('exit_time').assign(month=completed['entry_time'].dt.to_period('M'))
+    hours['after'] = (hours['exit_time'] - hours['entry_time']).dt.total_seconds().groupby(
+        [hours['system_id'], hours['month']]).cumsum() / 3600
+    hours['before'] = hours['after'] - (hours['exit_time'] - hours['entry_time']).dt.total_seconds() / 3600
+    for sid, exit_time, before, after in zip(hours['system_id'], hours['exit_time'], hours['before'], hours['after']):
+        for milestone in range(10, 101, 10):
+            if before < milestone <= after:
+                rows.append((sid, exit_time.date(), 'monthly_hours', str(milestone)))
+
+    # 連続利用日数（記録のある日を開室日として数える）
+    day_index = {day: i for i, day in enumerate(sorted(set(logs['day']) & set(open_days)))}
+    visits['index'] = visits['day'].map(day_index)
+    new_streak = (visits['system_id'] != visits['system_id'].shift()) | (visits['index'] - visits['index'].shift() != 1)
+    visits['streak'] = visits.groupby(new_streak.cumsum()).cumcount() + 1
+    streaks = visits[visits['streak'] >= 2]
+    rows += [(sid, day, 'consecutive_days', f'days_{n}')
+             for sid, day, n in zip(streaks['system_id'], streaks['day'], streaks['streak'])]
+
+    # 月初めの利用時に前月のランキングを確認し、上位3人に順位のアチーブメントと称号を付ける
+    first_visits = visits[visits['nth'] == 1]
+    rows += [(sid, day, 'monthly_rank_check', f'rank_check_{month.year}_{month.month}')
+             for sid, day, month in zip(first_visits['system_id'], first_visits['day'], first_visits['month'])]
+    seconds = (completed['exit_time'] - completed['entry_time']).dt.total_seconds()
+    monthly_seconds = seconds.groupby([completed['entry_time'].dt.to_period('M'), completed['system_id']]).sum()
+    first_visit = first_visits.set_index(['month', 'system_id'])['day']
+    titles, best_rank = {}, {}
+    rank_titles = {1: '首席利用者', 2: '次席利用者', 3: '三席利用者'}
+    for month, totals in monthly_seconds.groupby(level=0):
+        top = totals.droplevel(0).sort_values(ascending=False, kind='stable').head(3)
+        for rank, sid in enumerate(top.index, start=1):
+            day = first_visit.get((month + 1, sid))
+            if day is None:
+                continue
+            rows.append((sid, day, f'monthly_rank_{rank}', f'rank_{month.year}_{month.month}'))
+            if rank < best_rank.get(sid, 4):
+                best_rank[sid], titles[int(sid)] = rank, rank_titles[rank]
+
+    rows.sort(key=lambda row: (row[1], row[0], row[2]))
+    return [(int(sid), code, day.isoformat(), context) for sid, day, code, context in rows], titles
+
+
+# --- 質問 ---
+def _make_questions(rng, logs, students, now):
+    """在室中に登録された質問を、登録時刻順の INSERT 用の値で返す。"""
+    asked = logs[rng.random(len(logs)) < QUESTION_RATE]
+    asked = asked.loc[asked.index.repeat(rng.choice([1, 1, 1, 2], len(asked)))]
+    roster = students.set_index('system_id')
+    end = asked['exit_time'].fillna(pd.Timestamp(now))
+    span = (end - asked['entry_time']).dt.total_seconds().clip(lower=60)
+    created = (asked['entry_time'] + pd.to_timedelta(rng.uniform(0.05, 0.95, len(asked)) * span, unit='s')).dt.floor('s')
+    order = np.argsort(created.to_numpy(), kind='stable')
+    subjects = list(SUBJECTS)
+    rows = []
+    for i in order:
+        log = asked.iloc[i]
+        student = roster.loc[log['system_id']]
+        subject = subjects[rng.integers(len(subjects))]
+        sub_category = SUBJECTS[subject][rng.integers(len(SUBJECTS[subject]))]
+        seat = int(log['seat_number']) if log['seat_number'] != '指定なし' else int(rng.integers(1, MAX_SEAT_NUMBER + 1))
+        wait = rng.random() < 0.4
+        # 「待って質問」は対応済みになるまで pending（基準日時の直前に登録されたものだけ未対応のまま残す）
+        pending = wait and created.iloc[i] > pd.Timestamp(now) - pd.Timedelta(minutes=30)
+        image = json.dumps([f"{created.iloc[i].strftime('%Y%m%d%H%M%S')}_{rng.integers(16**8):08x}_photo.jpg"]) \
+            if rng.random() < 0.3 else None
+        rows.append((int(student['grade']), int(student['class']), int(student['student_number']), seat,
+                     f"問{rng.integers(1, 20)}({rng.integers(1, 5)})", subject, sub_category, image,
+                     'pending' if pending else 'done', 'wait' if wait else 'immediate',
+                     created.iloc[i].strftime('%Y-%m-%d %H:%M:%S'), f'{rng.integers(2**63):016x}'))
+    return rows
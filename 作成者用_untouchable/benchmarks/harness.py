@@ -0,0 +1,217 @@
+"""
+計測の実行と結果の保存・比較。
+bench_*.py の bench_ で始まる関数を定義順に呼び出し、benchmark(計測用のオブジェクト)と dataset(合成データ)を渡す。
+結果のJSONは pytest-benchmark の保存形式（machine_info / commit_info / benchmarks[].stats）に合わせる。
+"""
+import os
+import json
+import time
+import inspect
+import platform
+import datetime
+import importlib
+import statistics
+import subprocess
+import traceback
+
+from . import BASE_DIR
+
+SUITE_MODULES = ['bench_reports', 'bench_user_summary', 'bench_achievements', 'bench_api']
+RESULT_FORMAT_VERSION = 1
+DEFAULT_ROUNDS = 5
+
+
+class Benchmark:
+    """
+    1つの計測。pytest-benchmark の benchmark フィクスチャと同じく、
+    benchmark(func, *args) または benchmark.pedantic(func, setup=..., rounds=...) で計測し、func の戻り値を返す。
+    rounds を指定すると、各計測で指定した回数より優先する（コマンドラインの --rounds）。
+    """
+
+    def __init__(self, name, group, rounds=None):
+        self.name = name
+        self.group = group
+        self.rounds_override = rounds
+        self.extra_info = {}
+        self.data = []
+
+    def __call__(self, target, *args, **kwargs):
+        return self.pedantic(target, args=args, kwargs=kwargs, rounds=DEFAULT_ROUNDS, warmup_rounds=1)
+
+    def pedantic(self, target, args=(), kwargs=None, setup=None, teardown=None, rounds=1, warmup_rounds=0, iterations=1):
+        """
+        target を warmup_rounds + rounds 回呼び出し、後ろの rounds 回の所要時間を記録する。
+        setup / teardown は各回の前後に呼び出す（所要時間に含めない）。setup が (args, kwargs) を返した場合はそれを使う。
+        iterations は1回の計測で続けて呼び出す回数（短い処理の計測誤差を減らすため。記録するのは1呼び出しあたりの時間）。
+        """
+        kwargs = kwargs or {}
+        rounds = self.rounds_override or rounds
+        self.data = []
+        result = None
+        for i in range(warmup_rounds + rounds):
+            call_args, call_kwargs = args, kwargs
+            if setup is not None:
+                prepared = setup()
+                if prepared is not None:
+                    call_args, call_kwargs = prepared
+            try:
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    result = target(*call_args, **call_kwargs)
+                elapsed = (time.perf_counter() - started) / iterations
+            finally:
+                if teardown is not None:
+                    teardown()
+            if i >= warmup_rounds:
+                self.data.append(elapsed)
+        self.iterations = iterations
+        return result
+
+    def stats(self):
+        data = sorted(self.data)
+        if not data:
+            return None
+        quartiles = statistics.quantiles(data, n=4) if len(data) > 1 else [data[0]] * 3
+        mean = statistics.fmean(data)
+        return {
+            'min': data[0], 'max': data[-1], 'mean': mean,
+            'stddev': statistics.stdev(data) if len(data) > 1 else 0.0,
+            'median': statistics.median(data), 'q1': quartiles[0], 'q3': quartiles[2], 'iqr': quartiles[2] - quartiles[0],
+            'rounds': len(data), 'iterations': self.iterations, 'total': sum(data), 'ops': 1 / mean if mean else None,
+            'data': self.data,
+        }
+
+
+def collect(name_filter=None):
+    """計測関数を (グループ名, 関数名, 関数) の一覧で返す。name_filter を指定した場合は「グループ名.関数名」に含むものだけ。"""
+    found = []
+    for module_name in SUITE_MODULES:
+        module = importlib.import_module(f'{__package__}.{module_name}')
+        group = module_name[len('bench_'):]
+        functions = [func for name, func in inspect.getmembers(module, inspect.isfunction)
+                     if name.startswith('bench_') and func.__module__ == module.__name__]
+        for func in sorted(functions, key=lambda f: f.__code__.co_firstlineno):
+            name = func.__name__[len('bench_'):]
+            if not name_filter or name_filter in f'{group}.{name}':
+                found.append((group, name, func))
+    return found
+
+def run(dataset, name_filter=None, rounds=None, report=print):
+    """
+    計測関数を順に実行し、pytest-benchmark の benchmarks[] と同じ形の結果の一覧を返す。
+    失敗した計測は stats を None、error にエラー内容を入れて続行する。
+    """
+    results = []
+    for group, name, func in collect(name_filter):
+        benchmark = Benchmark(name, group, rounds=rounds)
+        error = None
+        try:
+            func(benchmark, dataset)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            traceback.print_exc()
+        stats = benchmark.stats() if error is None else None
+        results.append({
+            'group': group, 'name': name, 'fullname': f'benchmarks/bench_{group}.py::bench_{name}',
+            'params': None, 'extra_info': benchmark.extra_info, 'stats': stats, 'error': error,
+        })
+        if stats:
+            report(f"{group}.{name}: 中央値 {_format_seconds(stats['median'])} "
+                   f"(最小 {_format_seconds(stats['min'])}, {stats['rounds']}回)")
+        else:
+            report(f'{group}.{name}: 失敗 - {error}')
+    return results
+
+
+# --- 保存と比較 ---
+def default_results_dir():
+    return os.path.join(BASE_DIR, 'results')
+
+def commit_info():
+    """計測したソースのコミット(ID・ブランチ・未コミットの変更の有無)。git がない場合は空の値を返す。"""
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=BASE_DIR, capture_output=True, text=True, timeout=30,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'id': git('rev-parse', 'HEAD'),
+        'time': git('show', '-s', '--format=%cI', 'HEAD'),
+        'branch': git('rev-parse', '--abbrev-ref', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+    }
+
+def machine_info():
+    return {
+        'node': platform.node(), 'machine': platform.machine(), 'system': platform.system(),
+        'release': platform.release(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+        'python_implementation': platform.python_implementation(), 'python_version': platform.python_version(),
+    }
+
+def save_results(results, dataset, path=None):
+    """結果をJSONに保存し、保存先を返す。path を省略した場合は results フォルダに日時とコミットIDの名前で保存する。"""
+    commit = commit_info()
+    if path is None:
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(default_results_dir(), f"{stamp}_{(commit['id'] or 'nogit')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    document = {
+        'version': RESULT_FORMAT_VERSION,
+        'datetime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'machine_info': machine_info(),
+        'commit_info': commit,
+        'dataset': {'params': dataset.meta['params'], 'counts': dataset.meta.get('counts')},
+        'benchmarks': results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return path
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def compare(base, new, threshold=0.1, stat='median'):
+    """
+    2つの結果を計測ごとに比較し、(比較結果の一覧, 遅くなった計測の一覧) を返す。
+    new の値が base より threshold (割合) を超えて大きいものを「遅くなった」とする。片方にしかない計測は比べない。
+    """
+    base_stats = {f"{b['group']}.{b['name']}": b.get('stats') for b in base['benchmarks']}
+    rows, regressions = [], []
+    for bench in new['benchmarks']:
+        key = f"{bench['group']}.{bench['name']}"
+        old_stats, new_stats = base_stats.get(key), bench.get('stats')
+        if not old_stats or not new_stats:
+            continue
+        ratio = new_stats[stat] / old_stats[stat] if old_stats[stat] else float('inf')
+        row = {'name': key, 'base': old_stats[stat], 'new': new_stats[stat], 'ratio': ratio}
+        rows.append(row)
+        if ratio > 1 + threshold:
+            regressions.append(row)
+    return rows, regressions
+
+def format_comparison(rows, base, new, threshold, stat='median'):
+    lines = [f"比較元: {_describe(base)}", f"比較先: {_describe(new)}"]
+    if base.get('dataset', {}).get('params') != new.get('dataset', {}).get('params'):
+        lines.append('注意: 2つの結果は異なる合成データで計測されています。')
+    width = max([len(row['name']) for row in rows] + [4])
+    lines.append(f"{'計測'.ljust(width)}  {'比較元':>10}  {'比較先':>10}  変化 ({stat})")
+    for row in rows:
+        mark = '  ← 遅くなった' if row['ratio'] > 1 + threshold else ''
+        lines.append(f"{row['name'].ljust(width)}  {_format_seconds(row['base']):>10}  {_format_seconds(row['new']):>10}  "
+                     f"{(row['ratio'] - 1) * 100:+.1f}%{mark}")
+    return '\n'.join(lines)
+
+def _describe(document):
+    commit = document.get('commit_info') or {}
+    dirty = ' (未コミットの変更あり)' if commit.get('dirty') else ''
+    return f"{(commit.get('id') or '不明')[:8]}{dirty} {document.get('datetime', '')[:19]}"
+
+def _format_seconds(seconds):
+    if seconds >= 1:
+        return f'{seconds:.2f}s'
+    if seconds >= 1e-3:
+        return f'{seconds * 1e3:.2f}ms'
+    return f'{seconds * 1e6:.1f}us'
@@ -4,20 +4,32 @@ import datetime
 import pytz 
 import traceback
 import logging # 追加
-import queue
 import json
+import gzip # 追加
+import threading # 追加
+import base64 # 追加
+import csv # 追加
+import io # 追加
+from collections import OrderedDict # 追加
 import secrets # 追加
 import atexit # 追加
 from apscheduler.schedulers.background import BackgroundScheduler # 追加
 # from logging.handlers import RotatingFileHandler # 削除またはコメントアウト
 from concurrent_log_handler import ConcurrentRotatingFileHandler # 追加
 import os # osがインポートされているか確認（なければ追加）
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, send_file
 from dotenv import load_dotenv
 import database
-from report_generator import create_report
+import report_jobs # 追加
+import report_rollups # 追加
+import attendance_archive # 追加
+import report_batch # 追加
+from report_jobs import ReportJobManager, ReportQueueFull # 追加
 from achievement_logic import check_achievements
 from email_sender import send_email_async, retry_queued_emails
+from event_hub import BroadcastHub, CoalescingPublisher
+from async_sse import AsyncSSEServer
+from event_bus import EventBus, LeaderLock
 # 【追加】質問管理アプリのBlueprintをインポート
 # 注意: pyフォルダから見た相対パスでインポートできるようパスを通すか、
 # school_qnaフォルダをパッケージとして認識させる必要があります。
@@ -26,7 +38,7 @@ import sys
 import os
 import glob # 追加
 sys.path.append(os.path.join(os.path.dirname(__file__), '..')) 
-from school_qna import school_qna_bp
+from school_qna import school_qna_bp, qna_hub, attach_event_bus as attach_qna_event_bus
 
 # 【追加】指定日数より古いログファイルを削除する関数
 def cleanup_old_logs(log_dir, retention_days=30):
@@ -72,6 +84,8 @@ class PollingLogFilter(logging.Filter):
             return False
         if 'GET /qna/api/check_new_questions' in msg and '" 200 ' in msg:
             return False
+        if 'GET /qna/api/stream' in msg and '" 200 ' in msg: # 【追加】質問通知のSSE接続ログを抑制
+            return False
         if 'GET /api/stream' in msg and '" 200 ' in msg: # メインアプリのSSE接続ログも抑制したい場合
             return False
         if 'GET /api/settings' in msg and '" 200 ' in msg: # 【追加】ヘルスチェックのログを抑制
@@ -82,18 +96,126 @@ class PollingLogFilter(logging.Filter):
 dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '管理者用_touchable', '.env')
 load_dotenv(dotenv_path)
 
-# SSE用: 接続中のクライアントキューを保持するリスト
-sse_clients = []
+# SSE用: 接続中のクライアントを管理するブロードキャストハブ
+# ハートビート間隔(秒)は .env の SSE_HEARTBEAT_SECONDS で変更可能 (推奨: 15〜25秒)
+# 再接続時の再送用に保持するイベント数は SSE_REPLAY_BUFFER_SIZE で変更可能
+sse_hub = BroadcastHub(name='attendance',
+                       heartbeat_interval=float(os.getenv('SSE_HEARTBEAT_SECONDS', 20)),
+                       replay_size=int(os.getenv('SSE_REPLAY_BUFFER_SIZE', 500)))
+# 【追加】連続する更新通知(一斉入室や記録の連続編集など)を1回の配信にまとめる
+# SSE_COALESCE_WINDOW_MS: まとめる間隔(0で無効), SSE_COALESCE_MAX_DELAY_MS: 最初の通知からの最大待ち時間
+sse_publisher = CoalescingPublisher(sse_hub,
+                                    window=float(os.getenv('SSE_COALESCE_WINDOW_MS', 100)) / 1000,
+                                    max_delay=float(os.getenv('SSE_COALESCE_MAX_DELAY_MS', 500)) / 1000)
+
+# 【追加】非同期SSEサーバー（.env の SSE_ASYNC_PORT を設定した場合のみ起動）
+# 起動中は各画面（入退室・記録編集・質問受付）のSSE接続がこちらへ向き、Flask側のスレッドをストリーミングで占有しなくなる
+# 【修正】app.py を直接実行した場合だけでなく、WSGIサーバーから読み込んだ場合もモジュールの初期化時に起動する（下部の start_async_sse_server の呼び出し）
+#   - SSE_ASYNC_PORT: 待ち受けるポート。Flask本体とは別のポートにし、端末からそのポートへ接続できるようにしておく
+#     (未設定の場合は起動せず、従来通り Flask の /api/stream で配信する)
+#   - SSE_ASYNC_ALLOW_ORIGIN: 画面(Flask側のポート)からの接続を許可するオリジン (既定: *)
+#   - 証明書(certs/cert.crt, certs/key.pem)がある場合は、Flask本体と同じく HTTPS で待ち受ける
+#   - 複数のワーカープロセスで動かす場合、待ち受けられるのは最初に起動した1プロセスのみ。
+#     他のプロセスの画面は Flask の /api/stream を使うため、EVENT_BUS_ENABLED=true と組み合わせる
+CERT_PATH = os.path.join(os.path.dirname(__file__), '..', 'certs', 'cert.crt')
+KEY_PATH = os.path.join(os.path.dirname(__file__), '..', 'certs', 'key.pem')
+# デバッグ実行時の自動リロード（FLASK_USE_RELOADER=false で無効）
+USE_RELOADER = os.getenv('FLASK_USE_RELOADER', 'true').lower() == 'true'
+async_sse_server = None
+
+def _ssl_files():
+    """証明書と秘密鍵の両方が存在する場合は (証明書, 秘密鍵) のパスを、ない場合は None を返す。"""
+    if os.path.exists(CERT_PATH) and os.path.exists(KEY_PATH):
+        return CERT_PATH, KEY_PATH
+    return None
 
-def announce_update():
-    """全接続クライアントに更新通知を送る"""
-    msg = json.dumps({"type": "update"})
-    # リストのコピーを作成して反復処理（スレッドセーフ対策）
-    for q in sse_clients[:]:
-        try:
-            q.put(msg)
-        except Exception:
-            pass # エラー時は無視
+def _is_reloader_parent():
+    # 自動リロードでは、監視用の親プロセスもこのモジュールを実行する（実際に配信するのは子プロセス）
+    return __name__ == '__main__' and USE_RELOADER and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
+def start_async_sse_server(ssl_files=None):
+    """SSE_ASYNC_PORT が設定されていれば、同一プロセス内で非同期SSEサーバーを起動する。"""
+    global async_sse_server
+    port = os.getenv('SSE_ASYNC_PORT')
+    if not port or async_sse_server is not None:
+        return async_sse_server
+    ssl_context = None
+    if ssl_files:
+        import ssl
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(*ssl_files)
+    server = AsyncSSEServer(sse_hub, port=int(port), ssl_context=ssl_context,
+                            allow_origin=os.getenv('SSE_ASYNC_ALLOW_ORIGIN', '*'))
+    # 【追加】質問受付の通知も同じポートで配信する（パスは Flask 側の /qna/api/stream と同じ）
+    server.add_hub(qna_hub, '/qna/api/stream').start_in_thread()
+    if not server.started:
+        # ポートが使用中（他のワーカーが待ち受け中など）の場合は、このプロセスの画面の配信を Flask 側に任せる
+        app.logger.warning(f"[システムログ] 非同期SSEサーバーを起動できませんでした (ポート: {port})。Flask の /api/stream で配信します。")
+        return None
+    async_sse_server = server
+    return async_sse_server
+
+def _on_attendance_bus_event(version, event):
+    # 一括編集の変更は1件のバスイベントにまとめて届くので、各プロセスでも1回の配信にまとめる
+    if event.get('type') == 'bulk':
+        sse_publisher.notify_batch([(e, e['version']) for e in event['events']])
+    else:
+        sse_publisher.notify(event, version=version)
+
+def announce_update(kind=None, log=None, students=None, version=None):
+    """
+    全接続クライアントに更新内容を送る。
+    kind を指定した場合は差分イベント(check_in / check_out / log_edit / log_delete / presence_reset)として送信し、
+    クライアントは全件を再取得せずにその場で反映する。kind なしの場合は従来通り再取得を促す。
+    version には変更履歴(database.record_change)で採番したバージョンを渡す。
+    """
+    if kind is None:
+        event = {"type": "update"}
+    else:
+        event = {"type": "delta", "kind": kind, "log": log, "students": students or []}
+    if event_bus:
+        # 自プロセスの購読者にも、イベントバス経由で他のワーカーと同じ順序で届ける
+        return event_bus.publish('attendance', event, version=version)
+    return sse_publisher.notify(event, version=version)
+
+# 【追加】集計レポート作成ジョブの終了通知
+# 入退室データのバージョン(id:)とは無関係なので、バージョンを付けずにそのまま配信する
+def _publish_report_event(event):
+    sse_hub.publish(json.dumps(event, ensure_ascii=False, default=str))
+
+def announce_report_job(job):
+    event = {"type": "report_job", "job": job}
+    if event_bus:
+        event_bus.publish('reports', event)
+    else:
+        _publish_report_event(event)
+
+def announce_updates(deltas):
+    """
+    複数の差分 [(kind, log, students, version), ...] を1回の配信(batch)で全接続クライアントに送る。
+    各差分は個別のバージョンを持つため、クライアントは1件ずつ届いた場合と同じように反映できる。
+    """
+    events = [({"type": "delta", "kind": kind, "log": log, "students": students or []}, version)
+              for kind, log, students, version in deltas]
+    if not events:
+        return []
+    if event_bus:
+        bulk = {"type": "bulk", "events": [dict(event, version=version) for event, version in events]}
+        event_bus.publish('attendance', bulk, version=events[-1][1])
+        return [version for _, version in events]
+    return sse_publisher.notify_batch(events)
+
+# 【追加】マルチプロセス構成用のイベントバス（EVENT_BUS_ENABLED=true の場合のみ有効）
+# 有効時は、どのワーカーで発生した更新も全ワーカーのSSE接続へ届き、バージョンも全ワーカーで共通になる
+event_bus = None
+if os.getenv('EVENT_BUS_ENABLED', 'false').lower() == 'true':
+    event_bus = EventBus(poll_interval=float(os.getenv('EVENT_BUS_POLL_SECONDS', 1)))
+    sse_hub.seed_version(event_bus.latest_version('attendance'))
+    event_bus.subscribe('attendance', _on_attendance_bus_event)
+    attach_qna_event_bus(event_bus)
+    event_bus.subscribe('reports', lambda version, event: _publish_report_event(event))
+    # 【修正】購読先をすべて定義・登録してからポーリングを開始する（開始直後に届いたイベントを取りこぼさないため）
+    event_bus.start()
 
 app = Flask(__name__, 
             template_folder=os.path.join(os.path.dirname(__file__), '..', 'templates'),
@@ -173,6 +295,11 @@ UTC = pytz.utc
 def inject_theme_color():
     return dict(theme_color=os.getenv('THEME_COLOR', '#4a90e2'))
 
+# 【追加】非同期SSEサーバーのポートを画面に渡す（未起動の場合は空文字で、従来の /api/stream を使う）
+@app.context_processor
+def inject_sse_port():
+    return dict(sse_port=async_sse_server.port if async_sse_server else '')
+
 # --- データベース接続 ---
 def get_db_connection():
     # タイムアウトを10秒に設定（デフォルトは5秒）。
@@ -194,6 +321,15 @@ def _get_log_details(conn, log_id):
     row = conn.execute(query, (log_id,)).fetchone()
     return dict(row) if row else None
 
+# 【追加】差分通知用に、生徒の在室状態を取得する関数
+def _get_presence(conn, system_ids):
+    ids = [sid for sid in dict.fromkeys(system_ids) if sid is not None]
+    if not ids:
+        return []
+    placeholders = ','.join('?' * len(ids))
+    rows = conn.execute(f'SELECT system_id, is_present, current_log_id FROM students WHERE system_id IN ({placeholders})', ids).fetchall()
+    return [{'system_id': r['system_id'], 'is_present': bool(r['is_present']), 'current_log_id': r['current_log_id']} for r in rows]
+
 def parse_db_time_to_jst(dt_str):
     if not dt_str: return None
     try:
@@ -270,8 +406,21 @@ def _handle_notifications(conn, system_id, event_type, log_id):
     return ach_result
 
 # --- 起動時処理 ---
+# 【追加】条件付きGET(ETag)用の名簿バージョン。名簿は起動時のExcel同期でしか変わらないため、ここで確定させる
+roster_version = None
+# ETagにはプロセスの識別子も含め、再起動でバージョン番号が巻き戻っても古いキャッシュと一致しないようにする
+# (イベントバス有効時はバージョンが全プロセス共通かつ永続なので、識別子は不要)
+SERVER_EPOCH = 'bus' if event_bus else secrets.token_hex(4)
+
 with app.app_context():
     database.init_db()
+    _conn = get_db_connection()
+    try:
+        roster_version = database.get_roster_version(_conn)
+        # 【追加】データバージョンは変更履歴の番号を使うため、再起動後も続きから採番する
+        sse_hub.seed_version(database.get_change_version(_conn))
+    finally:
+        _conn.close()
 
 # --- ルーティング ---
 @app.route('/')
@@ -288,63 +437,154 @@ def index():
         return render_template('index.html', mode=mode, app_name=app_name, max_seat_number=max_seat_number, org_name_eng=org_name_eng, use_seat_number=use_seat_number)
 
 # --- API ---
+# 【追加】条件付きGET用のヘルパー
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    # ブラウザにキャッシュさせつつ、毎回 If-None-Match で再検証させる
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _build_roster(conn):
+    """名簿を {学年: {組: {番号: 生徒}}} の入れ子構造で返す。"""
+    roster = {}
+    for row in conn.execute('SELECT system_id, name, grade, class, student_number FROM students ORDER BY grade, class, student_number'):
+        student = dict(row)
+        roster.setdefault(student['grade'], {}).setdefault(student['class'], {})[student['student_number']] = student
+    return roster
+
+# 【追加】初期データのシリアライズ・圧縮済みキャッシュ
+# キー: (日付, 名簿バージョン, データバージョン, 名簿を含むか) → (JSON, gzip圧縮済みJSON)
+# データバージョンは書き込みのたびに増えるため、書き込みがあると次の取得時に作り直される
+_initial_data_cache = {}
+_initial_data_cache_lock = threading.Lock()
+
+def _store_initial_data(cache_key, payload):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    entry = (body, gzip.compress(body, compresslevel=6))
+    with _initial_data_cache_lock:
+        # 古いバージョンの応答は不要なので捨て、同じバージョンの名簿あり/なしの2種類だけを保持する
+        for key in [k for k in _initial_data_cache if k[:3] != cache_key[:3]]:
+            del _initial_data_cache[key]
+        _initial_data_cache[cache_key] = entry
+    return entry
+
+def _serialized_response(entry, etag):
+    body, gzipped = entry
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return _with_etag(response, etag)
+
+# 【追加】名簿のみを返すAPI（Excelの再同期まで変わらないため、ETagで長く再利用できる）
+@app.route('/api/roster')
+def get_roster():
+    etag = f"roster-{roster_version}"
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+    conn = get_db_connection()
+    try:
+        return _with_etag(jsonify({'students': _build_roster(conn), 'roster_version': roster_version}), etag)
+    except Exception as e:
+        app.logger.error(f"Error in get_roster: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'名簿の取得中にエラーが発生しました: {e}'}), 500
+    finally:
+        conn.close()
+
 @app.route('/api/initial_data')
 def get_initial_data():
     now_jst = datetime.datetime.now(JST)
     today_date = now_jst.date() # 今日の日付を取得
     start_of_day_jst = now_jst.replace(hour=0, minute=0, second=0, microsecond=0)
     start_of_day_utc = start_of_day_jst.astimezone(UTC)
+    # 【追加】読み込み前の時点のデータバージョンを返す（以降の差分はSSEで受け取る）
+    version = sse_hub.current_version()
+
+    # 【追加】クライアントが最新の名簿を保持している場合は、名簿を省いて在室状況のみを返す
+    include_roster = request.args.get('roster_version') != roster_version
+    # データバージョンは書き込みのたびに増えるため、日付・名簿・データのバージョンが同じなら内容も同じ
+    # この場合はDBに触れずに 304 を返す
+    etag = f"{SERVER_EPOCH}-{today_date.isoformat()}-{roster_version}-{version}-{'full' if include_roster else 'presence'}"
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    # 【追加】同じ日付・名簿・データバージョンの応答はシリアライズ・圧縮済みのものを使い回す
+    cache_key = (today_date, roster_version, version, include_roster)
+    cached = _initial_data_cache.get(cache_key)
+    if cached:
+        return _serialized_response(cached, etag)
+
     conn = get_db_connection()
 
     try: # データベース操作全体をtry...finallyで囲む
-        students_cursor = conn.execute('SELECT system_id, name, grade, class, student_number, is_present, current_log_id FROM students ORDER BY grade, class, student_number')
-        all_students_list = students_cursor.fetchall() # 一度リストとして取得
+        # 【修正】在室中の生徒の入室ログを1件ずつ引かず、1回のJOINでまとめて取得する
+        students_cursor = conn.execute("""
+            SELECT s.system_id, s.name, s.grade, s.class, s.student_number, s.is_present, s.current_log_id,
+                   al.entry_time AS current_entry_time
+            FROM students s
+            LEFT JOIN attendance_logs al ON al.id = s.current_log_id AND s.is_present = 1
+            ORDER BY s.grade, s.class, s.student_number
+        """)
 
         students_data_nested = {}
+        presence = {}
         #is_present の状態を日付でチェックして上書き 
         ids_to_reset = [] # DBリセット対象のsystem_idリスト
-        for student_row in all_students_list:
+        for student_row in students_cursor:
             student = dict(student_row) # Rowオブジェクトを辞書に変換
-            is_present_db = student['is_present'] == 1
-            current_log_id = student['current_log_id']
+            current_entry_time = student.pop('current_entry_time')
             is_present_today_for_frontend = False # フロントエンドに返す値（デフォルトFalse）
 
-            if is_present_db and current_log_id:
+            if student['is_present'] == 1 and current_entry_time:
                 # 入室中の場合、ログの日付を確認
-                log_entry = conn.execute('SELECT entry_time FROM attendance_logs WHERE id = ?', (current_log_id,)).fetchone()
-                if log_entry:
-                    entry_time_jst = parse_db_time_to_jst(log_entry['entry_time'])
-                    if entry_time_jst and entry_time_jst.date() == today_date:
-                        # 今日の記録ならフロントエンドにも True を返す
-                        is_present_today_for_frontend = True
-                    else:
-                        # 前日以前の記録ならリセット対象に追加
-                        ids_to_reset.append(student['system_id'])
-                        app.logger.info(f"ID:{student['system_id']} の前日以前の入室記録を検出(initial_data)。リセット対象に追加。")
+                entry_time_jst = parse_db_time_to_jst(current_entry_time)
+                if entry_time_jst and entry_time_jst.date() == today_date:
+                    # 今日の記録ならフロントエンドにも True を返す
+                    is_present_today_for_frontend = True
+                else:
+                    # 前日以前の記録ならリセット対象に追加
+                    ids_to_reset.append(student['system_id'])
+                    app.logger.info(f"ID:{student['system_id']} の前日以前の入室記録を検出(initial_data)。リセット対象に追加。")
             # else: is_present が 0 または log_id がない場合は is_present_today_for_frontend は False のまま
 
             # フロントエンドに返す is_present を設定
             student['is_present'] = is_present_today_for_frontend
 
-            # ネスト構造に格納 
-            grade, class_num, number = student['grade'], student['class'], student['student_number']
-            if grade not in students_data_nested: students_data_nested[grade] = {}
-            if class_num not in students_data_nested[grade]: students_data_nested[grade][class_num] = {}
-            students_data_nested[grade][class_num][number] = student
+            if include_roster:
+                # ネスト構造に格納 
+                students_data_nested.setdefault(student['grade'], {}).setdefault(student['class'], {})[student['student_number']] = student
+            else:
+                presence[student['system_id']] = {'is_present': student['is_present'], 'current_log_id': student['current_log_id']}
 
         #リセット対象の生徒のDBステータスを更新
         if ids_to_reset:
             # プレースホルダーを使って安全にUPDATE文を実行
             placeholders = ','.join('?' * len(ids_to_reset))
             conn.execute(f'UPDATE students SET is_present = 0, current_log_id = NULL WHERE system_id IN ({placeholders})', ids_to_reset)
+            reset_versions = [database.record_change(conn, 'presence_reset', system_id=sid) for sid in ids_to_reset]
             conn.commit()
             app.logger.info(f"リセット対象 {len(ids_to_reset)} 件のステータスをDBでリセットしました。")
+            for sid, reset_version in zip(ids_to_reset, reset_versions):
+                announce_update('presence_reset', None, _get_presence(conn, [sid]), version=reset_version)
 
         # 今日の入退室記録を取得
         attendees_cursor = conn.execute('SELECT al.id AS log_id, s.system_id, al.seat_number, al.entry_time, al.exit_time, s.name, s.grade, s.class, s.student_number FROM attendance_logs al JOIN students s ON al.system_id = s.system_id WHERE al.entry_time >= ? ORDER BY al.entry_time ASC', (start_of_day_utc.isoformat(),))
         current_attendees = [dict(row) for row in attendees_cursor.fetchall()]
 
-        return jsonify({'students': students_data_nested, 'attendees': current_attendees})
+        payload = {'attendees': current_attendees, 'version': version, 'roster_version': roster_version}
+        if include_roster:
+            payload['students'] = students_data_nested
+        else:
+            payload['presence'] = presence
+        return _serialized_response(_store_initial_data(cache_key, payload), etag)
 
     except Exception as e:
         app.logger.error(f"Error in get_initial_data: {e}", exc_info=True)
@@ -455,14 +695,16 @@ def check_in():
         log_suffix = " (オフライン同期)" if data.get('is_offline_sync') else ""
         app.logger.info(f"[操作ログ] 入室処理(手入力){log_suffix} - 生徒ID: {system_id}, 座席: {seat_number}, 実行者IP: {request.remote_addr}")
 
+        version = database.record_change(conn, 'check_in', new_log_id, system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
 
         # `rank`キーに、上で決定した最新のランク情報(final_rank)を渡す
         # 【修正】リスト更新用のログデータを返却に追加
         log_data = _get_log_details(conn, new_log_id)
+
+        # 他の端末へ更新を通知（差分）
+        announce_update('check_in', log_data, _get_presence(conn, [system_id]), version=version)
+
         # msg変数はif/elseブロック内で定義済み
         return jsonify({'status': 'success', 'message': msg, 'rank': final_rank, 'achievement': ach_result, 'log_data': log_data})
 
@@ -539,14 +781,16 @@ def check_out():
         log_suffix = " (オフライン同期)" if data.get('is_offline_sync') else ""
         app.logger.info(f"[操作ログ] 退室処理(手入力){log_suffix} - 生徒ID: {system_id}, 実行者IP: {request.remote_addr}")
 
+        version = database.record_change(conn, 'check_out', log_id_to_update, system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
 
         # `rank`キーに、最新のランク情報(final_rank)を渡す
         # 【修正】リスト更新用のログデータを返却に追加
         log_data = _get_log_details(conn, log_id_to_update)
+
+        # 他の端末へ更新を通知（差分）
+        announce_update('check_out', log_data, _get_presence(conn, [system_id]), version=version)
+
         return jsonify({'status': 'success', 'message': f'{student["name"]}さんが退室しました。', 'rank': final_rank, 'achievement': ach_result, 'log_data': log_data})
 
     except Exception as e:
@@ -647,10 +891,12 @@ def qr_process():
         target_log_id = new_log_id if not is_present_today else log_id_to_update
         log_data = _get_log_details(conn, target_log_id)
 
+        change_kind = 'check_out' if is_present_today else 'check_in'
+        version = database.record_change(conn, change_kind, target_log_id, system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
+
+        # 他の端末へ更新を通知（差分）
+        announce_update(change_kind, log_data, _get_presence(conn, [system_id]), version=version)
 
         return jsonify({'status': 'success', 'message': message, 'rank': final_rank, 'achievement': ach_result, 'log_data': log_data})
 
@@ -700,11 +946,13 @@ def exit_all():
         for student in present_students:
             _handle_notifications(conn, student['system_id'], 'check_out', student['current_log_id'])
 
+        versions = [database.record_change(conn, 'check_out', student['current_log_id'], student['system_id']) for student in present_students]
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
-        
+
+        # 他の端末へ更新を通知（生徒ごとの退室差分）
+        for student, version in zip(present_students, versions):
+            announce_update('check_out', _get_log_details(conn, student['current_log_id']), _get_presence(conn, [student['system_id']]), version=version)
+
         return jsonify({'status': 'success', 'message': f'{len(present_students)}名の生徒を全員退室させました。'})
     except Exception as e:
         conn.rollback()
@@ -713,26 +961,89 @@ def exit_all():
     finally:
         conn.close()
         
+# 【修正】集計レポートはバックグラウンドのジョブとして作成する（リクエスト内では作成しない）
+# 受付後すぐにジョブIDを返し、進捗は /api/reports/<id>、完了はSSE(report_job)で通知する
+report_job_manager = ReportJobManager(database.DB_PATH,
+                                      max_workers=int(os.getenv('REPORT_MAX_WORKERS', 1)),
+                                      max_queued=int(os.getenv('REPORT_MAX_QUEUED', 10)),
+                                      on_finished=announce_report_job).start()
+
 @app.route('/api/create_report', methods=['POST'])
+@app.route('/api/reports', methods=['POST'])
 def handle_create_report():
     data = request.json
     start_date, end_date = data.get('start_date'), data.get('end_date')
     if not start_date or not end_date: return jsonify({'status': 'error', 'message': '期間が指定されていません。'}), 400
+    try:
+        if datetime.datetime.strptime(start_date, '%Y-%m-%d') > datetime.datetime.strptime(end_date, '%Y-%m-%d'):
+            return jsonify({'status': 'error', 'message': '期間の開始日が終了日より後になっています。'}), 400
+    except ValueError:
+        return jsonify({'status': 'error', 'message': '期間の形式が正しくありません。'}), 400
+
+    try:
+        job = report_job_manager.submit(start_date, end_date, requested_by=request.remote_addr, force=bool(data.get('force')))
+    except ReportQueueFull:
+        return jsonify({'status': 'error', 'message': '作成待ちのレポートが多すぎます。しばらくしてから再度お試しください。'}), 429
+
+    # 【追加】作成済みのレポートを再利用した場合は、その場で完了として返す
+    if job['status'] == 'done':
+        app.logger.info(f"[操作ログ] 集計レポート作成受付(作成済みを再利用) - 期間: {start_date} ～ {end_date}, 実行者IP: {request.remote_addr}, ジョブID: {job['id']}")
+        return jsonify({'status': 'success', 'message': job['message'], 'job': job}), 200
 
     # [操作ログ] レポート作成開始
-    app.logger.info(f"[操作ログ] 集計レポート作成開始 - 期間: {start_date} ～ {end_date}, 実行者IP: {request.remote_addr}")
+    app.logger.info(f"[操作ログ] 集計レポート作成受付 - 期間: {start_date} ～ {end_date}, 実行者IP: {request.remote_addr}, ジョブID: {job['id']}")
+    return jsonify({'status': 'accepted', 'message': 'レポート作成を受け付けました。完了したらお知らせします。', 'job': job}), 202
 
-    file_path, message = create_report(database.DB_PATH, start_date, end_date)
-    if file_path:
-        if file_path == "No data": 
-            app.logger.info(f"[操作ログ] 集計レポート作成完了(データなし) - 期間: {start_date} ～ {end_date}")
-            return jsonify({'status': 'info', 'message': message})
-        
-        app.logger.info(f"[操作ログ] 集計レポート作成完了(成功) - 期間: {start_date} ～ {end_date}, 出力ファイル: {os.path.basename(file_path)}")
-        return jsonify({'status': 'success', 'message': message})
-    else:
-        app.logger.error(f"[操作ログ] 集計レポート作成失敗 - 期間: {start_date} ～ {end_date}, エラー: {message}")
-        return jsonify({'status': 'error', 'message': message}), 500
+# 【追加】集計レポートの一括作成（期間の一覧 × 学年・組の絞り込み）。1件のジョブとして作成し、結果はZIPファイルでダウンロードする
+REPORT_BATCH_MAX_ITEMS = int(os.getenv('REPORT_BATCH_MAX_ITEMS', 100))
+
+@app.route('/api/reports/batch', methods=['POST'])
+def handle_create_report_batch():
+    data = request.json or {}
+    try:
+        items = report_batch.expand_items(data.get('periods'), data.get('slices'), data.get('split'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if len(items) > REPORT_BATCH_MAX_ITEMS:
+        return jsonify({'status': 'error', 'message': f'一度に作成できるレポートは{REPORT_BATCH_MAX_ITEMS}件までです（指定: {len(items)}件）。'}), 400
+
+    try:
+        job = report_job_manager.submit_batch(items, requested_by=request.remote_addr)
+    except ReportQueueFull:
+        return jsonify({'status': 'error', 'message': '作成待ちのレポートが多すぎます。しばらくしてから再度お試しください。'}), 429
+
+    app.logger.info(f"[操作ログ] 集計レポート一括作成受付 - {len(items)}件, 期間: {job['start_date']} ～ {job['end_date']}, 実行者IP: {request.remote_addr}, ジョブID: {job['id']}")
+    return jsonify({'status': 'accepted', 'message': f'{len(items)}件のレポートの一括作成を受け付けました。完了したらお知らせします。', 'job': job}), 202
+
+@app.route('/api/reports', methods=['GET'])
+def list_report_jobs():
+    return jsonify({'jobs': report_jobs.list_jobs(report_job_manager.db_path)})
+
+@app.route('/api/reports/<job_id>', methods=['GET'])
+def get_report_job(job_id):
+    job = report_jobs.get_job(report_job_manager.db_path, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '指定されたレポート作成ジョブが見つかりません。'}), 404
+    return jsonify({'job': job})
+
+@app.route('/api/reports/<job_id>/cancel', methods=['POST'])
+def cancel_report_job(job_id):
+    job = report_jobs.get_job(report_job_manager.db_path, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '指定されたレポート作成ジョブが見つかりません。'}), 404
+    if job['status'] in report_jobs.FINISHED_STATUSES:
+        return jsonify({'status': 'error', 'message': 'このジョブは既に終了しています。', 'job': job}), 409
+    job = report_job_manager.cancel(job_id)
+    app.logger.info(f"[操作ログ] 集計レポート作成中止 - ジョブID: {job_id}, 実行者IP: {request.remote_addr}")
+    return jsonify({'status': 'success', 'message': 'レポート作成の中止を要求しました。', 'job': job})
+
+@app.route('/api/reports/<job_id>/download', methods=['GET'])
+def download_report(job_id):
+    job = report_jobs.get_job(report_job_manager.db_path, job_id)
+    if job is None or job['status'] != 'done' or not job['file_path'] or not os.path.exists(job['file_path']):
+        return jsonify({'status': 'error', 'message': 'ダウンロードできるレポートがありません。'}), 404
+    app.logger.info(f"[操作ログ] 集計レポートダウンロード - ジョブID: {job_id}, ファイル: {job['file_name']}, 実行者IP: {request.remote_addr}")
+    return send_file(job['file_path'], as_attachment=True, download_name=job['file_name'])
 
 # --- 設定管理用API ---
 @app.route('/api/settings', methods=['GET', 'POST'])
@@ -804,34 +1115,115 @@ def convert_to_utc(time_str):
             continue
     return None
 
-@app.route('/api/logs', methods=['GET'])
-def get_logs():
-    # print(f"[デバッグ] /api/logs が呼び出されました。")
-    # print(f"[デバッグ] 受け取った全パラメータ: {request.args}")
-    log_id = request.args.get('id')
-    if log_id:
-        conn = get_db_connection()
-        log = conn.execute('SELECT al.*, s.grade, s.class, s.student_number, s.name FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id WHERE al.id = ?', (log_id,)).fetchone()
+# 【追加】生徒一覧API（記録編集画面の選択肢・絞り込み用）
+# 名簿は起動時のExcel同期でしか変わらないため、名簿バージョンをETagにして再検証のみで済ませる
+# 【追加】q を指定した場合は氏名で絞り込む（表記ゆれを吸収した部分一致）
+@app.route('/api/students', methods=['GET'])
+def get_students():
+    name_query = (request.args.get('q') or '').strip()
+    etag = f"students-{roster_version}"
+    if not name_query and request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+    conn = get_db_connection()
+    try:
+        query = 'SELECT system_id, name, grade, class, student_number FROM students s'
+        if name_query:
+            name_condition, name_params = database.name_search_condition(conn, name_query)
+            if name_condition is None:
+                return jsonify({'students': [], 'roster_version': roster_version})
+            students = [dict(row) for row in conn.execute(f"{query} WHERE {name_condition} ORDER BY grade, class, student_number", name_params)]
+            return jsonify({'students': students, 'roster_version': roster_version})
+        students = [dict(row) for row in conn.execute(query)]
+        return _with_etag(jsonify({'students': students, 'roster_version': roster_version}), etag)
+    except Exception as e:
+        app.logger.error(f"Error in get_students: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'生徒一覧の取得中にエラーが発生しました: {e}'}), 500
+    finally:
         conn.close()
-        return jsonify({'logs': [dict(log)] if log else []})
 
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 100))
-    sort_by = request.args.get('sort', 'id')
-    sort_dir = request.args.get('dir', 'desc')
-    
+# 【追加】記録一覧のキーセット方式ページ送り用の並び替えキー
+# 並び替えの列とログID（同値の行を区別する）の2つ。ORDER BY も比較も列をそのまま使い、列のインデックスで読み進める
+# (idx_entry_time のインデックスは末尾に rowid = ログIDを含むため、入室時刻順はそのまま (entry_time, id) の順で読める)
+_LOG_SORT_COLUMNS = {
+    'id': 'al.id', 'entry_time': 'al.entry_time', 'exit_time': 'al.exit_time', 'seat_number': 'al.seat_number',
+    'grade': 's.grade', 'class': 's.class', 'student_number': 's.student_number', 'name': 's.name',
+}
+# NULLにならない列（入室時刻は記録の作成時に必ず入る）
+_LOG_NOT_NULL_SORT_COLUMNS = {'id', 'entry_time'}
+
+def _log_sort_keys(sort_by):
+    if sort_by == 'id':
+        return ['al.id']
+    return [_LOG_SORT_COLUMNS[sort_by], 'al.id']
+
+def _log_page_segments(sort_by, sort_dir, cursor_values):
+    """
+    【修正】カーソル以降の行を取得する条件を、並び順に読む区間 [(条件の一覧, パラメータ), ...] で返す。
+    NULLを含みうる列は「NULLでない行」と「NULLの行」を別の区間にし、各区間を範囲条件 (col <= ? など) で取得する
+    (SQLiteの並び順と同じく、昇順ではNULLの行が先、降順では後)。
+    """
+    column = _LOG_SORT_COLUMNS[sort_by]
+    desc = sort_dir == 'desc'
+    comparison, comparison_or_equal = ('<', '<=') if desc else ('>', '>=')
+    if sort_by == 'id':
+        return [([f"al.id {comparison} ?"], list(cursor_values))] if cursor_values else [([], [])]
+    nullable = sort_by not in _LOG_NOT_NULL_SORT_COLUMNS
+    if cursor_values is None:
+        if not nullable:
+            return [([], [])]
+        segments = [([f"{column} IS NOT NULL"], []), ([f"{column} IS NULL"], [])]
+        return segments if desc else segments[::-1]
+
+    value, last_id = cursor_values
+    if value is None:
+        # NULLの行の途中から（昇順ではこの後にNULLでない行が続く）
+        segments = [([f"{column} IS NULL", f"al.id {comparison} ?"], [last_id])]
+        if not desc:
+            segments.append(([f"{column} IS NOT NULL"], []))
+        return segments
+    segments = [([f"{column} {comparison_or_equal} ?", f"({column} {comparison} ? OR al.id {comparison} ?)"],
+                 [value, value, last_id])]
+    if desc and nullable:
+        segments.append(([f"{column} IS NULL"], []))
+    return segments
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor, key_count):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) and len(values) == key_count else None
+
+# 【追加】絞り込み条件ごとの件数キャッシュ（ページ送りのたびに COUNT を実行しないため）
+# キーにデータバージョンと名簿バージョンを含めるため、記録が変わると自然に古い件数は使われなくなる
+_log_count_cache = OrderedDict()
+_log_count_cache_lock = threading.Lock()
+LOG_COUNT_CACHE_SIZE = 128
+
+def _cached_log_count(conn, where_clause, params):
+    key = (where_clause, tuple(params), roster_version, sse_hub.current_version())
+    with _log_count_cache_lock:
+        if key in _log_count_cache:
+            _log_count_cache.move_to_end(key)
+            return _log_count_cache[key]
+    total = conn.execute(f"SELECT COUNT(al.id) FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id{where_clause}", params).fetchone()[0]
+    with _log_count_cache_lock:
+        _log_count_cache[key] = total
+        while len(_log_count_cache) > LOG_COUNT_CACHE_SIZE:
+            _log_count_cache.popitem(last=False)
+    return total
+
+# 【追加】記録一覧・エクスポート共通の絞り込み条件の組み立て
+def _build_log_filters(conn, args):
+    """リクエストの絞り込みパラメータから、WHERE句の条件一覧とパラメータを返す。"""
     filters = {
-        'start': request.args.get('start'), 'end': request.args.get('end'),
-        'name': request.args.get('name'), 'grade': request.args.get('grade'),
-        'class': request.args.get('class'), 'number': request.args.get('number'),
+        'start': args.get('start'), 'end': args.get('end'),
+        'name': args.get('name'), 'grade': args.get('grade'),
+        'class': args.get('class'), 'number': args.get('number'),
     }
-    # print(f"[デバッグ] 抽出したフィルター値: {filters}") 
-    conn = get_db_connection()
-    all_students_cursor = conn.execute('SELECT system_id, name, grade, class, student_number FROM students')
-    all_students = [dict(row) for row in all_students_cursor.fetchall()]
-
-    query = "SELECT al.id, al.system_id, al.entry_time, al.exit_time, s.name, s.grade, s.class, s.student_number FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id"
-    count_query = "SELECT COUNT(al.id) FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id"
     conditions, params = [], []
 
     if filters['start']:
@@ -868,7 +1260,10 @@ def get_logs():
             # 予期せぬエラー発生時のログ出力
             app.logger.error(f"【予期せぬエラー】終了日の処理中に問題が発生しました。入力値: '{end_raw}', エラー: {e}\n{traceback.format_exc()}")
     if filters['name']:
-        conditions.append("s.name LIKE ?"); params.append(f"%{filters['name']}%")
+        # 【修正】氏名は表記ゆれを正規化した全文検索インデックスで絞り込む（LIKE '%...%' の全件走査をしない）
+        name_condition, name_params = database.name_search_condition(conn, filters['name'])
+        if name_condition:
+            conditions.append(name_condition); params.extend(name_params)
     if filters['grade']:
         conditions.append("s.grade = ?"); params.append(filters['grade'])
     if filters['class']:
@@ -876,29 +1271,137 @@ def get_logs():
     if filters['number']:
         conditions.append("s.student_number = ?"); params.append(filters['number'])
 
-    if conditions:
-        where_clause = " WHERE " + " AND ".join(conditions)
-        query += where_clause
-        count_query += where_clause
-        # print(f"[デバッグ] SQL条件: {where_clause}") # デバッグ出力追加
-        # print(f"[デバッグ] SQLパラメータ: {params}") # デバッグ出力追加
-
-    total = conn.execute(count_query, params).fetchone()[0]
-    
-    valid_sort_columns = ['id', 'entry_time', 'grade', 'class', 'student_number', 'name', 'exit_time', 'seat_number']
-    if sort_by in valid_sort_columns and sort_dir in ['asc', 'desc']:
-        sort_column = f"s.{sort_by}" if sort_by in ['grade', 'class', 'student_number', 'name'] else f"al.{sort_by}"
-        query += f" ORDER BY {sort_column} {sort_dir.upper()}"
+    return conditions, params
 
-    offset = (page - 1) * per_page
-    query += f" LIMIT {per_page} OFFSET {offset}"
+@app.route('/api/logs', methods=['GET'])
+def get_logs():
+    # print(f"[デバッグ] /api/logs が呼び出されました。")
+    # print(f"[デバッグ] 受け取った全パラメータ: {request.args}")
+    log_id = request.args.get('id')
+    if log_id:
+        conn = get_db_connection()
+        log = conn.execute('SELECT al.*, s.grade, s.class, s.student_number, s.name FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id WHERE al.id = ?', (log_id,)).fetchone()
+        conn.close()
+        return jsonify({'logs': [dict(log)] if log else []})
 
-    # クエリに al.seat_number を追加
-    query = query.replace("al.entry_time, al.exit_time", "al.entry_time, al.exit_time, al.seat_number")
-    logs = [dict(row) for row in conn.execute(query, params).fetchall()]
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', 100))
+    sort_by = request.args.get('sort', 'id')
+    sort_dir = request.args.get('dir', 'desc')
+    # 【追加】前のページの最後の行を表すカーソル（指定時は OFFSET を使わずに続きから取得する）
+    cursor = request.args.get('cursor')
+    if sort_by not in _LOG_SORT_COLUMNS or sort_dir not in ['asc', 'desc']:
+        sort_by, sort_dir = 'id', 'desc'
+    
+    conn = get_db_connection()
+    # 【修正】生徒一覧は /api/students で別に取得するため、ここでは返さない（名簿バージョンのみ返す）
+    conditions, params = _build_log_filters(conn, request.args)
+
+    sort_keys = _log_sort_keys(sort_by)
+    key_columns = ''.join(f", {key} AS _k{i}" for i, key in enumerate(sort_keys))
+    query = f"SELECT al.id, al.system_id, al.entry_time, al.exit_time, al.seat_number, s.name, s.grade, s.class, s.student_number{key_columns} FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id"
+    where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+    # print(f"[デバッグ] SQL条件: {where_clause}") # デバッグ出力追加
+    # print(f"[デバッグ] SQLパラメータ: {params}") # デバッグ出力追加
+
+    # 【修正】件数は絞り込み条件とデータバージョンが同じ間はキャッシュを使う
+    total = _cached_log_count(conn, where_clause, params)
+
+    order_by = " ORDER BY " + ", ".join(f"{key} {sort_dir.upper()}" for key in sort_keys)
+    cursor_values = _decode_cursor(cursor, len(sort_keys)) if cursor else None
+    rows = []
+    if cursor_values is None and page > 1:
+        # カーソルなしでページ番号が指定された場合は従来通り OFFSET で取得する（互換用）
+        # 次のページの有無を判定するため1件多く取得する
+        rows = conn.execute(f"{query}{where_clause}{order_by} LIMIT {per_page + 1} OFFSET {(page - 1) * per_page}", params).fetchall()
+    else:
+        # 【修正】カーソルがある場合は、前のページの最後の行より後ろだけを取得する（深いページでも速度が落ちない）
+        for segment_conditions, segment_params in _log_page_segments(sort_by, sort_dir, cursor_values):
+            page_conditions = conditions + segment_conditions
+            page_where = " WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+            rows += conn.execute(f"{query}{page_where}{order_by} LIMIT {per_page + 1 - len(rows)}",
+                                 params + segment_params).fetchall()
+            if len(rows) > per_page:
+                break
     conn.close()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    logs = []
+    for row in rows:
+        log = dict(row)
+        for i in range(len(sort_keys)):
+            log.pop(f'_k{i}')
+        logs.append(log)
+    next_cursor = _encode_cursor([rows[-1][f'_k{i}'] for i in range(len(sort_keys))]) if has_more and rows else None
     
-    return jsonify({'logs': logs, 'total': total, 'students': all_students})
+    return jsonify({'logs': logs, 'total': total, 'next_cursor': next_cursor, 'roster_version': roster_version})
+
+# 【追加】記録の生データ出力API（監査用）。/api/logs と同じ絞り込み条件で CSV または NDJSON を逐次送信する
+# 件数が多くてもメモリに溜めないよう、ID順に一定件数ずつ読み出しては書き出す。
+# 1回の読み出しごとにクエリを終えるため、出力中も入退室の書き込みを長時間待たせない。
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+_EXPORT_COLUMNS = ['id', 'system_id', 'grade', 'class', 'student_number', 'name', 'seat_number', 'entry_time', 'exit_time']
+
+def _stream_log_export(conn, conditions, params, export_format):
+    query = ("SELECT al.id, al.system_id, s.grade, s.class, s.student_number, s.name, al.seat_number, al.entry_time, al.exit_time "
+             "FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id WHERE "
+             + " AND ".join(conditions + ['al.id > ?']) + f" ORDER BY al.id LIMIT {EXPORT_CHUNK_SIZE}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take_buffer():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return text
+
+    exported = 0
+    try:
+        if export_format == 'csv':
+            # Excelで開いても文字化けしないよう BOM を付ける
+            writer.writerow(_EXPORT_COLUMNS)
+            yield '\ufeff' + take_buffer()
+        last_id = 0
+        while True:
+            cursor = conn.execute(query, params + [last_id])
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            cursor.close()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            if export_format == 'csv':
+                writer.writerows(rows)
+                yield take_buffer()
+            else:
+                yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+            exported += len(rows)
+            if len(rows) < EXPORT_CHUNK_SIZE:
+                break
+    finally:
+        conn.close()
+        app.logger.info(f"[操作ログ] 記録の出力を終了しました: {exported} 件")
+
+@app.route('/api/logs/export', methods=['GET'])
+def export_logs():
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'status': 'error', 'message': 'format には csv または ndjson を指定してください。'}), 400
+    conn = get_db_connection()
+    try:
+        conditions, params = _build_log_filters(conn, request.args)
+    except Exception as e:
+        conn.close()
+        app.logger.error(f"Error in export_logs: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'出力条件の処理中にエラーが発生しました: {e}'}), 500
+
+    # [監査ログ] 記録の出力
+    app.logger.info(f"[監査ログ] 記録出力 - 実行者IP: {request.remote_addr}, 形式: {export_format}, 条件: {request.args.to_dict()}")
+    filename = f"attendance_logs_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(_stream_log_export(conn, conditions, params, export_format), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/logs', methods=['POST'])
 def add_log():
@@ -920,10 +1423,11 @@ def add_log():
             # 該当生徒のステータスを「在室中」に更新する
             conn.execute('UPDATE students SET is_present = 1, current_log_id = ? WHERE system_id = ?', (new_log_id, system_id))
         
+        version = database.record_change(conn, 'log_edit', new_log_id, system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
+
+        # 他の端末へ更新を通知（手動追加も編集と同じ差分として扱う）
+        announce_update('log_edit', _get_log_details(conn, new_log_id), _get_presence(conn, [system_id]), version=version)
 
         return jsonify({'status': 'success', 'message': '記録が正常に追加されました。'})
     except Exception as e:
@@ -939,6 +1443,10 @@ def update_log(log_id):
     entry_time_utc, exit_time_utc = convert_to_utc(entry_time), convert_to_utc(exit_time)
     conn = get_db_connection()
     try:
+        # 差分通知用に、変更前の担当生徒を控えておく
+        old_row = conn.execute('SELECT system_id FROM attendance_logs WHERE id = ?', (log_id,)).fetchone()
+        old_system_id = old_row['system_id'] if old_row else None
+
         # --- 1. 既存のステータスを安全にリセット ---
         # このログIDが、いずれかの生徒の「現在の入室記録」として設定されている場合、
         # その生徒のステータスを一旦「退室済み」にリセットする。
@@ -960,10 +1468,11 @@ def update_log(log_id):
             # 新しい担当生徒のステータスを「在室中」に更新する
             conn.execute('UPDATE students SET is_present = 1, current_log_id = ? WHERE system_id = ?', (log_id, system_id))
         
+        version = database.record_change(conn, 'log_edit', log_id, system_id, old_system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
+
+        # 他の端末へ更新を通知（差分）
+        announce_update('log_edit', _get_log_details(conn, log_id), _get_presence(conn, [old_system_id, system_id]), version=version)
 
         return jsonify({'status': 'success', 'message': f'ID: {log_id} の記録が正常に更新されました。'})
     except Exception as e:
@@ -978,12 +1487,17 @@ def delete_log(log_id):
         # [監査ログ] 記録の削除（削除実行前に記録）
         app.logger.info(f"[監査ログ] 記録削除 - 実行者IP: {request.remote_addr}, 対象ログID: {log_id}")
 
+        # 差分通知用に、削除前の担当生徒を控えておく
+        old_row = conn.execute('SELECT system_id FROM attendance_logs WHERE id = ?', (log_id,)).fetchone()
+        old_system_id = old_row['system_id'] if old_row else None
+
         conn.execute('UPDATE students SET is_present = 0, current_log_id = NULL WHERE current_log_id = ?', (log_id,))
         conn.execute('DELETE FROM attendance_logs WHERE id = ?', (log_id,))
+        version = database.record_change(conn, 'log_delete', log_id, old_system_id)
         conn.commit()
-        
-        # 他の端末へ更新を通知
-        announce_update()
+
+        # 他の端末へ更新を通知（差分）
+        announce_update('log_delete', {'log_id': log_id, 'system_id': old_system_id}, _get_presence(conn, [old_system_id]), version=version)
 
         return jsonify({'status': 'success', 'message': f'ID: {log_id} の記録が正常に削除されました。'})
     except Exception as e:
@@ -991,46 +1505,202 @@ def delete_log(log_id):
     finally:
         conn.close()
 
+# 【追加】記録の一括追加・編集・削除API（端末故障後の後片付けなどで、1件ずつ送らずに済ませる）
+# 全ての操作を1つのトランザクションで適用し、在室状態は最後に対象の生徒ごとにまとめて整合させる。
+# 1件でも失敗した場合は全体を取り消す。他の端末への通知も1回にまとめる。
+BULK_MAX_OPERATIONS = int(os.getenv('BULK_MAX_OPERATIONS', 500))
+
+def _parse_bulk_operation(index, op):
+    """一括操作の1件を検証し、(正規化した操作, エラーメッセージ) を返す。"""
+    if not isinstance(op, dict):
+        return None, f'{index + 1}件目: 操作の形式が正しくありません。'
+    action = op.get('op')
+    if action not in ('create', 'update', 'delete'):
+        return None, f'{index + 1}件目: op には create / update / delete のいずれかを指定してください。'
+    parsed = {'op': action}
+    if action in ('update', 'delete'):
+        try:
+            parsed['id'] = int(op.get('id'))
+        except (TypeError, ValueError):
+            return None, f'{index + 1}件目: 対象の記録ID(id)が正しくありません。'
+    if action in ('create', 'update'):
+        system_id, entry_time = op.get('system_id'), op.get('entry_time')
+        if not system_id or not entry_time:
+            return None, f'{index + 1}件目: 生徒IDと入室時刻は必須です。'
+        entry_time_utc, exit_time_utc = convert_to_utc(entry_time), convert_to_utc(op.get('exit_time'))
+        if entry_time_utc is None or (op.get('exit_time') and exit_time_utc is None):
+            return None, f'{index + 1}件目: 時刻の形式が正しくありません。'
+        parsed.update(system_id=system_id, entry_time=entry_time_utc, exit_time=exit_time_utc, seat_number=op.get('seat_number'))
+    return parsed, None
+
+def _reconcile_presence(conn, system_ids):
+    """
+    生徒の在室状態を記録から決め直す。
+    今日入室して未退室の記録があれば在室とし、その中で最も新しい記録を現在の入室記録にする。
+    """
+    today = datetime.datetime.now(JST).date()
+    day_start = JST.localize(datetime.datetime.combine(today, datetime.time.min)).astimezone(UTC).isoformat()
+    next_day_start = JST.localize(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min)).astimezone(UTC).isoformat()
+    for system_id in dict.fromkeys(system_ids):
+        if system_id is None:
+            continue
+        row = conn.execute('''
+            SELECT id FROM attendance_logs
+            WHERE system_id = ? AND exit_time IS NULL AND entry_time >= ? AND entry_time < ?
+            ORDER BY entry_time DESC, id DESC LIMIT 1
+        ''', (system_id, day_start, next_day_start)).fetchone()
+        if row:
+            conn.execute('UPDATE students SET is_present = 1, current_log_id = ? WHERE system_id = ?', (row['id'], system_id))
+        else:
+            conn.execute('UPDATE students SET is_present = 0, current_log_id = NULL WHERE system_id = ?', (system_id,))
+
+@app.route('/api/logs/bulk', methods=['POST'])
+def bulk_update_logs():
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'status': 'error', 'message': '操作の一覧(operations)を指定してください。'}), 400
+    if len(operations) > BULK_MAX_OPERATIONS:
+        return jsonify({'status': 'error', 'message': f'一度に実行できる操作は {BULK_MAX_OPERATIONS} 件までです。'}), 400
+
+    parsed_operations = []
+    for index, op in enumerate(operations):
+        parsed, error = _parse_bulk_operation(index, op)
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
+        parsed_operations.append(parsed)
+
+    conn = get_db_connection()
+    try:
+        applied = []  # (種類, ログID, 関係する生徒ID一覧, バージョン)
+        affected_students = []
+        for index, op in enumerate(parsed_operations):
+            if op['op'] == 'create':
+                cursor = conn.execute('INSERT INTO attendance_logs (system_id, entry_time, exit_time, seat_number) VALUES (?, ?, ?, ?)',
+                                      (op['system_id'], op['entry_time'], op['exit_time'], op['seat_number']))
+                log_id = cursor.lastrowid
+                app.logger.info(f"[監査ログ] 記録追加(一括) - 実行者IP: {request.remote_addr}, 新規ID: {log_id}, 対象生徒ID: {op['system_id']}, 入室: {op['entry_time']}, 退室: {op['exit_time']}, 座席: {op['seat_number']}")
+                version = database.record_change(conn, 'log_edit', log_id, op['system_id'])
+                applied.append(('log_edit', log_id, [op['system_id']], version))
+                affected_students.append(op['system_id'])
+                continue
+
+            log_id = op['id']
+            old_row = conn.execute('SELECT system_id FROM attendance_logs WHERE id = ?', (log_id,)).fetchone()
+            if old_row is None:
+                conn.rollback()
+                return jsonify({'status': 'error', 'message': f'{index + 1}件目: ID: {log_id} の記録が見つかりません。全ての操作を取り消しました。'}), 404
+            old_system_id = old_row['system_id']
+            # 現在の入室記録として参照している生徒がいれば、最後の整合処理で決め直す
+            affected_students.extend(r['system_id'] for r in conn.execute('SELECT system_id FROM students WHERE current_log_id = ?', (log_id,)))
+            affected_students.append(old_system_id)
+
+            if op['op'] == 'update':
+                conn.execute('UPDATE attendance_logs SET system_id = ?, entry_time = ?, exit_time = ?, seat_number = ? WHERE id = ?',
+                             (op['system_id'], op['entry_time'], op['exit_time'], op['seat_number'], log_id))
+                app.logger.info(f"[監査ログ] 記録編集(一括) - 実行者IP: {request.remote_addr}, 対象ログID: {log_id}, 変更内容: [生徒ID: {op['system_id']}, 入室: {op['entry_time']}, 退室: {op['exit_time']}, 座席: {op['seat_number']}]")
+                version = database.record_change(conn, 'log_edit', log_id, op['system_id'], old_system_id)
+                applied.append(('log_edit', log_id, [old_system_id, op['system_id']], version))
+                affected_students.append(op['system_id'])
+            else:
+                conn.execute('DELETE FROM attendance_logs WHERE id = ?', (log_id,))
+                app.logger.info(f"[監査ログ] 記録削除(一括) - 実行者IP: {request.remote_addr}, 対象ログID: {log_id}")
+                version = database.record_change(conn, 'log_delete', log_id, old_system_id)
+                applied.append(('log_delete', log_id, [old_system_id], version))
+
+        _reconcile_presence(conn, affected_students)
+        conn.commit()
+
+        # 他の端末へ更新を通知（操作ごとの差分を1回の配信にまとめる）
+        # 同じ一括操作の中で後から削除された記録は、削除として通知する
+        presence = {p['system_id']: p for p in _get_presence(conn, affected_students)}
+        deltas = []
+        for kind, log_id, system_ids, version in applied:
+            students = [presence[sid] for sid in dict.fromkeys(system_ids) if sid in presence]
+            log = _get_log_details(conn, log_id) if kind == 'log_edit' else None
+            if log is None:
+                deltas.append(('log_delete', {'log_id': log_id, 'system_id': system_ids[0]}, students, version))
+            else:
+                deltas.append((kind, log, students, version))
+        announce_updates(deltas)
+
+        app.logger.info(f"[操作ログ] 記録の一括操作 - 実行者IP: {request.remote_addr}, 件数: {len(applied)}")
+        return jsonify({
+            'status': 'success',
+            'message': f'{len(applied)} 件の操作を適用しました。',
+            'results': [{'op': op['op'], 'id': log_id} for op, (_, log_id, _, _) in zip(parsed_operations, applied)],
+            'version': applied[-1][3],
+        })
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"Error in bulk_update_logs: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'データベースエラー: {e}'}), 500
+    finally:
+        conn.close()
+
+# 【追加】前回取得したバージョン以降の変更だけを返すAPI（スリープ復帰・通信断からの再開用）
+# 同じ記録・生徒への複数の変更は最新の状態1件にまとめて返す
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    since = request.args.get('since', type=int)
+    conn = get_db_connection()
+    try:
+        oldest = conn.execute('SELECT MIN(version) FROM attendance_changes').fetchone()[0]
+        latest = database.get_change_version(conn)
+        # 変更履歴が圧縮済みで、指定のバージョンからは辿れない場合は全件取得を促す
+        if since is None or since > latest or (since < latest and (oldest is None or oldest > since + 1)):
+            return jsonify({'reset': True, 'version': latest})
+
+        changes = conn.execute('SELECT version, log_id, system_id, prev_system_id FROM attendance_changes WHERE version > ? ORDER BY version', (since,)).fetchall()
+        log_ids = list(dict.fromkeys(c['log_id'] for c in changes if c['log_id'] is not None))
+        system_ids = [sid for c in changes for sid in (c['system_id'], c['prev_system_id'])]
+
+        logs, deleted_log_ids = [], []
+        for log_id in log_ids:
+            log = _get_log_details(conn, log_id)
+            if log:
+                logs.append(log)
+            else:
+                deleted_log_ids.append(log_id)
+
+        return jsonify({
+            'reset': False,
+            'version': changes[-1]['version'] if changes else since,
+            'logs': logs,
+            'deleted_log_ids': deleted_log_ids,
+            'students': _get_presence(conn, system_ids),
+        })
+    except Exception as e:
+        app.logger.error(f"Error in get_changes: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'変更履歴の取得中にエラーが発生しました: {e}'}), 500
+    finally:
+        conn.close()
+
 # --- SSE用エンドポイント ---
 @app.route('/api/stream')
 def stream():
     # クライアント情報の取得
     client_ip = request.remote_addr
     client_id = request.args.get('client_id', 'unknown')
-    user_agent = request.headers.get('User-Agent', 'unknown')
-
-    def event_stream():
-        q = queue.Queue()
-        sse_clients.append(q)
-        
-        # 接続ログ
-        app.logger.info(f"[通信ログ] クライアント接続 - IP: {client_ip}, ID: {client_id}")
-
-        try:
-            while True:
-                # キューからメッセージを取得（タイムアウト付きでブロッキング）
-                # タイムアウトを設定することで、切断検知や定期的なKeep-Aliveが可能
-                try:
-                    # 【修正】タイムアウトを20秒→1.0秒に短縮
-                    # これにより、クライアント切断時にスレッドが最大20秒間拘束される「ゾンビ化」を防ぎ、
-                    # 素早く(最大1秒で)切断を検知してスレッドを解放できるようにする。
-                    msg = q.get(timeout=1.0)
-                    yield f"data: {msg}\n\n"
-                except queue.Empty:
-                    # タイムアウト時はコメント行を送って接続維持
-                    yield ": keep-alive\n\n"
-        except GeneratorExit:
-            # クライアント切断時（タブを閉じる、リロードなど）
-            # 切断ログはノイズになるため出力しない
-            if q in sse_clients:
-                sse_clients.remove(q)
-        except Exception as e:
-            # その他のエラー切断
-            app.logger.error(f"[通信ログ] クライアント通信エラー - IP: {client_ip}, ID: {client_id}, Error: {e}")
-            if q in sse_clients:
-                sse_clients.remove(q)
-
-    return Response(event_stream(), mimetype='text/event-stream')
+    # 【追加】再接続時はブラウザが Last-Event-ID ヘッダーを付与するので、取りこぼし分だけ再送する
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    sub = sse_hub.subscribe(client_id=client_id, remote_addr=client_ip, last_event_id=last_event_id)
+    # 接続ログ
+    app.logger.info(f"[通信ログ] クライアント接続 - IP: {client_ip}, ID: {client_id}, 接続数: {sse_hub.subscriber_count()}")
+
+    # 待機はハブ側で Condition により行うため、データがない間はハートビート間隔までスレッドが起きない
+    # 切断時（タブを閉じる、リロードなど）はジェネレーター終了時にハブから自動で登録解除される
+    return Response(sse_hub.stream(sub), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# 【追加】SSEの接続数・配信時間の確認用API
+@app.route('/api/stream/stats')
+def stream_stats():
+    stats = {**sse_hub.stats(), **sse_publisher.stats(), **report_job_manager.stats()}
+    if async_sse_server:
+        stats.update(async_sse_server.stats())
+    return jsonify(stats)
 
 # --- メール再送トリガー用API ---
 @app.route('/api/trigger_email_retry', methods=['POST'])
@@ -1047,33 +1717,99 @@ def trigger_email_retry():
 
 # --- 定期実行タスクの設定 ---
 scheduler = BackgroundScheduler()
-# 5分ごとに保留中のメール再送を試みる
-scheduler.add_job(retry_queued_emails, 'interval', minutes=5)
+# 【修正】複数のワーカープロセスで起動しても定期ジョブが1回だけ実行されるよう、
+# ファイルロックを取得できたプロセス(リーダー)だけが定期ジョブを登録する。
+# スケジューラ自体は全プロセスで起動する（手動トリガーの即時実行ジョブ用）。
+scheduler_leader = LeaderLock(os.path.join(os.path.dirname(database.DB_PATH), 'scheduler.lock'))
+
+def compact_change_log():
+    """変更履歴を直近の一定件数(CHANGE_LOG_RETENTION)だけ残して削除する。"""
+    conn = get_db_connection()
+    try:
+        deleted = database.compact_changes(conn, keep=int(os.getenv('CHANGE_LOG_RETENTION', 5000)))
+        if deleted:
+            app.logger.info(f"[システムログ] 変更履歴を {deleted} 件削除しました。")
+    finally:
+        conn.close()
+
+def refresh_report_rollups():
+    """集計レポート用の集計済みテーブルを最新にする（夜間にまとめて作り直し、レポート作成時の更新を少なくする）。"""
+    conn = sqlite3.connect(database.DB_PATH, timeout=30)
+    try:
+        report_rollups.refresh_all_rollups(conn)
+    except Exception as e:
+        app.logger.error(f"[システムログ] レポート用の集計の更新に失敗しました: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+def export_attendance_archive():
+    """入退室記録を列指向アーカイブ(Parquet)に書き出す（前日までの記録のうち、前回以降の追加・変更分）。"""
+    try:
+        count = attendance_archive.export_archive(database.DB_PATH)
+        app.logger.info(f"[システムログ] 入退室記録のアーカイブに {count} 件を書き出しました。")
+    except attendance_archive.ArchiveUnavailable as e:
+        app.logger.warning(f"[システムログ] {e}")
+    except Exception as e:
+        app.logger.error(f"[システムログ] 入退室記録のアーカイブの書き出しに失敗しました: {e}", exc_info=True)
+
+def _add_periodic_jobs():
+    # 5分ごとに保留中のメール再送を試みる
+    scheduler.add_job(retry_queued_emails, 'interval', minutes=5, id='retry_queued_emails')
+    # 【追加】1時間ごとに変更履歴を圧縮する
+    scheduler.add_job(compact_change_log, 'interval', hours=1, id='compact_change_log')
+    # 【追加】毎日深夜にレポート用の集計を更新する
+    scheduler.add_job(refresh_report_rollups, 'cron', hour=int(os.getenv('REPORT_ROLLUP_HOUR', 3)), id='refresh_report_rollups')
+    # 【追加】毎日深夜に入退室記録を列指向アーカイブに書き出す（pyarrow が必要なため、環境変数で有効にした場合のみ）
+    if os.getenv('ATTENDANCE_ARCHIVE_ENABLED', 'false').lower() == 'true':
+        scheduler.add_job(export_attendance_archive, 'cron', hour=int(os.getenv('ATTENDANCE_ARCHIVE_HOUR', 4)), id='export_attendance_archive')
+
+def _try_become_scheduler_leader():
+    """リーダーになれた場合のみ定期ジョブを登録する。リーダーが停止した場合はここで引き継ぐ。"""
+    if scheduler_leader.try_acquire():
+        _add_periodic_jobs()
+        if scheduler.get_job('leader_election'):
+            scheduler.remove_job('leader_election')
+        app.logger.info(f"[システムログ] 定期ジョブの実行担当になりました (PID: {os.getpid()})")
+        return True
+    return False
+
 scheduler.start()
+if not _try_become_scheduler_leader():
+    scheduler.add_job(_try_become_scheduler_leader, 'interval', seconds=30, id='leader_election')
+
+# 【修正】非同期SSEサーバーはモジュールの初期化時に起動する（WSGIサーバーや自動リロードなしの実行でも起動するように）
+if not _is_reloader_parent():
+    start_async_sse_server(_ssl_files())
 
 # アプリ終了時の処理
 def on_server_shutdown():
     app.logger.info("[システムログ] サーバーが停止しました (オフライン)")
+    sse_publisher.flush()
+    sse_hub.close_all()
+    if async_sse_server:
+        async_sse_server.stop()
+    if event_bus:
+        event_bus.stop()
+    report_job_manager.stop()
     if scheduler.running:
         scheduler.shutdown()
+    scheduler_leader.release()
 
 atexit.register(on_server_shutdown)
 
 # --- サーバーの起動 ---
 if __name__ == '__main__':
-    # 証明書ファイルのパスを定義
-    # 【修正】読み込む証明書名を cert.crt に変更
-    cert_path = os.path.join(os.path.dirname(__file__), '..', 'certs', 'cert.crt')
-    key_path = os.path.join(os.path.dirname(__file__), '..', 'certs', 'key.pem')
-
+    # 証明書ファイルのパスは CERT_PATH / KEY_PATH（【修正】読み込む証明書名を cert.crt に変更）
     # 証明書と秘密鍵の両方が存在するかチェック
-    if os.path.exists(cert_path) and os.path.exists(key_path):
+    ssl_paths = _ssl_files()
+
+    if ssl_paths:
         print("SSL証明書を検出しました。HTTPSでサーバーを起動します。")
         app.logger.info("[システムログ] サーバーが起動しました (HTTPS)")
         # HTTPSで起動
-        app.run(host='0.0.0.0', port=8080, debug=True, ssl_context=(cert_path, key_path))
+        app.run(host='0.0.0.0', port=8080, debug=True, use_reloader=USE_RELOADER, ssl_context=ssl_paths)
     else:
         print("SSL証明書が見つかりません。HTTPでサーバーを起動します。")
         app.logger.info("[システムログ] サーバーが起動しました (HTTP)")
         # 通常のHTTPで起動
-        app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+        app.run(host='0.0.0.0', port=8080, debug=True, use_reloader=USE_RELOADER)
\ No newline at end of file
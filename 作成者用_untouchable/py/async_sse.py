@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncClient:
+    """非同期SSEサーバー上の1接続。"""
+    def __init__(self, max_pending):
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.closed = False
+
+
+class AsyncSSEServer:
+    """
+    全てのSSE接続を1つの asyncio イベントループで保持する軽量サーバー。
+    Flask(WSGI)側のスレッドを1接続ごとに占有しないため、待機中の接続が何千あってもほぼ負荷がかからない。
+
+    イベントは同一プロセス内の BroadcastHub からリスナー経由で受け取る（プロセス内チャンネル）。
+    別ポートで待ち受けるため、ブラウザからはクロスオリジンの EventSource として接続される。
+    【追加】add_hub で、パスごとに別のハブ（質問受付の通知など）を同じポートで配信できる。
+    """
+    def __init__(self, hub, host='0.0.0.0', port=8081, ssl_context=None, path='/api/stream',
+                 allow_origin='*', max_pending=100):
+        self.hub = hub
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.path = path
+        self.allow_origin = allow_origin
+        self.max_pending = max_pending
+        self._loop = None
+        # パスごとの配信元のハブと接続中のクライアント
+        self._routes = {path: hub}
+        self._clients = {path: set()}
+        self._thread = None
+        self._ready = threading.Event()
+        self.started = False
+
+    def add_hub(self, hub, path):
+        """path への接続に hub のイベントを配信する。起動(start_in_thread)の前に呼び出す。"""
+        self._routes[path] = hub
+        self._clients[path] = set()
+        return self
+
+    # --- 起動・停止 ---
+    def start_in_thread(self):
+        """専用スレッドでイベントループを起動し、待ち受けを開始するまで待つ。待ち受けできたかは started で確認する。"""
+        self._thread = threading.Thread(target=self._run, name=f'{self.hub.name}-async-sse', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=5)
+        return self
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            logger.error(f"[通信ログ] 非同期SSEサーバーが停止しました: {e}", exc_info=True)
+        finally:
+            self._ready.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context)
+        listeners = [(hub, self._listener(path)) for path, hub in self._routes.items()]
+        for hub, listener in listeners:
+            hub.add_listener(listener)
+        logger.info(f"[システムログ] 非同期SSEサーバーを起動しました (ポート: {self.port}, パス: {', '.join(self._routes)})")
+        self.started = True
+        self._ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for hub, listener in listeners:
+                hub.remove_listener(listener)
+
+    def stop(self):
+        if self._loop and self._loop.is_running():
+            for task in asyncio.all_tasks(self._loop):
+                self._loop.call_soon_threadsafe(task.cancel)
+
+    # --- ハブからの受信 ---
+    def _listener(self, path):
+        def on_hub_message(message, event_id):
+            """配信スレッドから呼ばれる。イベントループ側へ処理を引き渡すだけで、すぐに戻る。"""
+            loop = self._loop
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(self._fanout, path, (event_id, message))
+        return on_hub_message
+
+    def _fanout(self, path, frame):
+        for client in list(self._clients[path]):
+            try:
+                client.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # 読み出されないまま溜まり続ける接続は、ゾンビとみなして閉じる
+                client.closed = True
+
+    # --- 接続処理 ---
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2:
+            return None, None, None, headers
+        url = urlsplit(parts[1])
+        return parts[0].upper(), url.path, parse_qs(url.query), headers
+
+    def _cors_headers(self):
+        return (f"Access-Control-Allow-Origin: {self.allow_origin}\r\n"
+                "Access-Control-Allow-Methods: GET, OPTIONS\r\n"
+                "Access-Control-Allow-Headers: Last-Event-ID, Cache-Control\r\n")
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else 'unknown'
+        try:
+            method, path, query, headers = await asyncio.wait_for(self._read_request(reader), timeout=10)
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+            writer.close()
+            return
+
+        if method == 'OPTIONS':
+            # 再接続時の Last-Event-ID ヘッダー付きリクエストに対するプリフライト
+            writer.write(("HTTP/1.1 204 No Content\r\n" + self._cors_headers() +
+                          "Content-Length: 0\r\nConnection: close\r\n\r\n").encode())
+            await self._close(writer)
+            return
+        hub = self._routes.get(path)
+        if method != 'GET' or hub is None:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await self._close(writer)
+            return
+
+        client_id = (query.get('client_id') or ['unknown'])[0]
+        last_event_id = headers.get('last-event-id') or (query.get('last_event_id') or [None])[0]
+
+        client = _AsyncClient(self.max_pending)
+        queue = client.queue
+        # 再送分の取得と登録の間に await を挟まないことで、イベントの取りこぼしを防ぐ
+        # (重複して届いた分はクライアント側でバージョンを見て無視される)
+        clients = self._clients[path]
+        replay = hub.replay_frames(last_event_id) if last_event_id is not None else []
+        clients.add(client)
+        logger.info(f"[通信ログ] クライアント接続(非同期SSE) - IP: {client_ip}, ID: {client_id}, パス: {path}, 接続数: {len(clients)}")
+
+        # クライアント側の切断を読み取り側で即座に検知する
+        disconnected = asyncio.ensure_future(reader.read())
+        try:
+            writer.write(("HTTP/1.1 200 OK\r\n"
+                          "Content-Type: text/event-stream; charset=utf-8\r\n"
+                          "Cache-Control: no-cache\r\n"
+                          "Connection: keep-alive\r\n" + self._cors_headers() + "\r\n").encode())
+            for frame in replay:
+                writer.write(self._format(frame))
+            await writer.drain()
+
+            while not client.closed:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=hub.heartbeat_interval,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    getter.cancel()
+                    break
+                if getter in done:
+                    writer.write(self._format(getter.result()))
+                    while not queue.empty():
+                        writer.write(self._format(queue.get_nowait()))
+                else:
+                    getter.cancel()
+                    writer.write(b": keep-alive\n\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error(f"[通信ログ] クライアント通信エラー(非同期SSE) - IP: {client_ip}, ID: {client_id}, Error: {e}")
+        finally:
+            clients.discard(client)
+            disconnected.cancel()
+            await self._close(writer)
+
+    @staticmethod
+    def _format(frame):
+        event_id, message = frame
+        if event_id is None:
+            return f"data: {message}\n\n".encode('utf-8')
+        return f"id: {event_id}\ndata: {message}\n\n".encode('utf-8')
+
+    @staticmethod
+    async def _close(writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {'async_port': self.port, 'async_subscribers': sum(len(clients) for clients in self._clients.values()),
+                'async_subscribers_by_path': {path: len(clients) for path, clients in self._clients.items()}}
@@ -0,0 +1,290 @@
+"""
+入退室記録の列指向アーカイブ(Parquet)。
+attendance_logs を生徒情報と結合し、学年度・月ごとのパーティション (school_year=YYYY/month=M) に書き出す。
+入室・退室時刻は型付きの日時(JST)、滞在時間は期間型の列として保存するため、分析のたびに文字列を解析し直す必要がない。
+pyarrow は任意の依存関係のため、使用する関数の中で読み込む。
+"""
+import os
+import json
+import shutil
+import sqlite3
+import logging
+import datetime
+
+import pandas as pd
+
+import database
+import report_rollups
+
+logger = logging.getLogger(__name__)
+
+JST = report_rollups.JST
+UTC = report_rollups.UTC
+# アーカイブの形式（列の構成）を変更した場合はこの値を上げ、次回の書き出しで全件を作り直す
+ARCHIVE_FORMAT = 1
+# '_' で始まるファイルは pyarrow がデータとして読み込まない
+STATE_FILE_NAME = '_archive_state.json'
+# 学年度の始まりの月
+SCHOOL_YEAR_START_MONTH = 4
+
+
+class ArchiveUnavailable(Exception):
+    """pyarrow がインストールされていないため、アーカイブを扱えない場合に送出される。"""
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ArchiveUnavailable("列指向アーカイブには pyarrow が必要です。pip install pyarrow を実行してください。") from e
+    return pa, ds, pq
+
+def _schema(pa):
+    timestamp = pa.timestamp('us', tz='Asia/Tokyo')
+    return pa.schema([
+        ('log_id', pa.int64()), ('system_id', pa.int64()),
+        ('enrollment_year', pa.int16()), ('grade', pa.int8()), ('class', pa.int8()),
+        ('student_number', pa.int16()), ('name', pa.string()),
+        # 座席は番号のほか '指定なし' などの文字列も入るため、文字列として保存する
+        ('seat_number', pa.string()),
+        ('day', pa.date32()), ('entry_time', timestamp), ('exit_time', timestamp),
+        # 退室時刻 - 入室時刻（未退室の記録は空）
+        ('stay', pa.duration('us')),
+    ])
+
+def _partitioning(pa, ds):
+    return ds.partitioning(pa.schema([('school_year', pa.int16()), ('month', pa.int8())]), flavor='hive')
+
+def default_archive_dir():
+    """アーカイブの保存先（管理者用_touchable 内の環境変数 ATTENDANCE_ARCHIVE_DIR のフォルダ。既定: archive）。"""
+    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '管理者用_touchable')
+    return os.path.join(base_dir, os.getenv('ATTENDANCE_ARCHIVE_DIR', 'archive'))
+
+
+# --- 学年度・月 ---
+def school_year(year, month):
+    """年・月が属する学年度（4月始まり）を返す。"""
+    return year if month >= SCHOOL_YEAR_START_MONTH else year - 1
+
+def _month_keys(first_day, last_day):
+    """期間に含まれる月を 'YYYY-MM' のリストで返す。"""
+    keys = []
+    month = first_day.replace(day=1)
+    while month <= last_day:
+        keys.append(month.strftime('%Y-%m'))
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return keys
+
+def _month_days(month_key, cutoff):
+    """月のうちアーカイブの対象になる日付の範囲 (初日, 最終日) を返す。cutoff の日付(を含まない)より前が対象。"""
+    first = datetime.date.fromisoformat(month_key + '-01')
+    next_month = (first + datetime.timedelta(days=32)).replace(day=1)
+    return first, min(next_month, cutoff) - datetime.timedelta(days=1)
+
+def _partition_dir(archive_dir, month_key):
+    year, month = map(int, month_key.split('-'))
+    return os.path.join(archive_dir, f'school_year={school_year(year, month)}', f'month={month}')
+
+def _utc_bounds(first_day, last_day):
+    start = JST.localize(datetime.datetime.combine(first_day, datetime.time.min)).astimezone(UTC).isoformat()
+    end = JST.localize(datetime.datetime.combine(last_day, datetime.time.max)).astimezone(UTC).isoformat()
+    return start, end
+
+
+# --- 書き出しの状態 ---
+def _load_state(archive_dir):
+    try:
+        with open(os.path.join(archive_dir, STATE_FILE_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(archive_dir, state):
+    # 書きかけの状態ファイルが残らないよう、一時ファイルに書いてから置き換える
+    path = os.path.join(archive_dir, STATE_FILE_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+def archived_until(archive_dir=None):
+    """アーカイブに含まれる最後の日付の翌日（前回の書き出しの対象外になった最初の日付）を返す。未作成の場合は None。"""
+    cutoff = _load_state(archive_dir or default_archive_dir()).get('cutoff')
+    return datetime.date.fromisoformat(cutoff) if cutoff else None
+
+
+# --- 書き出し ---
+_LOG_QUERY = '''
+    SELECT al.id AS log_id, al.system_id, s.enrollment_year, s.grade, s.class, s.student_number, s.name,
+           CAST(al.seat_number AS TEXT) AS seat_number, al.entry_time, al.exit_time
+    FROM attendance_logs al LEFT JOIN students s ON al.system_id = s.system_id
+    WHERE al.entry_time BETWEEN ? AND ? {condition}
+    ORDER BY al.entry_time, al.id
+'''
+
+def _read_month(conn, month_key, cutoff, archived):
+    """
+    1か月分の書き出す記録を読み込み、(記録, その月を作り直すか, データバージョン) を返す。変化がない場合の記録は None。
+    archived は前回その月を書き出した時の状態 {version, last_log_id, cutoff}（未作成の場合は None）。
+    - 前回より後に追加された記録（last_log_id より後の記録と、前回は対象外だった日付の記録）は、追加分として返す
+    - 前回書き出した日付のデータバージョン(attendance_day_versions)が、追加された記録の件数を超えて増えている場合は、
+      編集・削除があったため、その月の全記録を返して作り直す
+    データバージョンと記録は同じ読み取りトランザクション内で読み込み、途中の書き込みと食い違わないようにする。
+    """
+    first, last = _month_days(month_key, cutoff)
+    start_iso, end_iso = _utc_bounds(first, last)
+    conn.execute('BEGIN')
+    try:
+        version = database.get_range_data_version(conn, first.isoformat(), last.isoformat())
+        if archived is None:
+            return pd.read_sql_query(_LOG_QUERY.format(condition=''), conn, params=(start_iso, end_iso)), True, version
+
+        prev_cutoff = datetime.date.fromisoformat(archived['cutoff'])
+        if last < prev_cutoff and version == archived['version']:
+            return None, False, version
+
+        prev_cutoff_iso = _utc_bounds(prev_cutoff, prev_cutoff)[0]
+        new_logs = pd.read_sql_query(_LOG_QUERY.format(condition='AND (al.id > ? OR al.entry_time >= ?)'), conn,
+                                     params=(start_iso, end_iso, archived['last_log_id'], prev_cutoff_iso))
+        prev_last = min(last, prev_cutoff - datetime.timedelta(days=1))
+        prev_version = database.get_range_data_version(conn, first.isoformat(), prev_last.isoformat()) if prev_last >= first else 0
+        # 前回書き出した日付に後から追加された記録（過去の日付の記録の手入力など）
+        late_inserts = int((new_logs['entry_time'] < prev_cutoff_iso).sum())
+        if prev_version == archived['version'] + late_inserts:
+            return new_logs, False, version
+        logger.info(f"[システムログ] {month_key} の記録が書き出し後に編集・削除されたため、アーカイブを作り直します。")
+        return pd.read_sql_query(_LOG_QUERY.format(condition=''), conn, params=(start_iso, end_iso)), True, version
+    finally:
+        conn.commit()
+
+def _to_table(pa, logs):
+    report_rollups.parse_log_times(logs)
+    logs['day'] = logs['entry_time'].dt.date
+    logs['stay'] = logs['exit_time'] - logs['entry_time']
+    schema = _schema(pa)
+    return pa.Table.from_pandas(logs[schema.names], schema=schema, preserve_index=False)
+
+def _write_partition(pq, table, partition_dir, file_tag, replace):
+    """
+    パーティションにファイルを1つ追加する。replace=True の場合は、既存のファイルを置き換える（記録がなければ削除のみ）。
+    書きかけのファイルを読み込まないよう、'_' で始まる一時ファイルに書いてから名前を変える。
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    old_files = [f for f in os.listdir(partition_dir) if f.endswith('.parquet')] if replace else []
+    file_name = None
+    if table.num_rows:
+        log_ids = table.column('log_id').to_numpy()
+        file_name = f'part-{file_tag}-{log_ids.min():010d}-{log_ids.max():010d}.parquet'
+        tmp_path = os.path.join(partition_dir, f'_{file_name}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(partition_dir, file_name))
+    for old_file in old_files:
+        if old_file != file_name:
+            os.remove(os.path.join(partition_dir, old_file))
+    if not os.listdir(partition_dir):
+        os.rmdir(partition_dir)
+
+def export_archive(db_path, archive_dir=None, today=None):
+    """
+    attendance_logs を Parquet のアーカイブに書き出し、書き出した記録の件数を返す。
+    前日までの記録が対象（当日の記録は入退室でまだ変わるため含めない）。
+    月ごとに、前回書き出した最大の記録ID以降の記録だけをファイルとして追加する。
+    書き出し後にその月の記録が編集・削除された場合や、名簿(結合している生徒情報)が変わった場合は作り直す。
+    同時に複数の書き出しを実行しないこと（夜間の定期ジョブはスケジューラの担当プロセスだけが実行する）。
+    """
+    pa, ds, pq = _import_pyarrow()
+    archive_dir = archive_dir or default_archive_dir()
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = today or datetime.datetime.now(JST).date()
+    file_tag = cutoff.strftime('%Y%m%d')
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        state = _load_state(archive_dir)
+        roster_version = database.get_roster_version(conn)
+        if state.get('format') != ARCHIVE_FORMAT or state.get('roster_version') != roster_version:
+            # 形式や名簿が変わった場合は、既存のパーティションを削除して全件作り直す
+            for entry in os.listdir(archive_dir):
+                if entry.startswith('school_year='):
+                    shutil.rmtree(os.path.join(archive_dir, entry))
+            state = {'format': ARCHIVE_FORMAT, 'roster_version': roster_version, 'cutoff': None, 'months': {}}
+            _save_state(archive_dir, state)
+
+        first_entry = conn.execute('SELECT MIN(entry_time) FROM attendance_logs').fetchone()[0]
+        if first_entry is None:
+            return 0
+        first_day = pd.to_datetime(first_entry, format='ISO8601', utc=True).tz_convert(JST).date()
+        month_keys = sorted(set(_month_keys(first_day, cutoff - datetime.timedelta(days=1))) | set(state['months']))
+
+        exported = 0
+        for month_key in month_keys:
+            archived = state['months'].get(month_key)
+            logs, replace, version = _read_month(conn, month_key, cutoff, archived)
+            if logs is None:
+                continue
+            if replace or not logs.empty:
+                _write_partition(pq, _to_table(pa, logs), _partition_dir(archive_dir, month_key), file_tag, replace)
+            last_log_id = int(logs['log_id'].max()) if not logs.empty else 0
+            if not replace and archived:
+                last_log_id = max(last_log_id, archived['last_log_id'])
+            # 月ごとに状態を保存する（途中で停止しても、書き出し済みの月の記録を重複して追加しない）
+            state['months'][month_key] = {'version': version, 'last_log_id': last_log_id, 'cutoff': cutoff.isoformat()}
+            _save_state(archive_dir, state)
+            exported += len(logs)
+
+        state['cutoff'] = cutoff.isoformat()
+        _save_state(archive_dir, state)
+        return exported
+    finally:
+        conn.close()
+
+
+# --- 読み込み ---
+def load_logs(start_date, end_date, archive_dir=None, columns=None, filters=None):
+    """
+    アーカイブから期間(JSTの日付)内の記録を、入室時刻順の DataFrame で返す（入室・退室時刻はJSTの日時）。
+    学年度・月のパーティションと入室時刻の範囲を読み込み時の条件にするため、期間外のファイル・行グループは読まない。
+    filters は pyarrow の形式の追加条件（例: [('grade', 'in', [4, 5, 6])]）で、これも読み込み時に適用する。
+    開始日が終了日より後の場合は空の DataFrame を返す。
+    """
+    pa, ds, pq = _import_pyarrow()
+    archive_dir = archive_dir or default_archive_dir()
+    if not os.path.isdir(archive_dir):
+        raise FileNotFoundError(f"アーカイブが見つかりません: {archive_dir}")
+
+    partitioning = _partitioning(pa, ds)
+    schema = pa.unify_schemas([_schema(pa), partitioning.schema])
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, 'entry_time', 'log_id']))
+    if start_date > end_date:
+        # 【修正】期間が空の場合は読み込まず、同じ列・型の空の DataFrame を返す
+        table = schema.empty_table()
+        return _to_frame(table.select(read_columns) if read_columns else table, columns)
+    dataset = ds.dataset(archive_dir, schema=schema, format='parquet', partitioning=partitioning)
+
+    month_filter = None
+    for month_key in _month_keys(start_date, end_date):
+        year, month = map(int, month_key.split('-'))
+        condition = (ds.field('school_year') == school_year(year, month)) & (ds.field('month') == month)
+        month_filter = condition if month_filter is None else month_filter | condition
+    timestamp = schema.field('entry_time').type
+    start = JST.localize(datetime.datetime.combine(start_date, datetime.time.min))
+    end = JST.localize(datetime.datetime.combine(end_date, datetime.time.max))
+    condition = (month_filter & (ds.field('entry_time') >= pa.scalar(start, type=timestamp))
+                 & (ds.field('entry_time') <= pa.scalar(end, type=timestamp)))
+    if filters:
+        condition = condition & pq.filters_to_expression(filters)
+
+    return _to_frame(dataset.to_table(columns=read_columns, filter=condition), columns)
+
+def _to_frame(table, columns):
+    # 日時は pandas の既定(ナノ秒)に揃え、DBから読み込んだ場合と同じ型にする
+    df = table.to_pandas(coerce_temporal_nanoseconds=True)
+    df = df.sort_values(by=['entry_time', 'log_id'], kind='stable', ignore_index=True)
+    return df[columns] if columns is not None else df
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    count = export_archive(database.DB_PATH)
+    print(f"{count} 件の記録をアーカイブに書き出しました: {os.path.abspath(default_archive_dir())}")
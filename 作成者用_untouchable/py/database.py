@@ -3,6 +3,8 @@ import pandas as pd
 import glob
 import os
 import logging
+import hashlib
+import unicodedata
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +38,8 @@ def create_tables(conn):
     ''')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_id ON attendance_logs(system_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_entry_time ON attendance_logs(entry_time)')
+    # 【追加】記録一覧を退室時刻順にページ送りする際に使う（末尾に rowid = ログIDを含むため (exit_time, id) の順で読める）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_exit_time ON attendance_logs(exit_time)')
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS phrases (
         id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT, text TEXT NOT NULL, author TEXT, lifespan TEXT
@@ -61,6 +65,85 @@ def create_tables(conn):
         status TEXT DEFAULT 'pending'
     )
     ''')
+    # 【追加】入退室データの変更履歴（端末が前回以降の変更だけを取得するため）
+    # version は AUTOINCREMENT なので、圧縮で古い行を消しても番号が再利用されない
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS attendance_changes (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL, log_id INTEGER, system_id INTEGER, prev_system_id INTEGER,
+        created_at TEXT DEFAULT (datetime('now', 'localtime'))
+    )
+    ''')
+    # 【追加】集計レポートのバックグラウンド作成ジョブ（複数のワーカープロセスから状態を参照できるようDBに置く）
+    # status: queued / running / done / no_data / error / cancelled
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS report_jobs (
+        id TEXT PRIMARY KEY, start_date TEXT NOT NULL, end_date TEXT NOT NULL,
+        status TEXT NOT NULL, progress REAL DEFAULT 0, stage TEXT, message TEXT, file_path TEXT,
+        cancel_requested INTEGER DEFAULT 0, requested_by TEXT,
+        created_at TEXT DEFAULT (datetime('now', 'localtime')), started_at TEXT, finished_at TEXT,
+        updated_at REAL, batch_spec TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs(status)')
+    # 【追加】一括作成ジョブの作成内容(JSON。通常のジョブは NULL)。既存のテーブルには列を追加する
+    if 'batch_spec' not in [row[1] for row in cursor.execute('PRAGMA table_info(report_jobs)')]:
+        cursor.execute('ALTER TABLE report_jobs ADD COLUMN batch_spec TEXT')
+    # 【追加】日付(JST)ごとのデータバージョン。集計レポートのキャッシュが、対象期間の記録が変わったかを判定するために使う
+    # attendance_logs への書き込みはどの経路でもトリガーで反映される（編集で日付が変わった場合は前後両方の日付）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS attendance_day_versions (
+        day TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    for trigger_name, timing, days in [
+        ('trg_attendance_day_version_insert', 'AFTER INSERT', ['NEW']),
+        ('trg_attendance_day_version_update', 'AFTER UPDATE', ['OLD', 'NEW']),
+        ('trg_attendance_day_version_delete', 'AFTER DELETE', ['OLD']),
+    ]:
+        statements = []
+        for row_ref in days:
+            day_expr = f"COALESCE(date({row_ref}.entry_time, '+9 hours'), '')"
+            # 編集で日付が変わらない場合は、同じ日付を2回数えない
+            condition = f"{day_expr} IS NOT COALESCE(date(OLD.entry_time, '+9 hours'), '')" if row_ref == 'NEW' and 'OLD' in days else '1'
+            statements.append(f'''
+                INSERT INTO attendance_day_versions (day, version) SELECT {day_expr}, 1 WHERE {condition}
+                ON CONFLICT(day) DO UPDATE SET version = version + 1;''')
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger_name} {timing} ON attendance_logs BEGIN {''.join(statements)} END")
+    # 【追加】作成済みの集計レポート（期間・条件と、作成時のデータバージョン）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS report_cache (
+        cache_key TEXT PRIMARY KEY, data_version INTEGER NOT NULL, roster_version TEXT NOT NULL,
+        file_path TEXT NOT NULL, file_mtime REAL, file_size INTEGER, message TEXT,
+        created_at TEXT DEFAULT (datetime('now', 'localtime'))
+    )
+    ''')
+    # 【追加】集計レポート用の集計済みテーブル(ロールアップ)。report_rollups.refresh_rollups が日付単位で作り直す
+    # report_rollup_days は各日付をどのデータバージョン(attendance_day_versions)で集計したかを記録する
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS report_daily_rollup (
+        day TEXT NOT NULL, system_id INTEGER NOT NULL, checkins INTEGER NOT NULL, completed INTEGER NOT NULL,
+        stay_minutes REAL NOT NULL, stay_minutes_raw REAL NOT NULL,
+        first_log_id INTEGER, first_entry_time TEXT, first_exit_time TEXT,
+        occupied_hours INTEGER NOT NULL, occupancy_overflow INTEGER NOT NULL,
+        PRIMARY KEY (day, system_id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS report_hourly_rollup (
+        day TEXT NOT NULL, system_id INTEGER NOT NULL, hour INTEGER NOT NULL, checkins INTEGER NOT NULL,
+        PRIMARY KEY (day, system_id, hour)
+    )
+    ''')
+    cursor.execute('CREATE TABLE IF NOT EXISTS report_rollup_days (day TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+    # 未退室の記録だけを期間で引くための部分インデックス（レポートで退室時刻を推定する対象）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_open_logs_entry_time ON attendance_logs(entry_time) WHERE exit_time IS NULL')
+    # 【追加】氏名検索用の全文検索インデックス（表記ゆれを正規化した氏名を trigram で索引化する）
+    # rowid に system_id を使う。FTS5 が使えない SQLite の場合は作成せず、検索は LIKE で行う
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(name_norm, tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"氏名検索インデックス(FTS5)を作成できませんでした。LIKE検索で代替します: {e}")
     conn.commit()
     logger.info("データベースのテーブルを定義しました。")
 
@@ -116,6 +199,101 @@ def sync_students_from_excel(conn):
             
     conn.commit()
     logger.info(f"生徒情報の同期完了: 更新 {updated_count} 件, 新規 {inserted_count} 件")
+    # 【追加】名簿が変わった場合に備え、氏名検索インデックスを作り直す
+    rebuild_name_index(conn)
+
+
+# --- 【追加】氏名検索 ---
+# 全角/半角・カタカナ/ひらがな・姓名間の空白の違いを吸収するため、登録時と検索時の両方で同じ正規化をかける
+NAME_INDEX_MIN_CHARS = 3  # trigram インデックスが使える最短の文字数
+_name_index_available = None
+
+def normalize_name(text):
+    """氏名を検索用に正規化する（NFKC・カタカナ→ひらがな・空白除去・小文字化）。"""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', str(text))
+    text = ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ヶ' else ch for ch in text)
+    return ''.join(text.split()).lower()
+
+def has_name_index(conn):
+    global _name_index_available
+    if _name_index_available is None:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'students_fts'").fetchone()
+        _name_index_available = row is not None
+    return _name_index_available
+
+def rebuild_name_index(conn):
+    """students テーブルの氏名から氏名検索インデックスを作り直す。"""
+    if not has_name_index(conn):
+        return
+    rows = conn.execute('SELECT system_id, name FROM students').fetchall()
+    conn.execute('DELETE FROM students_fts')
+    conn.executemany('INSERT INTO students_fts (rowid, name_norm) VALUES (?, ?)',
+                     [(system_id, normalize_name(name)) for system_id, name in rows])
+    conn.commit()
+    logger.info(f"氏名検索インデックスを作成しました: {len(rows)} 件")
+
+def name_search_condition(conn, query, column='s.system_id'):
+    """
+    氏名の部分一致検索の条件式とパラメータを返す（column には生徒の system_id の列を指定する）。
+    正規化後3文字以上は trigram インデックスで検索し、それより短い場合は正規化済みの氏名に対する LIKE で検索する。
+    正規化すると空になる入力の場合は (None, []) を返す。
+    """
+    normalized = normalize_name(query)
+    if not normalized:
+        return None, []
+    if not has_name_index(conn):
+        return f"{column} IN (SELECT system_id FROM students WHERE name LIKE ?)", [f"%{query.strip()}%"]
+    if len(normalized) >= NAME_INDEX_MIN_CHARS:
+        # 二重引用符で囲んでフレーズとして扱う（FTS5の演算子として解釈させない）
+        phrase = '"' + normalized.replace('"', '""') + '"'
+        return f"{column} IN (SELECT rowid FROM students_fts WHERE students_fts MATCH ?)", [phrase]
+    escaped = normalized.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{column} IN (SELECT rowid FROM students_fts WHERE name_norm LIKE ? ESCAPE '\\')", [f"%{escaped}%"]
+
+
+def get_roster_version(conn):
+    """
+    名簿(生徒の氏名・学年・組・番号)の内容から算出したバージョン文字列を返す。
+    入退室では変化せず、Excelとの再同期で名簿の内容が変わった場合のみ変化する。
+    """
+    rows = conn.execute('SELECT system_id, name, grade, class, student_number FROM students ORDER BY system_id').fetchall()
+    return hashlib.sha1(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()[:16]
+
+
+def record_change(conn, kind, log_id=None, system_id=None, prev_system_id=None):
+    """
+    入退室データの変更を変更履歴に記録し、採番したバージョンを返す。
+    kind: check_in / check_out / log_edit / log_delete / presence_reset
+    書き込みと同じトランザクション内(commit前)で呼び出すこと。コミットされた変更と履歴が必ず一致する。
+    """
+    cursor = conn.execute('INSERT INTO attendance_changes (kind, log_id, system_id, prev_system_id) VALUES (?, ?, ?, ?)',
+                          (kind, log_id, system_id, prev_system_id))
+    return cursor.lastrowid
+
+
+def get_change_version(conn):
+    """変更履歴の最新バージョンを返す（起動時のバージョン採番の起点）。"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'attendance_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def get_range_data_version(conn, start_date, end_date):
+    """
+    期間(JSTの日付 'YYYY-MM-DD')内の記録のデータバージョンを返す。
+    各日付のバージョンは増える一方なので、合計値は期間内のどの記録が追加・編集・削除されても必ず増える。
+    """
+    row = conn.execute('SELECT COALESCE(SUM(version), 0) FROM attendance_day_versions WHERE day BETWEEN ? AND ?',
+                       (start_date, end_date)).fetchone()
+    return row[0]
+
+
+def compact_changes(conn, keep=5000):
+    """変更履歴を直近 keep 件だけ残して削除する。それより古い版からの再開は全件取得に切り替わる。"""
+    cursor = conn.execute('DELETE FROM attendance_changes WHERE version <= (SELECT MAX(version) FROM attendance_changes) - ?', (keep,))
+    conn.commit()
+    return cursor.rowcount
 
 
 def import_phrases_from_excel(conn):
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import portalocker
+
+logger = logging.getLogger(__name__)
+
+# バッチファイルで .../py フォルダに移動してから実行されることを前提とする相対パス
+EVENT_BUS_DB_PATH = os.path.join('..', 'event_bus.db')
+
+
+class EventBus:
+    """
+    複数のワーカープロセス間でイベントを共有するための、SQLiteを使った簡易 pub/sub。
+    - publish() はイベントを event_bus テーブルに書き込み、チャンネルごとに連番のバージョンを採番する
+      (採番は INSERT 文の中で行うため、どのプロセスから書いても番号が重複・逆転しない)
+    - 書き込み後、登録済みの全プロセスへ localhost の UDP で「起こす」だけの通知を送る
+    - 各プロセスの受信スレッドは通知を受けるか poll_interval 秒ごとに新しい行を読み、ハンドラーへ渡す
+      (UDPが届かなかった場合でも、ポーリングで必ず追いつく)
+    Windows でも動くよう、Unixドメインソケットではなく UDP を使う。
+    """
+    def __init__(self, db_path=EVENT_BUS_DB_PATH, poll_interval=1.0, retention_seconds=3600):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self._handlers = {}
+        self._last_id = 0
+        self._peer_ports = []
+        self._peers_loaded_at = 0.0
+        self._running = False
+        self._thread = None
+        self._sock = None
+        self.port = None
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS event_bus (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL, version INTEGER NOT NULL,
+                payload TEXT NOT NULL, created_at REAL NOT NULL
+            )
+            ''')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_event_bus_channel_version ON event_bus (channel, version)')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS event_bus_peers (
+                port INTEGER PRIMARY KEY, pid INTEGER, updated_at REAL NOT NULL
+            )
+            ''')
+            conn.commit()
+            # 起動前の古いイベントは配信しない
+            self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM event_bus').fetchone()[0]
+        finally:
+            conn.close()
+
+    # --- 購読 ---
+    def subscribe(self, channel, handler):
+        """channel に届いたイベントごとに handler(version, event) を呼び出すよう登録する。"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def latest_version(self, channel):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT MAX(version) FROM event_bus WHERE channel = ?', (channel,)).fetchone()
+            return row[0] or 0
+        finally:
+            conn.close()
+
+    # --- 配信 ---
+    def publish(self, channel, event, version=None):
+        """
+        イベントを書き込んで全プロセスに通知し、採番したバージョンを返す。
+        version を指定した場合は採番せずにその番号を使う（呼び出し側で採番済みの場合）。
+        """
+        payload = json.dumps(event, ensure_ascii=False, default=str)
+        conn = self._connect()
+        try:
+            with conn:
+                if version is not None:
+                    conn.execute('INSERT INTO event_bus (channel, version, payload, created_at) VALUES (?, ?, ?, ?)',
+                                 (channel, version, payload, time.time()))
+                else:
+                    cursor = conn.execute('''
+                        INSERT INTO event_bus (channel, version, payload, created_at)
+                        SELECT ?, COALESCE(MAX(version), 0) + 1, ?, ? FROM event_bus WHERE channel = ?
+                    ''', (channel, payload, time.time(), channel))
+                    version = conn.execute('SELECT version FROM event_bus WHERE id = ?', (cursor.lastrowid,)).fetchone()[0]
+        finally:
+            conn.close()
+        self._poke_peers()
+        return version
+
+    def _poke_peers(self):
+        now = time.monotonic()
+        if now - self._peers_loaded_at > 5:
+            conn = self._connect()
+            try:
+                self._peer_ports = [row[0] for row in conn.execute('SELECT port FROM event_bus_peers')]
+            finally:
+                conn.close()
+            self._peers_loaded_at = now
+        sock = self._sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for port in self._peer_ports:
+            try:
+                sock.sendto(b'!', ('127.0.0.1', port))
+            except OSError:
+                pass
+        if sock is not self._sock:
+            sock.close()
+
+    # --- 受信スレッド ---
+    def start(self):
+        """通知受信用のポートを登録し、受信スレッドを起動する。"""
+        if self._running:
+            return self
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.settimeout(self.poll_interval)
+        self.port = self._sock.getsockname()[1]
+        self._register_peer()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='event-bus-listener', daemon=True)
+        self._thread.start()
+        logger.info(f"[システムログ] イベントバスの受信を開始しました (PID: {os.getpid()}, 通知ポート: {self.port})")
+        return self
+
+    def _register_peer(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO event_bus_peers (port, pid, updated_at) VALUES (?, ?, ?)',
+                             (self.port, os.getpid(), time.time()))
+        finally:
+            conn.close()
+
+    def _run(self):
+        last_maintenance = time.monotonic()
+        while self._running:
+            try:
+                self._sock.recvfrom(16)
+            except socket.timeout:
+                pass
+            except OSError:
+                if not self._running:
+                    break
+            try:
+                self._dispatch_new_events()
+                if time.monotonic() - last_maintenance > 30:
+                    self._maintenance()
+                    last_maintenance = time.monotonic()
+            except Exception as e:
+                logger.error(f"[通信ログ] イベントバスの受信処理でエラーが発生しました: {e}", exc_info=True)
+
+    def _dispatch_new_events(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT id, channel, version, payload FROM event_bus WHERE id > ? ORDER BY id',
+                                (self._last_id,)).fetchall()
+        finally:
+            conn.close()
+        for row_id, channel, version, payload in rows:
+            self._last_id = row_id
+            for handler in self._handlers.get(channel, []):
+                try:
+                    handler(version, json.loads(payload))
+                except Exception as e:
+                    logger.error(f"[通信ログ] イベントの処理に失敗しました ({channel} v{version}): {e}", exc_info=True)
+
+    def _maintenance(self):
+        """生存通知の更新と、古いイベント・停止したプロセスの登録の削除。"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('UPDATE event_bus_peers SET updated_at = ? WHERE port = ?', (now, self.port))
+                conn.execute('DELETE FROM event_bus_peers WHERE updated_at < ?', (now - 120,))
+                # 各チャンネルの最新行は、次の採番のために残しておく
+                conn.execute('''
+                    DELETE FROM event_bus WHERE created_at < ?
+                    AND id NOT IN (SELECT MAX(id) FROM event_bus GROUP BY channel)
+                ''', (now - self.retention_seconds,))
+        finally:
+            conn.close()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM event_bus_peers WHERE port = ?', (self.port,))
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._sock.close()
+
+
+class LeaderLock:
+    """
+    ファイルロックによるリーダー選出。ロックを取得できたプロセスだけが定期ジョブを実行する。
+    リーダーのプロセスが終了するとOSがロックを解放するため、他のプロセスが次の試行で引き継ぐ。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        f = open(self.path, 'a')
+        try:
+            portalocker.lock(f, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        except portalocker.exceptions.LockException:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    @property
+    def is_leader(self):
+        return self._file is not None
+
+    def release(self):
+        if self._file is not None:
+            portalocker.unlock(self._file)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,371 @@
+import threading
+import time
+import json
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    """
+    1つのSSE接続に対応する購読者。
+    メッセージが届いた時だけ Condition で待機中のスレッドを起こす。
+    """
+    def __init__(self, client_id, remote_addr, max_pending):
+        self.client_id = client_id
+        self.remote_addr = remote_addr
+        self.max_pending = max_pending
+        self.connected_at = time.time()
+        self.closed = False
+        self._pending = deque()
+        self._cond = threading.Condition()
+
+    def push(self, message, event_id=None):
+        """メッセージを積んで待機中のスレッドを起こす。切断扱いになった場合は False を返す。"""
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._pending) >= self.max_pending:
+                # 読み出されないまま溜まり続ける接続は、切断済み(ゾンビ)とみなして閉じる
+                self.closed = True
+                self._cond.notify()
+                return False
+            self._pending.append((event_id, message))
+            self._cond.notify()
+            return True
+
+    def prefill(self, frames):
+        """再接続時の再送分を、上限に関係なく先頭に積む（配信開始前にのみ呼ぶ）。"""
+        with self._cond:
+            self._pending.extend(frames)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """メッセージが届くか timeout 秒経過するまで待機し、溜まっているメッセージをまとめて返す。"""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            messages = list(self._pending)
+            self._pending.clear()
+            return messages
+
+
+class BroadcastHub:
+    """
+    SSE購読者の登録とブロードキャストを管理するハブ。
+    - 購読者の登録・解除はロックで保護する
+    - 各接続のスレッドはデータがある時か、ハートビート間隔ごとにしか起きない
+    - ハートビートの書き込み失敗、または未読メッセージの溜まりすぎで切断を検知する
+    - 直近のイベントをリングバッファに保持し、再接続時(Last-Event-ID)に取りこぼし分だけ再送する
+    """
+    def __init__(self, name='sse', heartbeat_interval=20.0, max_pending=100, replay_size=500):
+        self.name = name
+        self.heartbeat_interval = heartbeat_interval
+        self.max_pending = max_pending
+        self._replay = deque(maxlen=replay_size)
+        self._lock = threading.Lock()
+        # バージョン採番と配信の順序を揃えるためのロック（v2がv1より先に届かないようにする）
+        self._publish_lock = threading.Lock()
+        self._subscribers = set()
+        # 同一プロセス内の別の配信経路（非同期SSEサーバーなど）へ転送するためのリスナー
+        self._listeners = []
+        self._version = 0
+        self._publish_count = 0
+        self._last_fanout_ms = 0.0
+        self._max_fanout_ms = 0.0
+        self._total_fanout_ms = 0.0
+
+    def subscribe(self, client_id='unknown', remote_addr=None, last_event_id=None):
+        """
+        購読者を登録する。last_event_id が指定された場合は、それ以降のイベントを再送対象として積む。
+        取りこぼしがバッファに残っていない場合は、全件再取得を促す snapshot イベントを積む。
+        """
+        sub = Subscriber(client_id, remote_addr, self.max_pending)
+        # 再送分の計算と登録の間に新しいイベントが割り込まないよう、配信ロックを取得しておく
+        with self._publish_lock:
+            if last_event_id is not None:
+                sub.prefill(self._replay_frames(last_event_id))
+            with self._lock:
+                self._subscribers.add(sub)
+        return sub
+
+    def replay_frames(self, last_event_id):
+        """last_event_id より後のイベントの (ID, メッセージ) 一覧を返す（外部の配信経路向け）。"""
+        with self._publish_lock:
+            return self._replay_frames(last_event_id)
+
+    def _replay_frames(self, last_event_id):
+        try:
+            last_version = int(last_event_id)
+        except (TypeError, ValueError):
+            last_version = -1
+
+        current = self._version
+        if last_version == current:
+            return []
+        # 再送バッファもバージョンの逆順に記録されることがあるため、最も古い番号は min で求める
+        oldest = min(version for version, _ in self._replay) if self._replay else None
+        # サーバー再起動でバージョンが巻き戻った場合や、取りこぼしがバッファより古い場合は全件再取得させる
+        if last_version < 0 or last_version > current or oldest is None or oldest > last_version + 1:
+            snapshot = json.dumps({"type": "snapshot", "version": current})
+            return [(current, snapshot)]
+        return sorted((version, msg) for version, msg in self._replay if version > last_version)
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def add_listener(self, callback):
+        """配信のたびに callback(message, event_id) を呼び出すよう登録する。callback はすぐに戻ること。"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def publish(self, message, event_id=None):
+        """全購読者にメッセージを配信し、配信できた件数を返す。"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+
+        for callback in listeners:
+            try:
+                callback(message, event_id)
+            except Exception as e:
+                logger.error(f"[通信ログ] リスナーへの転送に失敗しました ({self.name}): {e}")
+
+        started = time.perf_counter()
+        delivered = 0
+        dead = []
+        for sub in subscribers:
+            if sub.push(message, event_id):
+                delivered += 1
+            else:
+                dead.append(sub)
+        fanout_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            for sub in dead:
+                self._subscribers.discard(sub)
+            self._publish_count += 1
+            self._last_fanout_ms = fanout_ms
+            self._max_fanout_ms = max(self._max_fanout_ms, fanout_ms)
+            self._total_fanout_ms += fanout_ms
+
+        if dead:
+            logger.info(f"[通信ログ] 応答のない接続を {len(dead)} 件切断しました ({self.name})")
+        return delivered
+
+    def record_event(self, event, version=None):
+        """
+        イベント(dict)に単調増加するバージョン番号を付与し、再送用のリングバッファに保持する。
+        version を指定した場合は採番せずにその番号を使う（イベントバスで採番済みの場合）。
+        配信はまだ行わず、(バージョン, バージョン付きイベント) を返す。
+        """
+        with self._publish_lock:
+            with self._lock:
+                if version is None:
+                    self._version += 1
+                    version = self._version
+                else:
+                    self._version = max(self._version, version)
+            event = dict(event, version=version)
+            self._replay.append((version, json.dumps(event, ensure_ascii=False, default=str)))
+        return version, event
+
+    def broadcast_events(self, events):
+        """
+        記録済みのイベントをまとめて配信する。複数件の場合は1つの batch メッセージとして送り、
+        SSEのイベントID(id:)には最も新しいバージョンを使う。
+        """
+        if not events:
+            return 0
+        # 【修正】バージョンの採番と保留への追加は別々に行われるため、並行した通知は番号の逆順に届くことがある
+        # 配信前にバージョン順に並べ、クライアントが順に反映できる（飛びと誤認しない）ようにする
+        events = sorted(events, key=lambda e: e['version'])
+        with self._publish_lock:
+            last_version = max(event['version'] for event in events)
+            if len(events) == 1:
+                payload = events[0]
+            else:
+                payload = {"type": "batch", "version": last_version, "events": events}
+            return self.publish(json.dumps(payload, ensure_ascii=False, default=str), event_id=last_version)
+
+    def publish_event(self, event):
+        """
+        イベント(dict)にバージョン番号を付与して即座に配信し、そのバージョンを返す。
+        バージョンはSSEのイベントID(id:)としても送信し、再送用のリングバッファに保持する。
+        クライアントはバージョンの飛びを検知した場合のみ全件を再取得する。
+        """
+        version, event = self.record_event(event)
+        self.broadcast_events([event])
+        return version
+
+    def seed_version(self, version):
+        """起動時に、他のプロセスと共有している現在のバージョンから採番を始める。"""
+        with self._publish_lock:
+            with self._lock:
+                self._version = max(self._version, version)
+
+    def current_version(self):
+        with self._lock:
+            return self._version
+
+    def stream(self, sub):
+        """SSE形式の文字列を生成するジェネレーター。接続終了時に購読を解除する。"""
+        try:
+            while True:
+                messages = sub.wait(self.heartbeat_interval)
+                if messages:
+                    for event_id, msg in messages:
+                        if event_id is None:
+                            yield f"data: {msg}\n\n"
+                        else:
+                            yield f"id: {event_id}\ndata: {msg}\n\n"
+                elif sub.closed:
+                    break
+                else:
+                    # データがない間はハートビートのみ送信（書き込み失敗で切断を検知する）
+                    yield ": keep-alive\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+    def close_all(self):
+        """サーバー停止時に全接続を閉じ、待機中のスレッドを解放する。"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for sub in subscribers:
+            sub.close()
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            avg_ms = self._total_fanout_ms / self._publish_count if self._publish_count else 0.0
+            return {
+                'name': self.name,
+                'version': self._version,
+                'subscribers': len(self._subscribers),
+                'replay_buffered': len(self._replay),
+                'heartbeat_interval': self.heartbeat_interval,
+                'publish_count': self._publish_count,
+                'last_fanout_ms': round(self._last_fanout_ms, 3),
+                'max_fanout_ms': round(self._max_fanout_ms, 3),
+                'avg_fanout_ms': round(avg_ms, 3),
+            }
+
+
+class CoalescingPublisher:
+    """
+    短時間に連続する通知を1回のブロードキャストにまとめる層。
+    - バージョン採番と再送バッファへの記録は通知時に即座に行う（データの版数は遅れない）
+    - 配信は、最後の通知から window 秒間新しい通知がなければ行う
+    - ただし最初の通知から max_delay 秒を超えて待たせることはない（リアルタイム性の保証）
+    window が 0 以下の場合はまとめずに即時配信する。
+    """
+    def __init__(self, hub, window=0.1, max_delay=0.5):
+        self.hub = hub
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._first_at = None
+        self._deadline = None
+        self._thread = None
+        self._notifications_received = 0
+        self._broadcasts_sent = 0
+
+    def notify(self, event, version=None):
+        """イベントを記録し、まとめて配信するために保留する。付与したバージョンを返す。"""
+        version, event = self.hub.record_event(event, version)
+        if self.window <= 0:
+            self.hub.broadcast_events([event])
+            with self._cond:
+                self._notifications_received += 1
+                self._broadcasts_sent += 1
+            return version
+
+        with self._cond:
+            self._notifications_received += 1
+            now = time.monotonic()
+            if self._first_at is None:
+                self._first_at = now
+            self._pending.append(event)
+            self._deadline = min(now + self.window, self._first_at + self.max_delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'{self.hub.name}-coalescer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return version
+
+    def notify_batch(self, items):
+        """
+        複数のイベント [(event, version), ...] を記録し、保留中の通知と合わせて即座に1回で配信する。
+        一括編集のように、1つの操作で発生した変更をまとめて届けたい場合に使う。付与したバージョンの一覧を返す。
+        """
+        with self._cond:
+            recorded = [self.hub.record_event(event, version)[1] for event, version in items]
+            self._notifications_received += len(recorded)
+            events = sorted(self._take_pending() + recorded, key=lambda e: e['version'])
+            if events:
+                self._broadcasts_sent += 1
+        self.hub.broadcast_events(events)
+        return [event['version'] for event in recorded]
+
+    def _take_pending(self):
+        events = self._pending
+        self._pending = []
+        self._first_at = None
+        self._deadline = None
+        return events
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # 締め切りまで待つ（待機中に通知が来ると締め切りが延びるが、max_delay を超えることはない）
+                while self._pending:
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                # 【修正】待機中に flush / notify_batch で配信済みになった場合は、次の通知を待つ
+                if not self._pending:
+                    continue
+                events = self._take_pending()
+                self._broadcasts_sent += 1
+            try:
+                self.hub.broadcast_events(events)
+            except Exception as e:
+                logger.error(f"[通信ログ] まとめ配信に失敗しました ({self.hub.name}): {e}", exc_info=True)
+
+    def flush(self):
+        """保留中の通知を即座に配信する（サーバー停止時など）。"""
+        with self._cond:
+            events = self._take_pending()
+            if events:
+                self._broadcasts_sent += 1
+        self.hub.broadcast_events(events)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'coalesce_window_ms': round(self.window * 1000),
+                'coalesce_max_delay_ms': round(self.max_delay * 1000),
+                'notifications_received': self._notifications_received,
+                'broadcasts_sent': self._broadcasts_sent,
+                'pending': len(self._pending),
+            }
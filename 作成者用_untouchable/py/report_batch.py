@@ -0,0 +1,281 @@
+"""
+集計レポートの一括作成（期間 × 学年・組の絞り込み の組み合わせごとに1ファイル）。
+対象期間全体の記録をDBから1回だけ読み込み、各レポートの集計・Excelへの書き出しをプロセスプールで並列に行う。
+作成したファイルは 管理者用_touchable/logs 内の一括作成ごとのフォルダに保存し、各レポートの結果と所要時間を manifest.json に記録する。
+
+コマンドラインからの実行例（py フォルダで実行）:
+    python report_batch.py --period 2025-04-01:2026-03-31 --split month --slice all --slice 1 --slice 4-2
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import zipfile
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import database
+import report_generator
+from report_generator import GRADE_MAP, ReportCancelled
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def _notify_progress(progress, fraction, stage):
+    # progress(割合0〜1, 段階名) は中止させたい場合に ReportCancelled を送出する
+    if progress:
+        progress(fraction, stage)
+
+def default_max_workers():
+    """並列に作成するレポートの数（環境変数 REPORT_BATCH_WORKERS。既定: CPU数、最大4）。"""
+    return int(os.getenv('REPORT_BATCH_WORKERS', min(4, os.cpu_count() or 1)))
+
+
+# --- 作成するレポートの一覧 ---
+def _parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('期間の形式が正しくありません。')
+
+def _split_months(start_date, end_date):
+    """期間を月ごとの期間に分ける（最初と最後の月は期間の範囲まで）。"""
+    periods = []
+    month_start = start_date
+    while month_start <= end_date:
+        next_month = (month_start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        periods.append((month_start, min(end_date, next_month - datetime.timedelta(days=1))))
+        month_start = next_month
+    return periods
+
+def _normalize_slice(value):
+    if not isinstance(value, dict):
+        raise ValueError('学年・組の指定が正しくありません。')
+    grade, class_ = value.get('grade'), value.get('class')
+    if grade is not None and (isinstance(grade, bool) or not isinstance(grade, int) or grade not in GRADE_MAP):
+        raise ValueError(f'学年の指定が正しくありません: {grade}')
+    if class_ is not None and (isinstance(class_, bool) or not isinstance(class_, int) or class_ < 1):
+        raise ValueError(f'組の指定が正しくありません: {class_}')
+    return {'grade': grade, 'class': class_}
+
+def expand_items(periods, slices=None, split=None):
+    """
+    期間の一覧と学年・組の絞り込みの一覧から、作成するレポートの一覧（期間 × 絞り込み の組み合わせ）を返す。
+    periods: [{'start_date': 'YYYY-MM-DD', 'end_date': 'YYYY-MM-DD'}, ...]
+    slices: [{}, {'grade': 1}, {'grade': 4, 'class': 2}, ...]（{} は全体。省略時は全体のみ）
+    split='month' の場合は、各期間を月ごとに分ける。
+    指定が正しくない場合は ValueError を送出する（メッセージはそのまま利用者に表示できる）。
+    """
+    if not periods or not isinstance(periods, list):
+        raise ValueError('期間が指定されていません。')
+    if split not in (None, 'month'):
+        raise ValueError('期間の分割方法の指定が正しくありません。')
+    if slices is not None and not isinstance(slices, list):
+        raise ValueError('学年・組の指定が正しくありません。')
+    slices = [_normalize_slice(value) for value in (slices or [{}])]
+
+    items = []
+    for period in periods:
+        if not isinstance(period, dict):
+            raise ValueError('期間の形式が正しくありません。')
+        start_date, end_date = _parse_date(period.get('start_date')), _parse_date(period.get('end_date'))
+        if start_date > end_date:
+            raise ValueError('期間の開始日が終了日より後になっています。')
+        for item_start, item_end in (_split_months(start_date, end_date) if split == 'month' else [(start_date, end_date)]):
+            for slice_ in slices:
+                item = {'start_date': item_start.isoformat(), 'end_date': item_end.isoformat(), **slice_}
+                if item not in items:
+                    items.append(item)
+    return items
+
+def slice_label(item):
+    """絞り込みの表示名（例: 全体 / 高1 / 高1-2組 / 2組）。"""
+    parts = []
+    if item.get('grade') is not None:
+        parts.append(GRADE_MAP[item['grade']])
+    if item.get('class') is not None:
+        parts.append(f"{item['class']}組")
+    return '-'.join(parts) or '全体'
+
+def _file_name(item):
+    name = f"集計レポート_{item['start_date'].replace('-', '')}-{item['end_date'].replace('-', '')}"
+    if item.get('grade') is not None or item.get('class') is not None:
+        name += f'_{slice_label(item)}'
+    return name + '.xlsx'
+
+
+# --- 作成 ---
+def _render_item(logs, students_master, start_date, end_date, file_path):
+    """1件のレポートを作成し、(保存先, 所要秒数) を返す（プロセスプールの子プロセスで呼ばれる）。"""
+    started = time.perf_counter()
+    file_path = report_generator.render_report(logs, students_master, start_date, end_date, file_path)
+    return file_path, round(time.perf_counter() - started, 3)
+
+def _render_all(tasks, max_workers):
+    """
+    各レポートを作成し、完了した順に (結果, 保存先, 所要秒数, 例外) を返す。
+    呼び出し元が途中で止めた(close した)場合は、未着手のレポートを取り消し、作成中のものの終了を待つ。
+    """
+    if max_workers <= 1 or len(tasks) <= 1:
+        for result, *args in tasks:
+            try:
+                yield (result, *_render_item(*args), None)
+            except Exception as e:
+                yield result, None, None, e
+        return
+    # Webサーバーのプロセスでは使わない（このモジュールはレポート作成用の子プロセスかコマンドラインから呼ばれる）
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = {executor.submit(_render_item, *args): result for result, *args in tasks}
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield (futures[future], *future.result(), None)
+                except Exception as e:
+                    yield futures[future], None, None, e
+        finally:
+            for future in futures:
+                future.cancel()
+
+def run_batch(db_path, items, output_dir=None, max_workers=None, progress=None):
+    """
+    レポートを一括作成し、(manifest.json の保存先, マニフェスト) を返す。
+    items は expand_items で作成した一覧。output_dir を省略した場合は 集計レポートの保存先/一括レポート_日時 に保存する。
+    progress(割合0〜1, 段階名) はレポートが1件完了するごとに呼ばれる。ReportCancelled を送出すると、
+    未着手のレポートを取り消して中止し、作成途中のフォルダを削除する。
+    """
+    started = time.perf_counter()
+    max_workers = max_workers or default_max_workers()
+    created_at = datetime.datetime.now()
+    output_dir = output_dir or os.path.join(report_generator.report_output_dir(), f"一括レポート_{created_at.strftime('%Y%m%d-%H%M%S')}")
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        # --- 対象期間全体の記録を1回だけ読み込む ---
+        _notify_progress(progress, 0.0, 'データ読み込み')
+        start_date = min(datetime.date.fromisoformat(item['start_date']) for item in items)
+        end_date = max(datetime.date.fromisoformat(item['end_date']) for item in items)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            logs = report_generator.load_report_logs(conn, start_date, end_date)
+            students_master = pd.read_sql_query("SELECT grade, class FROM students", conn)
+        finally:
+            conn.close()
+        read_seconds = round(time.perf_counter() - started, 3)
+
+        # --- 各レポートの対象の記録を切り出す ---
+        entry_days = logs['entry_time'].dt.tz_localize(None).to_numpy('datetime64[D]')
+        grades, classes = logs['grade'].to_numpy(), logs['class'].to_numpy()
+        results, tasks = [], []
+        for item in items:
+            result = {**item, 'label': slice_label(item), 'status': None, 'file': None, 'rows': 0, 'seconds': None}
+            results.append(result)
+            mask = (entry_days >= np.datetime64(item['start_date'])) & (entry_days <= np.datetime64(item['end_date']))
+            master = students_master
+            if item['grade'] is not None:
+                mask &= grades == item['grade']
+                master = master[master['grade'] == item['grade']]
+            if item['class'] is not None:
+                mask &= classes == item['class']
+                master = master[master['class'] == item['class']]
+            result['rows'] = int(mask.sum())
+            if not result['rows']:
+                result['status'] = 'no_data'
+                continue
+            tasks.append((result, logs[mask].reset_index(drop=True), master,
+                          datetime.date.fromisoformat(item['start_date']), datetime.date.fromisoformat(item['end_date']),
+                          os.path.join(output_dir, _file_name(item))))
+        _notify_progress(progress, 0.1, f'レポート作成 (0/{len(tasks)}件)')
+
+        # --- 並列に作成する ---
+        rendered = _render_all(tasks, max_workers)
+        try:
+            for count, (result, file_path, seconds, error) in enumerate(rendered, start=1):
+                if error is None:
+                    result.update(status='done', file=os.path.basename(file_path), seconds=seconds)
+                else:
+                    logger.error(f"[システムログ] 一括作成中のレポートの作成に失敗しました ({result['start_date']}～{result['end_date']} {result['label']}): {error}")
+                    result.update(status='error', message=str(error))
+                _notify_progress(progress, 0.1 + 0.85 * count / len(tasks), f'レポート作成 ({count}/{len(tasks)}件)')
+        finally:
+            rendered.close()
+    except ReportCancelled:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+
+    manifest = {
+        'created_at': created_at.isoformat(timespec='seconds'),
+        'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(),
+        'max_workers': max_workers, 'log_rows': len(logs),
+        'read_seconds': read_seconds, 'total_seconds': round(time.perf_counter() - started, 3),
+        'reports': results,
+    }
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    logger.info(f"[操作ログ] 集計レポートを一括作成しました - {summarize(manifest)}, 保存先: {output_dir}")
+    return manifest_path, manifest
+
+def summarize(manifest):
+    """一括作成の結果の要約（件数と所要時間）。"""
+    counts = {status: sum(1 for report in manifest['reports'] if report['status'] == status) for status in ('done', 'no_data', 'error')}
+    return (f"{counts['done']}件のレポートを作成しました（データなし {counts['no_data']}件、失敗 {counts['error']}件）。"
+            f"読み込み {manifest['read_seconds']}秒、合計 {manifest['total_seconds']}秒")
+
+def archive_batch(manifest_path):
+    """一括作成したフォルダの内容を、ダウンロード用に1つのZIPファイルにまとめてそのパスを返す。"""
+    output_dir = os.path.dirname(manifest_path)
+    zip_path = output_dir + '.zip'
+    # Excelファイルは圧縮済みのため、そのまま格納する
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for file_name in sorted(os.listdir(output_dir)):
+            archive.write(os.path.join(output_dir, file_name), arcname=os.path.join(os.path.basename(output_dir), file_name))
+    return zip_path
+
+
+# --- コマンドライン ---
+def _parse_period(text):
+    start_date, sep, end_date = text.partition(':')
+    return {'start_date': start_date, 'end_date': end_date if sep else start_date}
+
+def _parse_slice(text):
+    if text == 'all':
+        return {}
+    grade, sep, class_ = text.partition('-')
+    try:
+        return {'grade': int(grade), 'class': int(class_)} if sep else {'grade': int(grade)}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'学年・組の指定が正しくありません: {text}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='集計レポートを一括作成します。')
+    parser.add_argument('--period', action='append', required=True, type=_parse_period,
+                        help='期間 (YYYY-MM-DD:YYYY-MM-DD)。複数指定できます')
+    parser.add_argument('--split', choices=['month'], help='各期間を月ごとのレポートに分ける')
+    parser.add_argument('--slice', action='append', type=_parse_slice,
+                        help='学年・組の絞り込み。all(全体) / 学年(1〜6) / 学年-組 (例: 4-2)。複数指定できます（省略時は全体のみ）')
+    parser.add_argument('--workers', type=int, help='並列に作成するレポートの数（既定: 環境変数 REPORT_BATCH_WORKERS）')
+    parser.add_argument('--db', default=database.DB_PATH, help='データベースファイルのパス')
+    args = parser.parse_args(argv)
+    try:
+        items = expand_items(args.period, args.slice, args.split)
+    except ValueError as e:
+        parser.error(str(e))
+
+    manifest_path, manifest = run_batch(args.db, items, max_workers=args.workers)
+    for report in manifest['reports']:
+        seconds = f"{report['seconds']:.2f}秒" if report['seconds'] is not None else '-'
+        print(f"{report['start_date']}～{report['end_date']} {report['label']}: {report['status']} {report['rows']}件 {seconds}")
+    print(summarize(manifest))
+    print(f"保存先: {os.path.dirname(os.path.abspath(manifest_path))}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -1,10 +1,18 @@
 import pandas as pd
+import numpy as np
 import sqlite3
 import os
 import datetime
 import pytz
 import logging
 import shutil
+import contextlib
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+import report_rollups
+import attendance_archive
 
 logger = logging.getLogger(__name__)
 
@@ -14,351 +22,678 @@ UTC = pytz.utc
 GRADE_MAP = {1: '中1', 2: '中2', 3: '中3', 4: '高1', 5: '高2', 6: '高3'}
 GRADE_ALPHABET_MAP = {1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'E', 6: 'F'}
 DOW_MAP = {'Monday': '月', 'Tuesday': '火', 'Wednesday': '水', 'Thursday': '木', 'Friday': '金', 'Saturday': '土', 'Sunday': '日'}
+# 滞在記録(元データ)シートを書き出す際に、一度に文字列へ整形する行数
+RAW_SHEET_CHUNK_ROWS = 20000
+# 【追加】記録を読み込むときの1回あたりの件数（環境変数 REPORT_READ_CHUNK_ROWS で変更できる）
+READ_CHUNK_ROWS = 50000
+RAW_SHEET_COLUMNS = ['ID', '学年', '組', '番号', '氏名', '入室日', '曜日', '入室時刻', '退室日', '退室時刻', '滞在時間(分)', '入室時間帯']
+# pandas の to_excel と同じ見出しの書式（太字・細罫線・中央揃え）
+_HEADER_FONT = Font(bold=True)
+_THIN = Side(style='thin')
+_HEADER_BORDER = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
+_HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+
+class ReportCancelled(Exception):
+    """進捗の通知先(progress)がレポート作成の中止を求めた場合に送出される。"""
+
+
+def _notify_progress(progress, fraction, stage):
+    # progress(割合0〜1, 段階名) は中止させたい場合に ReportCancelled を送出する
+    if progress:
+        progress(fraction, stage)
+
+def _excel_value(ws, value, header=False):
+    """セルに書き込む値を、pandas の to_excel と同じ見た目になるよう変換する（欠損値は空欄）。"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return None
+    is_date = isinstance(value, (datetime.date, pd.Timestamp))
+    if isinstance(value, pd.Timestamp):
+        value = value.to_pydatetime()
+    if not header and not is_date:
+        return value
+    cell = WriteOnlyCell(ws, value=value)
+    if is_date:
+        cell.number_format = 'YYYY-MM-DD'
+    if header:
+        cell.font, cell.border, cell.alignment = _HEADER_FONT, _HEADER_BORDER, _HEADER_ALIGNMENT
+    return cell
+
+def _create_sheet(workbook, sheet_name, header, title=None, tab_color=None):
+    """書き込み専用のシートを作り、(A1のタイトルと)見出し行を書き込む。"""
+    ws = workbook.create_sheet(sheet_name)
+    if tab_color:
+        ws.sheet_properties.tabColor = tab_color
+    if title is not None:
+        ws.append([title])
+    ws.append([_excel_value(ws, value, header=True) for value in header])
+    return ws
+
+def _append_frame(ws, frame, index=True):
+    """DataFrame の行を1行ずつシートへ書き出す（インデックスは見出しと同じ書式にする）。"""
+    for row in frame.itertuples(index=index, name=None):
+        values = [_excel_value(ws, value) for value in row]
+        if index:
+            values[0] = _excel_value(ws, row[0], header=True)
+        ws.append(values)
+
+def _write_frame(workbook, sheet_name, frame, index=True):
+    header = ([frame.index.name] if index else []) + list(frame.columns)
+    _append_frame(_create_sheet(workbook, sheet_name, header), frame, index=index)
+
+@contextlib.contextmanager
+def _streaming_workbook(file_path):
+    """
+    書き込み専用(write_only)のブックを作り、ブロックを正常に抜けた場合のみ file_path に保存する。
+    行は追加した時点で一時ファイルへ書き出されるため、シート全体をメモリ上に組み立てない。
+    """
+    workbook = Workbook(write_only=True)
+    try:
+        yield workbook
+    except BaseException:
+        # 中止・エラーの場合は保存せず、書きかけのシートの一時ファイルを片付ける
+        for ws in workbook.worksheets:
+            ws.close()
+            ws._writer.cleanup()
+        raise
+    workbook.save(file_path)
+
+def _raw_sheet_rows(df, forgot_exit_mask):
+    """滞在記録(元データ)シートの行を、RAW_SHEET_CHUNK_ROWS 行ずつ整形して返す。"""
+    for start in range(0, len(df), RAW_SHEET_CHUNK_ROWS):
+        chunk = df.iloc[start:start + RAW_SHEET_CHUNK_ROWS]
+        exit_hm = chunk['exit_time'].dt.strftime('%H:%M:%S')
+        exit_hm = exit_hm.where(~forgot_exit_mask.reindex(chunk.index), exit_hm + '（推定）')
+        yield pd.DataFrame({
+            'ID': chunk['ID'], '学年': chunk['grade_jp'], '組': chunk['class'], '番号': chunk['student_number'],
+            '氏名': chunk['name'], '入室日': chunk['entry_time'].dt.strftime('%Y-%m-%d'), '曜日': chunk['day_of_week_jp'],
+            '入室時刻': chunk['entry_time'].dt.strftime('%H:%M:%S'), '退室日': chunk['exit_time'].dt.strftime('%Y-%m-%d'),
+            '退室時刻': exit_hm, '滞在時間(分)': chunk['stay_minutes'], '入室時間帯': chunk['entry_hour_jp'],
+        })
+
+def _occupied_hours(df):
+    """
+    各滞在を JST の通し時間番号の区間 [入室の時, 退室1秒前の時] に変換し、NumPyでまとめて展開する。
+    在室した (時間帯の通し番号 hour, system_id, grade_jp) を返す。
+    """
+    valid = ~(df['entry_time'].isna().to_numpy() | df['exit_time'].isna().to_numpy())
+    start_hour, end_hour = report_rollups.stay_hour_range(df['entry_time'], df['exit_time'])
+    # 各滞在を、在室した時間帯の数だけ繰り返して展開する
+    rows, hours = report_rollups.expand_hours(start_hour, np.where(valid, end_hour, start_hour - 1))
+    return pd.DataFrame({
+        'hour': hours,
+        'system_id': df['system_id'].to_numpy()[rows],
+        'grade_jp': df['grade_jp'].to_numpy()[rows],
+    })
+
+def _occupancy_pivot(occupied, all_grades_jp, all_hours_jp):
+    """
+    時間帯(0-23時) × 学年 の在室人数を集計する（「同じ日・同じ時間帯・同じ人」は1回として数える）。
+    退室時間がジャスト(例: 10:00:00)の場合は、その時間帯(10時台)には在室していないとみなす。
+    """
+    # 同じ日・同じ時間帯の同じ人は1回だけ数える（別の日の同じ時間帯は別にカウントする）
+    occupied = occupied.drop_duplicates(subset=['hour', 'system_id'])
+    grade_codes = pd.Categorical(occupied['grade_jp'], categories=all_grades_jp).codes
+    valid = grade_codes >= 0
+
+    counts = np.zeros((24, len(all_grades_jp)), dtype='int64')
+    np.add.at(counts, (occupied['hour'].to_numpy()[valid] % 24, grade_codes[valid]), 1)
+    occupancy_pivot = pd.DataFrame(counts, index=all_hours_jp, columns=all_grades_jp)
+    occupancy_pivot.columns.name = 'grade_jp'
+    return occupancy_pivot
+
+def _group_mode(group_ids, values, ngroups, weights=None):
+    """
+    グループごとの最頻値を返す（x.mode()[0] と同じく、同数の場合は値の並び順で最初のもの）。
+    値をカテゴリ番号に変換し、グループ × 値 の件数表の argmax で求める。
+    weights を指定すると、1行を weights の件数として数える（集計済みの件数から求める場合）。
+    """
+    categories = np.sort(values.dropna().unique())
+    codes = pd.Categorical(values, categories=categories).codes
+    mask = (group_ids >= 0) & (codes >= 0)
+    counts = np.zeros((ngroups, len(categories)), dtype='int64')
+    np.add.at(counts, (group_ids[mask], codes[mask]), 1 if weights is None else weights[mask])
+    return categories[counts.argmax(axis=1)]
+
+def _user_summary(df, num_weeks):
+    """
+    「利用者別サマリー」の集計。生徒ごとのグループ分けを1回だけ行い、
+    最頻値・曜日別利用日数は件数表の argmax / 合計で求める（グループごとのPython処理を行わない）。
+    """
+    dow_order = ['月', '火', '水', '木', '金', '土', '日']
+    grouped = df.groupby(['grade_jp', 'class', 'student_number', 'name', 'system_id'], observed=True)
+    df_user_summary = grouped.agg(
+        total_checkins=('system_id', 'count'),
+        total_stay_minutes=('stay_minutes', 'sum'),
+        avg_stay_minutes=('stay_minutes', 'mean'),
+        first_entry_time=('entry_time', 'min'),
+    ).reset_index()
+    # 日付(date型)の min は遅いため、日時の min から日付を取り出す（date は entry_time の日付なので結果は同じ）
+    df_user_summary['first_use_date'] = df_user_summary.pop('first_entry_time').dt.date
+    # キーに欠損がありグループに入らない行は -1 にする
+    group_ids = grouped.ngroup().fillna(-1).to_numpy('int64')
+    ngroups = len(df_user_summary)
+
+    # 曜日ごとの利用日数（日付と生徒で重複を除いた、その日最初の記録だけを数える）
+    first_of_day = ~df.duplicated(subset=['date', 'system_id']).to_numpy()
+    dow_codes = pd.Categorical(df['day_of_week_jp'], categories=dow_order).codes
+    mask = first_of_day & (group_ids >= 0) & (dow_codes >= 0)
+    dow_counts = np.zeros((ngroups, len(dow_order)), dtype='int64')
+    np.add.at(dow_counts, (group_ids[mask], dow_codes[mask]), 1)
+    df_user_summary[dow_order] = dow_counts
+    df_user_summary['unique_days_attended'] = dow_counts.sum(axis=1)
+
+    df_user_summary['most_used_dow'] = _group_mode(group_ids, df['day_of_week_jp'], ngroups)
+    df_user_summary['most_used_hour'] = _group_mode(group_ids, df['entry_hour_jp'], ngroups)
+    df_user_summary.drop(columns=['system_id'], inplace=True)
+    df_user_summary['weekly_avg_checkins'] = round(df_user_summary['unique_days_attended'] / num_weeks, 1)
+    return df_user_summary
+
+def _user_summary_from_rollups(daily, hourly, num_weeks):
+    """
+    「利用者別サマリー」を集計済みテーブルから集計する（_user_summary と同じ結果になる）。
+    daily は 日付×生徒 の1行、hourly は 生徒×入室時間帯 の入室回数。
+    """
+    dow_order = ['月', '火', '水', '木', '金', '土', '日']
+    grouped = daily.groupby(['grade_jp', 'class', 'student_number', 'name', 'system_id'], observed=True)
+    df_user_summary = grouped.agg(
+        total_checkins=('checkins', 'sum'),
+        total_stay_minutes=('stay_total', 'sum'),
+        first_day=('day', 'min'),
+    ).reset_index()
+    df_user_summary['avg_stay_minutes'] = df_user_summary['total_stay_minutes'] / df_user_summary['total_checkins']
+    df_user_summary['first_use_date'] = pd.to_datetime(df_user_summary.pop('first_day')).dt.date
+    group_ids = grouped.ngroup().fillna(-1).to_numpy('int64')
+    ngroups = len(df_user_summary)
+
+    # 曜日ごとの利用日数（daily は1行が「ある生徒のある日」なので、そのまま数える）
+    dow_codes = pd.Categorical(daily['day_of_week_jp'], categories=dow_order).codes
+    mask = (group_ids >= 0) & (dow_codes >= 0)
+    dow_counts = np.zeros((ngroups, len(dow_order)), dtype='int64')
+    np.add.at(dow_counts, (group_ids[mask], dow_codes[mask]), 1)
+    df_user_summary[dow_order] = dow_counts
+    df_user_summary['unique_days_attended'] = dow_counts.sum(axis=1)
+
+    # 最頻値は記録1件ごとに数えるため、入室回数を重みにする
+    df_user_summary['most_used_dow'] = _group_mode(group_ids, daily['day_of_week_jp'], ngroups,
+                                                   weights=daily['checkins'].to_numpy('int64'))
+    group_by_student = pd.Series(group_ids, index=daily['system_id'].to_numpy()).groupby(level=0).first()
+    hourly_group_ids = hourly['system_id'].map(group_by_student).fillna(-1).to_numpy('int64')
+    df_user_summary['most_used_hour'] = _group_mode(hourly_group_ids, hourly['hour'].astype(str) + '時台', ngroups,
+                                                    weights=hourly['checkins'].to_numpy('int64'))
+    df_user_summary.drop(columns=['system_id'], inplace=True)
+    df_user_summary['weekly_avg_checkins'] = round(df_user_summary['unique_days_attended'] / num_weeks, 1)
+    return df_user_summary
+
+def _prepare_logs(df, avg_stay_minutes_map):
+    """
+    退室し忘れの記録の滞在時間・退室時刻を生徒ごとの平均滞在時間で補い、集計用の列を追加する。
+    退室時刻を推定した行のマスクを返す。
+    """
+    forgot_exit_mask = df['exit_time'].isnull()
+    df['stay_minutes_imputed'] = df['system_id'].map(avg_stay_minutes_map).fillna(120)
+    
+    df['stay_minutes'] = round((df['exit_time'] - df['entry_time']).dt.total_seconds() / 60, 1)
+    df.loc[forgot_exit_mask, 'stay_minutes'] = df.loc[forgot_exit_mask, 'stay_minutes_imputed']
+    df.loc[forgot_exit_mask, 'exit_time'] = df.loc[forgot_exit_mask, 'entry_time'] + pd.to_timedelta(df.loc[forgot_exit_mask, 'stay_minutes'], unit='m')
+    
+    df['grade_jp'] = df['grade'].map(GRADE_MAP)
+    df['ID'] = 'ID_' + df['system_id'].astype(str)
+    df['stay_hours'] = round(df['stay_minutes'] / 60, 1)
+    df['date'] = df['entry_time'].dt.date # 'date'列をここで作成
+    df['day_of_week_jp'] = df['entry_time'].dt.day_name().map(DOW_MAP)
+    df['entry_hour'] = df['entry_time'].dt.hour
+    df['entry_hour_jp'] = df['entry_hour'].astype(str) + '時台'
+    return forgot_exit_mask
+
+def _format_hm(times):
+    """日時の列を 'HH:MM' 形式の文字列にする（欠損は空文字列）。"""
+    valid = times.notna()
+    hm = pd.Series('', index=times.index, dtype=object)
+    hm[valid] = (times[valid].dt.hour.astype(str).str.zfill(2) + ':'
+                 + times[valid].dt.minute.astype(str).str.zfill(2))
+    return hm
+
+def _daily_count_sheet(df_for_sheet0):
+    """「日報人数カウント用」シートの表を作る（各生徒のその日最初の入室記録1件ずつ）。"""
+    df_copy_paste = df_for_sheet0.copy() # フィルター後のデータを使用
+
+    # 1. (仕様変更) IDを 'ID_23C0115' 形式に生成
+    # system_idを文字列に変換（7桁ゼロ埋め）
+    df_copy_paste['system_id_str'] = df_copy_paste['system_id'].astype(str).str.zfill(7)
+    # 学年(数値)をアルファベット(A-F)に変換
+    df_copy_paste['grade_alphabet'] = df_copy_paste['grade'].map(GRADE_ALPHABET_MAP)
+    # 結合してIDを生成: 'ID_' + '23' + 'C' + '0115'
+    # system_idの3文字目(学年)を、マッピングしたアルファベットで置き換える
+    df_copy_paste['ID_formatted'] = 'ID_' + \
+                                    df_copy_paste['system_id_str'].str[0:2] + \
+                                    df_copy_paste['grade_alphabet'] + \
+                                    df_copy_paste['system_id_str'].str[3:]
+
+    # 1-2. 中高を除いた数字のみの学年を作成
+    # 【修正】正規表現は学年の種類ごとに1回だけ適用し、各行には対応表で割り当てる
+    grade_labels = df_copy_paste['grade_jp'].drop_duplicates()
+    grade_numbers = dict(zip(grade_labels, grade_labels.str.extract(r'(\d+)')[0].astype(int)))
+    df_copy_paste['学年_数値'] = df_copy_paste['grade_jp'].map(grade_numbers).astype(int)
+
+    # 2. 入室時間と退室時間を HH:MM 形式にフォーマット
+    # 【修正】行ごとの strftime は件数が多いと遅いため、時・分の数値から文字列を組み立てる
+    df_copy_paste['入室時間_HM'] = _format_hm(df_copy_paste['entry_time'])
+    # 退室時間が空欄でない場合のみフォーマット、空欄の場合は空文字列
+    df_copy_paste['退室時間_HM'] = _format_hm(df_copy_paste['exit_time'])
+
+    # 3. その日の何回目の入室かを計算 (ユニーク抽出したため、すべて1になる)
+    df_copy_paste['入室回数'] = 1 # groupby処理を削除し、固定で 1 を設定
+
+    # 4. 中高の区分を作成 ( 削除)
+    # df_copy_paste['中高'] = df_copy_paste['grade_jp'].str[0] # この行を削除
+
+    # 5. 必要な列を順番通りに選択 ( ID -> ID_formatted に変更、'中高'を削除)
+    df_final_copy_paste = df_copy_paste[[
+        'ID_formatted', # 変更
+        '学年_数値',
+        'class',
+        'student_number',
+        'name',
+        '入室時間_HM',
+        '退室時間_HM',
+        '入室回数',
+        # '中高' # 削除
+    ]]
+
+    # 6. Excelに出力する際の列名（ヘッダー）を変更 
+    df_final_copy_paste.columns = [
+        'ID',
+        '学年',
+        '組',
+        '番',
+        '名前',
+        '入室時間',
+        '退室時間',
+        '回数',
+        # '中高' # 削除
+    ]
+    return df_final_copy_paste
+
+def _class_summary(df_daily_unique_users, all_grades_jp, all_classes):
+    """「日別ユニーク学年組別サマリー」。df_daily_unique_users は「日ごとのユニーク利用者」(日付×生徒の1行)。"""
+    # 2. 上記の「日ごとユニーク」データを使ってクロス集計（=延べ人数をカウント）
+    df_summary_class = pd.crosstab(df_daily_unique_users['grade_jp'], df_daily_unique_users['class'])
+    
+    # 3. 欠損している学年・組を0埋めして合計を計算
+    df_summary_class = df_summary_class.reindex(index=all_grades_jp, columns=all_classes, fill_value=0)
+    df_summary_class['合計'] = df_summary_class.sum(axis=1)
+    df_summary_class.loc['合計'] = df_summary_class.sum()
+    df_summary_class.index.name = "学年"
+    df_summary_class.columns.name = "組"
+    return df_summary_class
+
+def _daily_summary(daily_agg, daily_grade_pivot, all_grades_jp, start_date, end_date):
+    """「日別サマリー」。daily_agg は日付ごとの集計、daily_grade_pivot は日付×学年のユニーク入室者数。"""
+    # 2. 2つの集計結果を一度結合し、列にすべての学年が含まれるように保証する
+    df_daily = pd.concat([daily_agg, daily_grade_pivot], axis=1)
+    df_daily = df_daily.reindex(columns=daily_agg.columns.tolist() + all_grades_jp)
+
+    all_dates_index = pd.to_datetime(pd.date_range(start=start_date, end=end_date)).date
+    df_daily = df_daily.reindex(all_dates_index)
+
+    # 4. 記録がなくてNaN(空欄)になったセルを0で埋める
+    df_daily.fillna(0, inplace=True)
+    
+    # 5. 空だった行の曜日を、日付インデックスから再生成して埋める
+    df_daily['day_of_week_jp'] = pd.to_datetime(df_daily.index).to_series().dt.day_name().map(DOW_MAP)
+
+    # 6. カラムのデータ型（整数）と最終的な順序を整える
+    count_cols = ['total_checkins', 'unique_users'] + all_grades_jp
+    df_daily[count_cols] = df_daily[count_cols].astype(int)
+    final_columns_daily = ['day_of_week_jp'] + count_cols + ['avg_stay_minutes']
+    df_daily = df_daily[final_columns_daily]
+
+    # 7. カラム名を日本語にリネームしてExcelに出力
+    df_daily.rename(columns={
+        'day_of_week_jp':'曜日', 'total_checkins':'総入室回数', 
+        'unique_users':'ユニーク入室者数', 'avg_stay_minutes':'平均滞在時間(分)'
+    }, inplace=True)
+    df_daily.index.name = '日付'
+    return df_daily
+
+def _user_summary_sheet(df_user_summary):
+    df_user_summary = df_user_summary.rename(columns={
+        'grade_jp': '学年', 'class': '組', 'student_number': '番号', 'name': '氏名',
+        'total_checkins': '総利用回数', 'unique_days_attended': '利用日数', # '利用日数' を追加
+        'total_stay_minutes': '総滞在時間(分)', # '総滞在時間(分)' に変更
+        'avg_stay_minutes': '平均滞在時間(分)', 'most_used_dow': '最多利用曜日',
+        'weekly_avg_checkins': '週平均利用回数', 'first_use_date': '初回利用日', 'most_used_hour': '最多入室時間帯'
+    })
+    
+    # 最終的に出力する列のリストを定義し直す
+    final_user_summary_columns = [
+        '学年', '組', '番号', '氏名', 
+        '総利用回数', '利用日数', '週平均利用回数', 
+        '総滞在時間(分)', '平均滞在時間(分)', 
+        '最多利用曜日', '月', '火', '水', '木', '金', '土', '日',
+        '最多入室時間帯', '初回利用日'
+    ]
+    return df_user_summary[final_user_summary_columns]
+
+def _hourly_summary(hourly_pivot, all_grades_jp, all_hours_jp):
+    """「時間帯別総入室回数サマリー」。hourly_pivot は 入室時間帯×学年 の入室回数。"""
+    hourly_pivot = hourly_pivot.reindex(columns=all_grades_jp, fill_value=0)
+    hourly_pivot = hourly_pivot.reindex(index=all_hours_jp, fill_value=0)
+    hourly_pivot['合計'] = hourly_pivot.sum(axis=1)
+    hourly_pivot.loc['合計'] = hourly_pivot.sum()
+    hourly_pivot.index.name = '時間帯'
+    return hourly_pivot
+
+def _occupancy_summary(occupied, all_grades_jp, all_hours_jp):
+    """「時間帯別在室人数サマリー」。occupied は在室した (時間帯の通し番号, 生徒, 学年)。"""
+    # ここで集計されるのは「期間中の全日程における、その時間帯の在室人数の延べ合計」となる
+    occupancy_pivot = _occupancy_pivot(occupied, all_grades_jp, all_hours_jp)
+    
+    # 合計列・行の計算
+    # 横方向（その時間帯の全学年合計）は意味があるため残す
+    occupancy_pivot['合計'] = occupancy_pivot.sum(axis=1)
+    
+    # 縦方向（列の合計）は、時間をまたぐ同一人物が重複加算され、
+    # 「延べ積算人数」のような直感的でない値になるため計算しない
+    # occupancy_pivot.loc['合計'] = occupancy_pivot.sum()
+    
+    occupancy_pivot.index.name = '時間帯'
+    return occupancy_pivot
+
+def report_output_dir():
+    """集計レポートの保存先フォルダ（管理者用_touchable 内の環境変数 REPORT_OUTPUT_DIR のフォルダ。既定: logs）を返す。なければ作成する。"""
+    report_dir_name = os.getenv('REPORT_OUTPUT_DIR', 'logs')
+    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '管理者用_touchable')
+    report_dir = os.path.join(base_dir, report_dir_name)
+    
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    return report_dir
+
+def _available_file_path(file_path):
+    """保存先のファイルが開かれて(ロックされて)いる場合は、連番を付けた別名の保存先を返す。"""
+    report_dir, file_name = os.path.split(file_path)
+    # 【追加】ファイルがロックされている（開かれている）場合に別名を生成する処理
+    base_name, ext = os.path.splitext(file_name)
+    counter = 1
+    while True:
+        try:
+            # ファイルが存在する場合のみロックチェックを行う
+            if os.path.exists(file_path):
+                # 追記モードで開いてみることでロック状態を確認
+                # WindowsではExcelで開いているファイルに対して PermissionError が発生する
+                with open(file_path, 'a'):
+                    pass
+            # エラーが出なければ書き込み可能（またはファイルが存在しない）なのでループを抜ける
+            break
+        except PermissionError:
+            # ロックされている場合は連番を付与して再試行
+            logger.warning(f"ファイル {os.path.basename(file_path)} はロックされています。別名での保存を試みます。")
+            new_name = f"{base_name}_{counter}{ext}"
+            file_path = os.path.join(report_dir, new_name)
+            counter += 1
+    return file_path
+
+def _write_report_workbook(file_path, sheets, raw_rows, start_date, end_date, progress=None):
+    """シートの表(sheets)と滞在記録(元データ)シートの行(raw_rows)を、集計レポートのブックとして file_path に保存する。"""
+    # 【修正】pd.ExcelWriter(openpyxl) はブック全体をメモリ上に組み立ててから保存するため、
+    # 期間が長いと滞在記録(元データ)シートでメモリを大きく消費する。書き込み専用のブックへ行ごとに書き出す
+    with _streaming_workbook(file_path) as workbook:
+    
+        # --- シート0: 日報人数カウント用 ---
+        # (仕様変更) シート名を変更し、A1に期間、A2からデータを出力
+        sheet_name = '日報人数カウント用'
+    
+        # (仕様変更) A1セルに期間を書き込む （仕様②）
+        if start_date == end_date:
+            # 単一日の場合
+            title_str = start_date.strftime('%Y/%m/%d')
+        else:
+            # 複数日の場合
+            title_str = f"{start_date.strftime('%Y/%m/%d')}～{end_date.strftime('%Y/%m/%d')}"
+    
+        # (仕様変更) シート見出しの色を黄色に設定 （仕様③）
+        # データをA2から書き出す （仕様①）
+        worksheet = _create_sheet(workbook, sheet_name, sheets['daily_count'].columns, title=title_str,
+                                  tab_color="FFFFFF00") # ARGB for Yellow
+        _append_frame(worksheet, sheets['daily_count'], index=False)
+    
+        _notify_progress(progress, 0.3, '日別ユニーク学年組別サマリー')
+        # --- シート1: 日別ユニーク学年組別サマリー ---
+        _write_frame(workbook, '日別ユニーク学年組別サマリー', sheets['class_summary'])
+        _notify_progress(progress, 0.4, '滞在記録(元データ)')
+        # --- シート2: 滞在記録(元データ) ---
+        # 【修正】全行分の文字列を一度に作らず、一定行数ずつ整形して書き出す
+        worksheet = _create_sheet(workbook, '滞在記録(元データ)', RAW_SHEET_COLUMNS)
+        for df_raw in raw_rows:
+            _append_frame(worksheet, df_raw[RAW_SHEET_COLUMNS], index=False)
+    
+        _notify_progress(progress, 0.5, '日別サマリー')
+        # --- シート3: 日別サマリー ---
+        _write_frame(workbook, '日別サマリー', sheets['daily_summary'])
+    
+        _notify_progress(progress, 0.6, '利用者別サマリー')
+        # --- シート4: 利用者別サマリー ---
+        _write_frame(workbook, '利用者別サマリー', sheets['user_summary'], index=False)
+    
+        _notify_progress(progress, 0.7, '時間帯別総入室回数サマリー')
+        # --- シート5: 時間帯別総入室回数サマリー ---
+        _write_frame(workbook, '時間帯別総入室回数サマリー', sheets['hourly_summary'])
+    
+        _notify_progress(progress, 0.8, '時間帯別在室人数サマリー')
+        # --- シート6: 時間帯別在室人数サマリー ---
+        _write_frame(workbook, '時間帯別在室人数サマリー', sheets['occupancy_summary'])
+        _notify_progress(progress, 0.9, 'ファイル保存')
+
+def _prepare_raw_logs(df):
+    """
+    期間内の全記録(入室・退室時刻はJSTの日時に変換済み)に前処理を行い、(入室時刻順の記録, 退室時刻を推定した行のマスク) を返す。
+    """
+    completed_logs = df.dropna(subset=['exit_time']).copy()
+
+     # 先に滞在時間（分）を計算する
+    # この時点で exit_time と entry_time は日時型なので、安全に計算できる
+    completed_logs.loc[:, 'stay_minutes'] = (completed_logs['exit_time'] - completed_logs['entry_time']).dt.total_seconds() / 60
+
+    # system_id ごとに平均滞在時間を計算する
+    avg_stay_minutes_map = completed_logs.groupby('system_id')['stay_minutes'].mean().round(1)
+
+    forgot_exit_mask = _prepare_logs(df, avg_stay_minutes_map)
+    
+    # 入室時間が早い順に並び替え（シート0で最初の記録を取得するために必要）
+    # 同時刻の記録は記録ID順のまま（集計済みテーブルから作成する場合と同じ順序）にするため、安定ソートを使う
+    return df.sort_values(by='entry_time', kind='stable'), forgot_exit_mask
+
+def _report_axes(students_master):
+    # 存在するすべての学年・組・時間帯のリスト（学年・組はマスターから取得）
+    all_grades_jp = sorted(students_master['grade'].map(GRADE_MAP).unique(), key=lambda x: list(GRADE_MAP.values()).index(x))
+    all_classes = sorted(students_master['class'].unique())
+    all_hours_jp = [f"{h}時台" for h in range(24)]
+    return all_grades_jp, all_classes, all_hours_jp
+
+def _sheets_from_logs(df, students_master, start_date, end_date):
+    """期間内の全記録(前処理済み・入室時刻順)から、滞在記録(元データ)以外のシートの表を作る。"""
+    all_grades_jp, all_classes, all_hours_jp = _report_axes(students_master)
+    # 日付と生徒IDで重複を削除し、「日ごとのユニーク利用者」(その日最初の入室記録)を作成
+    df_daily_unique_users = df.drop_duplicates(subset=['date', 'system_id'], keep='first')
+
+    # 1. これまで通り、日付ごとの集計と、学年ごとのクロス集計をそれぞれ作成
+    daily_agg = df.groupby('date').agg(
+        total_checkins=('system_id', 'count'),
+        unique_users=('system_id', 'nunique'),
+        avg_stay_minutes=('stay_minutes', 'mean')
+    ).round(1)
+    daily_grade_pivot = pd.crosstab(df['date'], df['grade_jp'], values=df['system_id'], aggfunc='nunique')
+
+    # 1. ログデータからユニークな日付の数を数え、「開室日数」を算出する
+    total_open_days = df['date'].nunique()
+    # 2. 「開室日数」を基に週数を計算する（7日未満は1週間とみなす）
+    num_weeks = total_open_days / 7 if total_open_days >= 7 else 1
+
+    return {
+        # (仕様変更) 日付と生徒IDで重複を削除し、その日最初の入室記録のみを対象とする
+        'daily_count': _daily_count_sheet(df_daily_unique_users),
+        'class_summary': _class_summary(df_daily_unique_users, all_grades_jp, all_classes),
+        'daily_summary': _daily_summary(daily_agg, daily_grade_pivot, all_grades_jp, start_date, end_date),
+        # 【修正】最頻値(mode)をグループごとのラムダで求めず、1回のグループ分けと件数表でまとめて集計する
+        'user_summary': _user_summary_sheet(_user_summary(df, num_weeks)),
+        'hourly_summary': _hourly_summary(pd.crosstab(df['entry_hour_jp'], df['grade_jp']), all_grades_jp, all_hours_jp),
+        # 【修正】滞在ごとに date_range を作って explode する方法は長期間で遅いため、NumPyでまとめて集計する
+        'occupancy_summary': _occupancy_summary(_occupied_hours(df), all_grades_jp, all_hours_jp),
+    }
+
+def _sheets_from_rollups(daily, hourly, extra_logs, students_master, start_date, end_date):
+    """
+    集計済みテーブル(report_rollups)から、滞在記録(元データ)以外のシートの表を作る。
+    extra_logs は記録から直接集計する必要があるもの（退室し忘れの記録と、長時間の滞在の記録）。
+    期間内の退室済みの記録から求めた生徒ごとの平均滞在時間も返す（退室し忘れの記録の推定に使う）。
+    """
+    all_grades_jp, all_classes, all_hours_jp = _report_axes(students_master)
+    daily['grade_jp'] = daily['grade'].map(GRADE_MAP)
+    daily_dates = pd.to_datetime(daily['day'])
+    daily['date'] = daily_dates.dt.date
+    daily['day_of_week_jp'] = daily_dates.dt.day_name().map(DOW_MAP)
+    hourly['grade_jp'] = hourly['grade'].map(GRADE_MAP)
+
+    # system_id ごとの平均滞在時間（期間内の退室済みの記録の平均。元データから集計する場合と同じ）
+    completed = daily.groupby('system_id')[['stay_minutes_raw', 'completed']].sum()
+    completed = completed[completed['completed'] > 0]
+    avg_stay_minutes_map = (completed['stay_minutes_raw'] / completed['completed']).round(1)
+
+    # 退室し忘れの記録の推定滞在時間を、日付×生徒の合計に加える
+    forgot_exit_mask = _prepare_logs(extra_logs, avg_stay_minutes_map)
+    forgot_logs = extra_logs[forgot_exit_mask]
+    imputed = forgot_logs.groupby([forgot_logs['entry_time'].dt.strftime('%Y-%m-%d'), 'system_id'])['stay_minutes'].sum()
+    keys = pd.MultiIndex.from_frame(daily[['day', 'system_id']])
+    daily['stay_total'] = daily['stay_minutes'].to_numpy() + imputed.reindex(keys, fill_value=0).to_numpy()
+
+    # 日報人数カウント用: その日最初の記録の入室・退室時刻（退室し忘れの場合は推定した退室時刻）
+    first_logs = daily.assign(entry_time=daily['first_entry_time'], exit_time=daily['first_exit_time'])
+    report_rollups.parse_log_times(first_logs)
+    forgot_first = first_logs['exit_time'].isna()
+    first_stay = first_logs.loc[forgot_first, 'system_id'].map(avg_stay_minutes_map).fillna(120)
+    first_logs.loc[forgot_first, 'exit_time'] = first_logs.loc[forgot_first, 'entry_time'] + pd.to_timedelta(first_stay, unit='m')
+    first_logs = first_logs.sort_values(by=['entry_time', 'first_log_id'])
+
+    daily_agg = daily.groupby('date').agg(
+        total_checkins=('checkins', 'sum'),
+        unique_users=('system_id', 'nunique'),
+        stay_total=('stay_total', 'sum'),
+    )
+    daily_agg['avg_stay_minutes'] = daily_agg.pop('stay_total') / daily_agg['total_checkins']
+    daily_agg = daily_agg.round(1)
+    daily_grade_pivot = pd.crosstab(daily['date'], daily['grade_jp'])
+
+    total_open_days = daily['date'].nunique()
+    num_weeks = total_open_days / 7 if total_open_days >= 7 else 1
+
+    hourly_pivot = hourly.assign(entry_hour_jp=hourly['hour'].astype(str) + '時台').pivot_table(
+        index='entry_hour_jp', columns='grade_jp', values='checkins', aggfunc='sum', fill_value=0)
+
+    rows, hours = report_rollups.expand_occupancy_masks(daily['day'].to_numpy(), daily['occupied_hours'].to_numpy('int64'))
+    occupied = pd.concat([
+        pd.DataFrame({'hour': hours, 'system_id': daily['system_id'].to_numpy()[rows], 'grade_jp': daily['grade_jp'].to_numpy()[rows]}),
+        _occupied_hours(extra_logs),
+    ], ignore_index=True)
+
+    sheets = {
+        'daily_count': _daily_count_sheet(first_logs),
+        'class_summary': _class_summary(daily, all_grades_jp, all_classes),
+        'daily_summary': _daily_summary(daily_agg, daily_grade_pivot, all_grades_jp, start_date, end_date),
+        'user_summary': _user_summary_sheet(_user_summary_from_rollups(daily, hourly, num_weeks)),
+        'hourly_summary': _hourly_summary(hourly_pivot, all_grades_jp, all_hours_jp),
+        'occupancy_summary': _occupancy_summary(occupied, all_grades_jp, all_hours_jp),
+    }
+    return sheets, avg_stay_minutes_map
+
+def _raw_sheet_rows_from_db(conn, start_date, end_date, avg_stay_minutes_map):
+    """滞在記録(元データ)シートの行を、DBから一定件数ずつ読み込んで整形して返す。"""
+    for chunk in report_rollups.iter_log_chunks(conn, start_date, end_date, RAW_SHEET_CHUNK_ROWS):
+        forgot_exit_mask = _prepare_logs(chunk, avg_stay_minutes_map)
+        yield from _raw_sheet_rows(chunk, forgot_exit_mask)
+
+def _read_chunk_rows():
+    return int(os.getenv('REPORT_READ_CHUNK_ROWS', READ_CHUNK_ROWS))
+
+def load_report_logs(conn, start_date, end_date):
+    """
+    期間(JSTの日付)内の記録を生徒情報と結合して入室時刻・記録ID順に読み込み、入室・退室時刻をJSTの日時に変換して返す。
+    生徒情報にない記録は含めない。
+    【修正】一定件数ずつ読み込み、チャンクごとに生徒情報の列をコンパクトな型(report_rollups.load_students と同じ)に、
+    時刻をJSTの日時に変換してから連結する（期間全体の文字列を一度に持たない）。
+    """
+    start_utc_iso = JST.localize(datetime.datetime.combine(start_date, datetime.time.min)).astimezone(UTC).isoformat()
+    end_utc_iso = JST.localize(datetime.datetime.combine(end_date, datetime.time.max)).astimezone(UTC).isoformat()
+    dtypes = report_rollups.load_students(conn).drop(columns=['system_id']).dtypes.to_dict()
+    
+    query = """
+    SELECT al.system_id, s.grade, s.class, s.student_number, s.name, al.entry_time, al.exit_time
+    FROM attendance_logs al JOIN students s ON al.system_id = s.system_id
+    WHERE al.entry_time BETWEEN ? AND ?
+    ORDER BY al.entry_time, al.id
+    """
+    chunks = pd.read_sql_query(query, conn, params=(start_utc_iso, end_utc_iso), chunksize=_read_chunk_rows())
+    return pd.concat([report_rollups.parse_log_times(chunk.astype(dtypes)) for chunk in chunks], ignore_index=True)
 
-def create_report(db_path, start_date_str, end_date_str):
+def render_report(df, students_master, start_date, end_date, file_path, progress=None):
+    """
+    【追加】期間内の全記録(入室・退室時刻はJSTの日時に変換済み、入室時刻・記録ID順)から集計レポートを作成して保存し、保存先を返す。
+    students_master はシートの行・列にする学年・組の一覧（学年・組ごとのレポートでは、その学年・組だけに絞り込んだもの）。
+    保存先のファイルが開かれている場合は、連番を付けた別名で保存する。
+    """
+    df, forgot_exit_mask = _prepare_raw_logs(df)
+    _notify_progress(progress, 0.2, 'データ前処理')
+    sheets = _sheets_from_logs(df, students_master, start_date, end_date)
+    file_path = _available_file_path(file_path)
+    _write_report_workbook(file_path, sheets, _raw_sheet_rows(df, forgot_exit_mask), start_date, end_date, progress)
+    return file_path
+
+def create_report(db_path, start_date_str, end_date_str, progress=None, use_rollups=None):
     """
     「日別サマリー」シート作成時のKeyErrorを修正。
+    【追加】progress を指定すると、各段階の完了時に progress(割合0〜1, 段階名) を呼び出す。
+    【追加】use_rollups=True の場合、滞在記録(元データ)以外のシートを集計済みテーブル(report_rollups)から作成する。
+    省略時は環境変数 REPORT_USE_ROLLUPS (既定: 1) に従う。
+    【修正】use_rollups=False の場合も、記録を一定件数ずつ読み込みながら同じ形に集計する（集計済みテーブルには書き込まない）。
     """
+    if use_rollups is None:
+        use_rollups = os.getenv('REPORT_USE_ROLLUPS', '1') == '1'
+    file_path = None
+    conn = None
     try:
         # --- 期間設定とファイルパスの準備 ---
         start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').date()
         
-        report_dir_name = os.getenv('REPORT_OUTPUT_DIR', 'logs')
-        base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '管理者用_touchable')
-        report_dir = os.path.join(base_dir, report_dir_name)
-        
-        if not os.path.exists(report_dir):
-            os.makedirs(report_dir)
-
         file_name = f"集計レポート_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx"
-        file_path = os.path.join(report_dir, file_name)
+        file_path = os.path.join(report_output_dir(), file_name)
 
         # --- データベースからデータを取得 ---
-        conn = sqlite3.connect(db_path)
-        start_utc_iso = JST.localize(datetime.datetime.combine(start_date, datetime.time.min)).astimezone(UTC).isoformat()
-        end_utc_iso = JST.localize(datetime.datetime.combine(end_date, datetime.time.max)).astimezone(UTC).isoformat()
-        
-        query = f"""
-        SELECT al.system_id, s.grade, s.class, s.student_number, s.name, al.entry_time, al.exit_time
-        FROM attendance_logs al JOIN students s ON al.system_id = s.system_id
-        WHERE al.entry_time BETWEEN '{start_utc_iso}' AND '{end_utc_iso}'
-        """
-        df = pd.read_sql_query(query, conn)
-        
+        _notify_progress(progress, 0.0, 'データ読み込み')
+        conn = sqlite3.connect(db_path, timeout=30)
         students_master = pd.read_sql_query("SELECT grade, class FROM students", conn)
-        conn.close()
 
-        if df.empty:
+        if use_rollups:
+            # 【追加】期間内で記録が変わった日付だけ集計し直してから、集計済みテーブルを読み込む
+            report_rollups.refresh_rollups(conn, start_date, end_date)
+            daily = report_rollups.load_daily(conn, start_date, end_date)
+            hourly = report_rollups.load_hourly(conn, start_date, end_date)
+        else:
+            # 【修正】期間全体の記録を1つの DataFrame に読み込まず、日付の区切りで一定件数ずつ読み込んで集計し、集計結果だけを連結する
+            daily, hourly = report_rollups.aggregate_logs(conn, start_date, end_date, _read_chunk_rows())
+        if daily.empty:
             return "No data", f"{start_date_str}から{end_date_str}の期間にデータはありませんでした。"
-        
-        # --- データ前処理 ---
-        # format='ISO8601' を追加して、様々な形式のISO8601文字列に正しく対応する
-        df['entry_time'] = pd.to_datetime(df['entry_time'], format='ISO8601', utc=True).dt.tz_convert(JST)
-        df['exit_time'] = pd.to_datetime(df['exit_time'], errors='coerce', format='ISO8601', utc=True).dt.tz_convert(JST)
-
-        completed_logs = df.dropna(subset=['exit_time']).copy()
-
-         # 先に滞在時間（分）を計算する
-        # この時点で exit_time と entry_time は日時型なので、安全に計算できる
-        completed_logs.loc[:, 'stay_minutes'] = (completed_logs['exit_time'] - completed_logs['entry_time']).dt.total_seconds() / 60
-
-        # system_id ごとに平均滞在時間を計算する
-        avg_stay_minutes_map = completed_logs.groupby('system_id')['stay_minutes'].mean().round(1)
-
-        forgot_exit_mask = df['exit_time'].isnull()
-        df['stay_minutes_imputed'] = df['system_id'].map(avg_stay_minutes_map).fillna(120)
-        
-        df['stay_minutes'] = round((df['exit_time'] - df['entry_time']).dt.total_seconds() / 60, 1)
-        df.loc[forgot_exit_mask, 'stay_minutes'] = df.loc[forgot_exit_mask, 'stay_minutes_imputed']
-        df.loc[forgot_exit_mask, 'exit_time'] = df.loc[forgot_exit_mask, 'entry_time'] + pd.to_timedelta(df.loc[forgot_exit_mask, 'stay_minutes'], unit='m')
-        
-        df['grade_jp'] = df['grade'].map(GRADE_MAP)
-        df['ID'] = 'ID_' + df['system_id'].astype(str)
-        df['stay_hours'] = round(df['stay_minutes'] / 60, 1)
-        df['date'] = df['entry_time'].dt.date # 'date'列をここで作成
-        df['day_of_week_jp'] = df['entry_time'].dt.day_name().map(DOW_MAP)
-        df['entry_hour'] = df['entry_time'].dt.hour
-        df['entry_hour_jp'] = df['entry_hour'].astype(str) + '時台'
-        
-        df = df.sort_values(by='entry_time') # 入室時間が早い順に並び替え（シート0で最初の記録を取得するために必要）
-
-        # 【追加】ファイルがロックされている（開かれている）場合に別名を生成する処理
-        base_name, ext = os.path.splitext(file_name)
-        counter = 1
-        while True:
-            try:
-                # ファイルが存在する場合のみロックチェックを行う
-                if os.path.exists(file_path):
-                    # 追記モードで開いてみることでロック状態を確認
-                    # WindowsではExcelで開いているファイルに対して PermissionError が発生する
-                    with open(file_path, 'a'):
-                        pass
-                # エラーが出なければ書き込み可能（またはファイルが存在しない）なのでループを抜ける
-                break
-            except PermissionError:
-                # ロックされている場合は連番を付与して再試行
-                logger.warning(f"ファイル {os.path.basename(file_path)} はロックされています。別名での保存を試みます。")
-                new_name = f"{base_name}_{counter}{ext}"
-                file_path = os.path.join(report_dir, new_name)
-                counter += 1
-
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-            
-            # --- シート0: 日報人数カウント用 ---
-            # (仕様変更) 日付と生徒IDで重複を削除し、その日最初の入室記録のみを対象とする
-            df_for_sheet0 = df.drop_duplicates(subset=['date', 'system_id'], keep='first')
-            df_copy_paste = df_for_sheet0.copy() # フィルター後のデータを使用
-
-            # 1. (仕様変更) IDを 'ID_23C0115' 形式に生成
-            # system_idを文字列に変換（7桁ゼロ埋め）
-            df_copy_paste['system_id_str'] = df_copy_paste['system_id'].astype(str).str.zfill(7)
-            # 学年(数値)をアルファベット(A-F)に変換
-            df_copy_paste['grade_alphabet'] = df_copy_paste['grade'].map(GRADE_ALPHABET_MAP)
-            # 結合してIDを生成: 'ID_' + '23' + 'C' + '0115'
-            # system_idの3文字目(学年)を、マッピングしたアルファベットで置き換える
-            df_copy_paste['ID_formatted'] = 'ID_' + \
-                                            df_copy_paste['system_id_str'].str[0:2] + \
-                                            df_copy_paste['grade_alphabet'] + \
-                                            df_copy_paste['system_id_str'].str[3:]
-
-            # 1-2. 中高を除いた数字のみの学年を作成
-            df_copy_paste['学年_数値'] = df_copy_paste['grade_jp'].str.extract(r'(\d+)').astype(int)
-
-            # 2. 入室時間と退室時間を HH:MM 形式にフォーマット
-            df_copy_paste['入室時間_HM'] = df_copy_paste['entry_time'].dt.strftime('%H:%M')
-            # 退室時間が空欄でない場合のみフォーマット、空欄の場合は空文字列
-            df_copy_paste['退室時間_HM'] = df_copy_paste['exit_time'].apply(lambda x: x.strftime('%H:%M') if pd.notna(x) else '')
-
-            # 3. その日の何回目の入室かを計算 (ユニーク抽出したため、すべて1になる)
-            df_copy_paste['入室回数'] = 1 # groupby処理を削除し、固定で 1 を設定
-
-            # 4. 中高の区分を作成 ( 削除)
-            # df_copy_paste['中高'] = df_copy_paste['grade_jp'].str[0] # この行を削除
-
-            # 5. 必要な列を順番通りに選択 ( ID -> ID_formatted に変更、'中高'を削除)
-            df_final_copy_paste = df_copy_paste[[
-                'ID_formatted', # 変更
-                '学年_数値',
-                'class',
-                'student_number',
-                'name',
-                '入室時間_HM',
-                '退室時間_HM',
-                '入室回数',
-                # '中高' # 削除
-            ]]
-
-            # 6. Excelに出力する際の列名（ヘッダー）を変更 
-            df_final_copy_paste.columns = [
-                'ID',
-                '学年',
-                '組',
-                '番',
-                '名前',
-                '入室時間',
-                '退室時間',
-                '回数',
-                # '中高' # 削除
-            ]
-
-            # 7. Excelファイルの一番目のシートとして書き出す
-            # (仕様変更) シート名を変更し、A1に期間、A2からデータを出力
-            sheet_name = '日報人数カウント用'
-            
-            # データをA2から書き出す (startrow=1) （仕様①）
-            df_final_copy_paste.to_excel(writer, sheet_name=sheet_name, index=False, startrow=1)
-            
-            # openpyxlのワークシートオブジェクトを取得
-            worksheet = writer.sheets[sheet_name]
-            
-            # (仕様変更) A1セルに期間を書き込む （仕様②）
-            if start_date == end_date:
-                # 単一日の場合
-                title_str = start_date.strftime('%Y/%m/%d')
-            else:
-                # 複数日の場合
-                title_str = f"{start_date.strftime('%Y/%m/%d')}～{end_date.strftime('%Y/%m/%d')}"
-            worksheet.cell(row=1, column=1, value=title_str)
-            
-            # (仕様変更) シート見出しの色を黄色に設定 （仕様③）
-            worksheet.sheet_properties.tabColor = "FFFFFF00" # ARGB for Yellow
-
-            # --- シート1: 日別ユニーク学年組別サマリー ---
-            # 存在するすべての学年・組のリストをマスターから取得
-            all_grades_jp = sorted(students_master['grade'].map(GRADE_MAP).unique(), key=lambda x: list(GRADE_MAP.values()).index(x))
-            all_classes = sorted(students_master['class'].unique())
-
-            # 1. 日付と生徒IDで重複を削除し、「日ごとのユニーク利用者」データを作成
-            df_daily_unique_users = df.drop_duplicates(subset=['date', 'system_id'])
-
-            # 2. 上記の「日ごとユニーク」データを使ってクロス集計（=延べ人数をカウント）
-            df_summary_class = pd.crosstab(df_daily_unique_users['grade_jp'], df_daily_unique_users['class'])
-            
-            # 3. 欠損している学年・組を0埋めして合計を計算
-            df_summary_class = df_summary_class.reindex(index=all_grades_jp, columns=all_classes, fill_value=0)
-            df_summary_class['合計'] = df_summary_class.sum(axis=1)
-            df_summary_class.loc['合計'] = df_summary_class.sum()
-            df_summary_class.index.name = "学年"
-            df_summary_class.columns.name = "組"
-            
-            # 4. シート名を分かりやすいように変更してExcelに出力
-            df_summary_class.to_excel(writer, sheet_name='日別ユニーク学年組別サマリー')
-            # --- シート2: 滞在記録(元データ) ---
-            df_raw = df[['ID', 'grade_jp', 'class', 'student_number', 'name', 'entry_time', 'exit_time', 
-                         'stay_minutes', 'day_of_week_jp', 'entry_hour_jp']].copy()
-            df_raw['入室日'] = df_raw['entry_time'].dt.strftime('%Y-%m-%d')
-            df_raw['入室時刻'] = df_raw['entry_time'].dt.strftime('%H:%M:%S')
-            df_raw['退室日'] = df_raw['exit_time'].dt.strftime('%Y-%m-%d')
-            df_raw['退室時刻'] = df_raw['exit_time'].dt.strftime('%H:%M:%S')
-            df_raw.loc[forgot_exit_mask, '退室時刻'] += '（推定）'
-            df_raw.rename(columns={
-                'ID': 'ID', 'grade_jp': '学年', 'class': '組', 'student_number': '番号', 'name': '氏名',
-                'stay_minutes': '滞在時間(分)', 'day_of_week_jp': '曜日', 'entry_hour_jp': '入室時間帯'
-            }, inplace=True)
-            final_columns = ['ID', '学年', '組', '番号', '氏名', '入室日', '曜日', '入室時刻', '退室日', '退室時刻', '滞在時間(分)', '入室時間帯']
-            df_raw[final_columns].to_excel(writer, sheet_name='滞在記録(元データ)', index=False)
-            
-            # --- シート3: 日別サマリー ---
-            # 1. これまで通り、日付ごとの集計と、学年ごとのクロス集計をそれぞれ作成
-            daily_agg = df.groupby('date').agg(
-                total_checkins=('system_id', 'count'),
-                unique_users=('system_id', 'nunique'),
-                avg_stay_minutes=('stay_minutes', 'mean')
-            ).round(1)
-
-            daily_grade_pivot = pd.crosstab(df['date'], df['grade_jp'], values=df['system_id'], aggfunc='nunique')
-            
-            # 2. 2つの集計結果を一度結合し、列にすべての学年が含まれるように保証する
-            df_daily = pd.concat([daily_agg, daily_grade_pivot], axis=1)
-            # (all_grades_jpはシート1作成時に定義済み)
-            df_daily = df_daily.reindex(columns=daily_agg.columns.tolist() + all_grades_jp)
-
-            all_dates_index = pd.to_datetime(pd.date_range(start=start_date, end=end_date)).date
-            df_daily = df_daily.reindex(all_dates_index)
-
-            # 4. 記録がなくてNaN(空欄)になったセルを0で埋める
-            df_daily.fillna(0, inplace=True)
-            
-            # 5. 空だった行の曜日を、日付インデックスから再生成して埋める
-            df_daily['day_of_week_jp'] = pd.to_datetime(df_daily.index).to_series().dt.day_name().map(DOW_MAP)
-
-            # 6. カラムのデータ型（整数）と最終的な順序を整える
-            count_cols = ['total_checkins', 'unique_users'] + all_grades_jp
-            df_daily[count_cols] = df_daily[count_cols].astype(int)
-            final_columns_daily = ['day_of_week_jp'] + count_cols + ['avg_stay_minutes']
-            df_daily = df_daily[final_columns_daily]
-
-            # 7. カラム名を日本語にリネームしてExcelに出力
-            df_daily.rename(columns={
-                'day_of_week_jp':'曜日', 'total_checkins':'総入室回数', 
-                'unique_users':'ユニーク入室者数', 'avg_stay_minutes':'平均滞在時間(分)'
-            }, inplace=True)
-            df_daily.index.name = '日付'
-            df_daily.to_excel(writer, sheet_name='日別サマリー')
-
-            # --- シート4: 利用者別サマリー ---
-            # 1. ログデータからユニークな日付の数を数え、「開室日数」を算出する
-            total_open_days = df['date'].nunique()
-            # 2. 「開室日数」を基に週数を計算する（7日未満は1週間とみなす）
-            num_weeks = total_open_days / 7 if total_open_days >= 7 else 1
-            df_daily_unique_users = df.drop_duplicates(subset=['date', 'system_id'])
-            df_user_summary = df.groupby(['grade_jp', 'class', 'student_number', 'name', 'system_id']).agg(
-                total_checkins=('system_id', 'count'),
-                unique_days_attended=('date', 'nunique'),
-                total_stay_minutes=('stay_minutes', 'sum'),
-                avg_stay_minutes=('stay_minutes', 'mean'),
-                most_used_dow=('day_of_week_jp', lambda x: x.mode()[0]),
-                first_use_date=('date', 'min'),
-                most_used_hour=('entry_hour_jp', lambda x: x.mode()[0])
-            ).reset_index()
-             # 曜日ごとの利用日数を集計
-            dow_counts = pd.crosstab(df_daily_unique_users['system_id'], df_daily_unique_users['day_of_week_jp'])
-            
-            # 月〜日のカラム順に並び替え
-            dow_order = ['月', '火', '水', '木', '金', '土', '日']
-            dow_counts = dow_counts.reindex(columns=dow_order, fill_value=0)
-
-            # 曜日ごとの集計結果をメインのサマリーに結合
-            df_user_summary = pd.merge(df_user_summary, dow_counts, on='system_id', how='left')
-            
-            #結合によって発生したNaN(欠損値)を0で埋め、データ型を整数に変換する
-            df_user_summary[dow_order] = df_user_summary[dow_order].fillna(0).astype(int)
-            # 結合後に不要になったsystem_id列を削除
-            df_user_summary.drop(columns=['system_id'], inplace=True)
-            df_user_summary['weekly_avg_checkins'] = round(df_user_summary['unique_days_attended'] / num_weeks, 1)
-            df_user_summary.rename(columns={
-                'grade_jp': '学年', 'class': '組', 'student_number': '番号', 'name': '氏名',
-                'total_checkins': '総利用回数', 'unique_days_attended': '利用日数', # '利用日数' を追加
-                'total_stay_minutes': '総滞在時間(分)', # '総滞在時間(分)' に変更
-                'avg_stay_minutes': '平均滞在時間(分)', 'most_used_dow': '最多利用曜日',
-                'weekly_avg_checkins': '週平均利用回数', 'first_use_date': '初回利用日', 'most_used_hour': '最多入室時間帯'
-            }, inplace=True)
-            
-            # 最終的に出力する列のリストを定義し直す
-            final_user_summary_columns = [
-                '学年', '組', '番号', '氏名', 
-                '総利用回数', '利用日数', '週平均利用回数', 
-                '総滞在時間(分)', '平均滞在時間(分)', 
-                '最多利用曜日', '月', '火', '水', '木', '金', '土', '日',
-                '最多入室時間帯', '初回利用日'
-            ]
-            df_user_summary = df_user_summary[final_user_summary_columns]
-            
-            df_user_summary.to_excel(writer, sheet_name='利用者別サマリー', index=False)
-            
-            # --- シート5: 時間帯別総入室回数サマリー ---
-            hourly_pivot = pd.crosstab(df['entry_hour_jp'], df['grade_jp']).reindex(columns=all_grades_jp, fill_value=0)
-            all_hours_jp = [f"{h}時台" for h in range(24)]
-            hourly_pivot = hourly_pivot.reindex(index=all_hours_jp, fill_value=0)
-            hourly_pivot['合計'] = hourly_pivot.sum(axis=1)
-            hourly_pivot.loc['合計'] = hourly_pivot.sum()
-            hourly_pivot.index.name = '時間帯'
-            hourly_pivot.to_excel(writer, sheet_name='時間帯別総入室回数サマリー')
-
-            # --- シート6: 時間帯別在室人数サマリー ---
-            # 各滞在がカバーする時間帯（日時）のリストを生成
-            def get_hour_timestamps(row):
-                start = row['entry_time'].floor('h')
-                # 退室時間がジャスト(例: 10:00:00)の場合は、その時間帯(10時台)には在室していないとみなすため1秒引く
-                end = (row['exit_time'] - pd.Timedelta(seconds=1)).floor('h')
-                # startからendまでの1時間ごとの「日時そのもの」を取得（日付情報を保持するため）
-                return pd.date_range(start, end, freq='h').tolist()
-
-            # データフレームに各利用者の在室時間帯（日時）リストを追加
-            df_occupancy = df[['grade_jp', 'system_id']].copy()
-            df_occupancy['timestamps'] = df.apply(get_hour_timestamps, axis=1)
-            
-            # リストを行に展開（1人の滞在を複数の時間帯行に分割）
-            df_exploded = df_occupancy.explode('timestamps')
-            df_exploded = df_exploded.dropna(subset=['timestamps'])
-
-            # 日付と時間を抽出
-            df_exploded['date_val'] = df_exploded['timestamps'].dt.date
-            df_exploded['hour_val'] = df_exploded['timestamps'].dt.hour
-            df_exploded['hour_str'] = df_exploded['hour_val'].astype(str) + '時台'
-
-            #「同じ日」かつ「同じ時間帯」かつ「同じ人」の場合のみ重複として削除する
-            # これにより、「別の日」の「同じ時間帯」の利用は維持される（例: 月曜10時と火曜10時は別カウント）
-            df_exploded = df_exploded.drop_duplicates(subset=['date_val', 'hour_str', 'system_id'])
-            
-            # 時間帯(0-23時) × 学年 でクロス集計（人数カウント）
-            # ここで集計されるのは「期間中の全日程における、その時間帯の在室人数の延べ合計」となる
-            occupancy_pivot = pd.crosstab(df_exploded['hour_str'], df_exploded['grade_jp'])
-            
-            # 全時間帯・全学年の枠を確保して埋める
-            occupancy_pivot = occupancy_pivot.reindex(index=all_hours_jp, columns=all_grades_jp, fill_value=0)
-            
-            # 合計列・行の計算
-            # 横方向（その時間帯の全学年合計）は意味があるため残す
-            occupancy_pivot['合計'] = occupancy_pivot.sum(axis=1)
-            
-            # 縦方向（列の合計）は、時間をまたぐ同一人物が重複加算され、
-            # 「延べ積算人数」のような直感的でない値になるため計算しない
-            # occupancy_pivot.loc['合計'] = occupancy_pivot.sum()
-            
-            occupancy_pivot.index.name = '時間帯'
-            occupancy_pivot.to_excel(writer, sheet_name='時間帯別在室人数サマリー')
+        extra_logs = report_rollups.load_logs_for_occupancy(conn, start_date, end_date,
+                                                            include_long_stays=bool(daily['occupancy_overflow'].any()))
+        _notify_progress(progress, 0.2, 'データ前処理')
+        sheets, avg_stay_minutes_map = _sheets_from_rollups(daily, hourly, extra_logs, students_master, start_date, end_date)
+        # 滞在記録(元データ)シートだけは記録そのものを、書き出しながら一定件数ずつ読み込む
+        raw_rows = _raw_sheet_rows_from_db(conn, start_date, end_date, avg_stay_minutes_map)
+        file_path = _available_file_path(file_path)
+        _write_report_workbook(file_path, sheets, raw_rows, start_date, end_date, progress)
 
         # --- 追加: 2つ目の指定パスへのコピー処理 ---
         secondary_dir = r"C:\Users\kober\OneDrive\デスクトップ\01　日々の業務（日報、質問ログ、入退さん）\入退さん\カード忘れ_iPad"
@@ -372,9 +707,45 @@ def create_report(db_path, start_date_str, end_date_str):
         except Exception as copy_e:
             logger.warning(f"2つ目のパスへのコピーに失敗しました: {copy_e}")
 
+        _notify_progress(progress, 1.0, '完了')
         return file_path, f"レポートが正常に作成されました: {os.path.basename(file_path)}"
-        
+
+    except ReportCancelled:
+        # ファイルは最後にまとめて保存するため、中止した場合は不完全なファイルも残らない（既存のファイルもそのまま）
+        raise
     except Exception as e:
         error_message = f"レポート作成中にエラーが発生しました。該当期間のExcelファイルが開かれていないかを確認してください: {e}"
         logger.error(error_message, exc_info=True)
-        return None, error_message
\ No newline at end of file
+        return None, error_message
+    finally:
+        if conn is not None:
+            conn.close()
+
+def summarize_archive(db_path, start_date_str, end_date_str, archive_dir=None):
+    """
+    【追加】列指向アーカイブ(attendance_archive)の記録から、滞在記録(元データ)以外のシートの表を作り、シート名をキーとする辞書で返す。
+    SQLite の記録を読み込み直さないため、年単位の期間の集計・分析に使う。アーカイブは前日までの記録が対象。
+    期間内にデータがない場合は空の辞書を返し、アーカイブが未作成の場合は FileNotFoundError を送出する。
+    """
+    start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').date()
+    end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    archived_until = attendance_archive.archived_until(archive_dir)
+    if archived_until is None:
+        # 【修正】アーカイブ未作成のまま集計しない（attendance_archive.export_archive で先に書き出す）
+        raise FileNotFoundError("アーカイブがまだ作成されていません。先に attendance_archive.py で書き出してください。")
+    if end_date >= archived_until:
+        logger.warning(f"アーカイブは {archived_until} より前の記録のみを含みます。期間の最後の記録は集計に含まれません。")
+
+    # 生徒情報にない記録は含めない（DBから作成する場合の JOIN と同じ）
+    df = attendance_archive.load_logs(start_date, end_date, archive_dir=archive_dir,
+                                      columns=['system_id', 'grade', 'class', 'student_number', 'name', 'entry_time', 'exit_time'],
+                                      filters=[('grade', 'in', list(GRADE_MAP))])
+    if df.empty:
+        return {}
+    df, _ = _prepare_raw_logs(df)
+    conn = sqlite3.connect(db_path)
+    try:
+        students_master = pd.read_sql_query("SELECT grade, class FROM students", conn)
+    finally:
+        conn.close()
+    return _sheets_from_logs(df, students_master, start_date, end_date)
@@ -0,0 +1,425 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import datetime
+import threading
+import subprocess
+from collections import deque
+
+import database
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ('done', 'no_data', 'error', 'cancelled')
+# 担当プロセスからの生存通知がこの秒数途絶えたジョブは、中断されたものとみなす
+STALE_SECONDS = 60
+# レポートの内容・書式を変更した場合はこの値を上げ、作成済みレポートの再利用を無効にする
+REPORT_CACHE_FORMAT = 1
+
+
+class ReportQueueFull(Exception):
+    """待機中のレポート作成ジョブが上限に達している場合に送出される。"""
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _now_str():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def get_job(db_path, job_id):
+    conn = _connect(db_path)
+    try:
+        row = conn.execute('SELECT * FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+        return _to_dict(row) if row else None
+    finally:
+        conn.close()
+
+def list_jobs(db_path, limit=20):
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute('SELECT * FROM report_jobs ORDER BY created_at DESC, rowid DESC LIMIT ?', (limit,)).fetchall()
+        return [_to_dict(row) for row in rows]
+    finally:
+        conn.close()
+
+def _to_dict(row):
+    job = dict(row)
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    job['file_name'] = os.path.basename(job['file_path']) if job['file_path'] else None
+    job['batch_spec'] = json.loads(job['batch_spec']) if job.get('batch_spec') else None
+    job.pop('updated_at', None)
+    return job
+
+
+# --- 作成済みレポートの再利用 ---
+def _cache_key(start_date, end_date, options):
+    return json.dumps([REPORT_CACHE_FORMAT, start_date, end_date, options or {}], sort_keys=True, ensure_ascii=False)
+
+def _data_fingerprint(conn, start_date, end_date):
+    """対象期間の記録と名簿のバージョン。どちらかが変われば作成済みのレポートは使えない。"""
+    return database.get_range_data_version(conn, start_date, end_date), database.get_roster_version(conn)
+
+def find_cached_report(db_path, start_date, end_date, options=None):
+    """
+    同じ期間・条件で作成済みのレポートが、その後データが変わっておらずファイルもそのまま残っていれば
+    (file_path, message) を返す。使えない場合は None。
+    """
+    conn = _connect(db_path)
+    try:
+        row = conn.execute('SELECT * FROM report_cache WHERE cache_key = ?', (_cache_key(start_date, end_date, options),)).fetchone()
+        if row is None:
+            return None
+        if (row['data_version'], row['roster_version']) != _data_fingerprint(conn, start_date, end_date):
+            return None
+    finally:
+        conn.close()
+    try:
+        stat = os.stat(row['file_path'])
+    except OSError:
+        return None
+    # 作成後にファイルが開かれて上書き保存された場合なども作り直す
+    if stat.st_size != row['file_size'] or stat.st_mtime != row['file_mtime']:
+        return None
+    return row['file_path'], row['message']
+
+def _store_cached_report(conn, start_date, end_date, options, fingerprint, file_path, message):
+    stat = os.stat(file_path)
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO report_cache (cache_key, data_version, roster_version, file_path, file_mtime, file_size, message)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (_cache_key(start_date, end_date, options), fingerprint[0], fingerprint[1],
+              file_path, stat.st_mtime, stat.st_size, message))
+
+
+class ReportJobManager:
+    """
+    集計レポートをバックグラウンドで作成するジョブ管理。
+    - 作成処理は別プロセス（このファイルをスクリプトとして起動）で行い、Webサーバーのスレッド・GILを占有しない
+      (ProcessPoolExecutor は Windows では app.py 自体を子プロセスで読み込み直してしまうため使わない)
+    - 同時に実行するジョブは max_workers 件まで（全ワーカープロセスで共通。DB上の実行中の件数で判定する）
+    - 待機できるジョブは max_queued 件まで
+    - 進捗・結果は子プロセスが report_jobs テーブルに書き込むため、どのプロセスからでも参照できる
+    - 中止は report_jobs の中止フラグで伝え、子プロセスは各段階の区切りで確認して中止する
+    - 同じ期間のレポートが作成済みで、その後対象期間の記録が変わっていなければ、作成せずに既存のファイルを返す
+    on_finished(job) はジョブの終了時（完了・データなし・失敗・中止）に呼ばれる。
+    """
+    def __init__(self, db_path, max_workers=1, max_queued=10, on_finished=None, poll_interval=2.0):
+        self.db_path = os.path.abspath(db_path)
+        self.max_workers = max(1, max_workers)
+        self.max_queued = max_queued
+        self.on_finished = on_finished
+        self.poll_interval = poll_interval
+        self._queue = deque()
+        self._running = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """管理スレッドを起動する（前回の停止で中断されたジョブの後始末もここで行われる）。"""
+        with self._cond:
+            self._ensure_thread()
+        return self
+
+    # --- 受付・中止 ---
+    def submit(self, start_date, end_date, requested_by=None, force=False):
+        """
+        ジョブを登録して待機列に積み、登録したジョブを返す。
+        作成済みのレポートを再利用できる場合は、完了済みのジョブとして登録してすぐに返す（force=True で作り直す）。
+        """
+        cached = None if force else find_cached_report(self.db_path, start_date, end_date)
+        if cached:
+            return self._complete_from_cache(start_date, end_date, requested_by, *cached)
+        return self._enqueue(start_date, end_date, requested_by)
+
+    def submit_batch(self, items, requested_by=None):
+        """
+        【追加】一括作成のジョブ(report_batch)を登録して待機列に積み、登録したジョブを返す。
+        items は report_batch.expand_items で作成したレポートの一覧。ジョブの期間は全レポートを含む期間になる。
+        """
+        start_date = min(item['start_date'] for item in items)
+        end_date = max(item['end_date'] for item in items)
+        return self._enqueue(start_date, end_date, requested_by, batch_spec=json.dumps(items, ensure_ascii=False))
+
+    def _enqueue(self, start_date, end_date, requested_by, batch_spec=None):
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                raise ReportQueueFull()
+            job_id = uuid.uuid4().hex
+            conn = _connect(self.db_path)
+            try:
+                with conn:
+                    conn.execute('''
+                        INSERT INTO report_jobs (id, start_date, end_date, status, stage, requested_by, updated_at, batch_spec)
+                        VALUES (?, ?, ?, 'queued', '待機中', ?, ?, ?)
+                    ''', (job_id, start_date, end_date, requested_by, time.time(), batch_spec))
+            finally:
+                conn.close()
+            self._queue.append(job_id)
+            self._ensure_thread()
+            self._cond.notify()
+        return get_job(self.db_path, job_id)
+
+    def _complete_from_cache(self, start_date, end_date, requested_by, file_path, message):
+        job_id = uuid.uuid4().hex
+        conn = _connect(self.db_path)
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT INTO report_jobs (id, start_date, end_date, status, progress, stage, message, file_path,
+                                             requested_by, started_at, finished_at, updated_at)
+                    VALUES (?, ?, ?, 'done', 1, '完了', ?, ?, ?, ?, ?, ?)
+                ''', (job_id, start_date, end_date, f'前回作成時からデータに変更がないため、作成済みのレポートを使用します。{message or ""}',
+                      file_path, requested_by, _now_str(), _now_str(), time.time()))
+        finally:
+            conn.close()
+        logger.info(f"[操作ログ] 作成済みの集計レポートを再利用しました - 期間: {start_date} ～ {end_date}, ファイル: {os.path.basename(file_path)}")
+        self._finished(job_id)
+        return get_job(self.db_path, job_id)
+
+    def cancel(self, job_id):
+        """
+        ジョブの中止を要求し、更新後のジョブを返す（存在しない場合は None）。
+        待機中のジョブはその場で中止し、実行中のジョブは子プロセスが次の区切りで中止する。
+        """
+        conn = _connect(self.db_path)
+        try:
+            with conn:
+                conn.execute('UPDATE report_jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)',
+                             (job_id, 'queued', 'running'))
+                cursor = conn.execute('''
+                    UPDATE report_jobs SET status = 'cancelled', stage = '中止', message = ?, finished_at = ?
+                    WHERE id = ? AND status = 'queued'
+                ''', ('レポート作成を中止しました。', _now_str(), job_id))
+                cancelled_while_queued = cursor.rowcount > 0
+        finally:
+            conn.close()
+        if cancelled_while_queued:
+            with self._cond:
+                if job_id in self._queue:
+                    self._queue.remove(job_id)
+            self._finished(job_id)
+        return get_job(self.db_path, job_id)
+
+    # --- 実行管理 ---
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='report-job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            with self._cond:
+                self._cond.wait(self.poll_interval)
+            try:
+                self._heartbeat_and_expire()
+                self._dispatch()
+            except Exception as e:
+                logger.error(f"[システムログ] レポート作成ジョブの管理処理でエラーが発生しました: {e}", exc_info=True)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                if not self._queue:
+                    return
+                job_id = self._queue[0]
+            claimed = self._claim(job_id)
+            if claimed is None:
+                # 全プロセスで実行中のジョブが上限に達しているため、次の確認まで待つ
+                return
+            with self._cond:
+                if job_id in self._queue:
+                    self._queue.remove(job_id)
+            if claimed:
+                self._start_worker(job_id)
+
+    def _claim(self, job_id):
+        """
+        実行枠が空いていればジョブを実行中にする。
+        実行できた場合は True、既に中止済みなどで実行不要な場合は False、枠が空いていない場合は None を返す。
+        """
+        conn = _connect(self.db_path)
+        try:
+            with conn:
+                # 件数の確認と更新を1文で行い、複数のプロセスが同時に枠を取り合っても上限を超えないようにする
+                cursor = conn.execute('''
+                    UPDATE report_jobs SET status = 'running', stage = '開始', started_at = ?, updated_at = ?
+                    WHERE id = ? AND status = 'queued'
+                    AND (SELECT COUNT(*) FROM report_jobs WHERE status = 'running') < ?
+                ''', (_now_str(), time.time(), job_id, self.max_workers))
+                if cursor.rowcount:
+                    return True
+                status = conn.execute('SELECT status FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+                return None if status and status['status'] == 'queued' else False
+        finally:
+            conn.close()
+
+    def _start_worker(self, job_id):
+        logger.info(f"[操作ログ] 集計レポート作成ジョブを開始しました - ジョブID: {job_id}")
+        try:
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.db_path, job_id],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        except OSError as e:
+            _finish_job(self.db_path, job_id, 'error', f'レポート作成プロセスを起動できませんでした: {e}')
+            self._finished(job_id)
+            return
+        with self._cond:
+            self._running[job_id] = process
+        threading.Thread(target=self._wait_worker, args=(job_id, process), name=f'report-job-{job_id[:8]}', daemon=True).start()
+
+    def _wait_worker(self, job_id, process):
+        returncode = process.wait()
+        with self._cond:
+            self._running.pop(job_id, None)
+            self._cond.notify()
+        job = get_job(self.db_path, job_id)
+        if job and job['status'] == 'running':
+            # 子プロセスが結果を書き込まずに終了した（強制終了など）
+            _finish_job(self.db_path, job_id, 'error', f'レポート作成プロセスが異常終了しました (終了コード: {returncode})')
+        self._finished(job_id)
+
+    def _finished(self, job_id):
+        job = get_job(self.db_path, job_id)
+        logger.info(f"[操作ログ] 集計レポート作成ジョブが終了しました - ジョブID: {job_id}, 状態: {job['status'] if job else '不明'}")
+        if job and self.on_finished:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                logger.error(f"[通信ログ] レポート作成ジョブの終了通知に失敗しました: {e}", exc_info=True)
+
+    def _heartbeat_and_expire(self):
+        """担当しているジョブの生存通知を更新し、担当プロセスが停止したジョブを中断扱いにする。"""
+        with self._cond:
+            own_jobs = list(self._queue) + list(self._running)
+        now = time.time()
+        conn = _connect(self.db_path)
+        try:
+            with conn:
+                if own_jobs:
+                    placeholders = ','.join('?' * len(own_jobs))
+                    conn.execute(f'UPDATE report_jobs SET updated_at = ? WHERE id IN ({placeholders})', [now] + own_jobs)
+                expired = [row['id'] for row in conn.execute('''
+                    SELECT id FROM report_jobs WHERE status IN ('queued', 'running') AND updated_at < ?
+                ''', (now - STALE_SECONDS,))]
+                for job_id in expired:
+                    conn.execute('''
+                        UPDATE report_jobs SET status = 'error', stage = '中断', message = ?, finished_at = ?
+                        WHERE id = ?
+                    ''', ('サーバーの停止によりレポート作成が中断されました。', _now_str(), job_id))
+        finally:
+            conn.close()
+
+    def stop(self):
+        """サーバー停止時に、実行中の子プロセスを終了させる。"""
+        self._stopped = True
+        with self._cond:
+            processes = list(self._running.values())
+            self._cond.notify()
+        for process in processes:
+            process.terminate()
+
+    def stats(self):
+        with self._cond:
+            return {'report_jobs_queued': len(self._queue), 'report_jobs_running': len(self._running),
+                    'report_max_workers': self.max_workers}
+
+
+def _finish_job(db_path, job_id, status, message, file_path=None):
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute('''
+                UPDATE report_jobs SET status = ?, message = ?, file_path = ?, finished_at = ?, updated_at = ?,
+                progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END,
+                stage = CASE ? WHEN 'done' THEN '完了' WHEN 'no_data' THEN 'データなし' WHEN 'cancelled' THEN '中止' ELSE '失敗' END
+                WHERE id = ?
+            ''', (status, message, file_path, _now_str(), time.time(), status, status, job_id))
+    finally:
+        conn.close()
+
+
+# --- 子プロセス側の処理 ---
+def run_job(db_path, job_id):
+    """1件のジョブを実行し、進捗と結果を report_jobs に書き込む（子プロセスで呼ばれる）。"""
+    from report_generator import create_report, ReportCancelled
+
+    job = get_job(db_path, job_id)
+    if job is None or job['status'] != 'running':
+        return
+
+    def progress(fraction, stage):
+        conn = _connect(db_path)
+        try:
+            with conn:
+                conn.execute('UPDATE report_jobs SET progress = ?, stage = ?, updated_at = ? WHERE id = ?',
+                             (round(fraction, 2), stage, time.time(), job_id))
+                row = conn.execute('SELECT cancel_requested FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row and row['cancel_requested']:
+            raise ReportCancelled()
+
+    if job['batch_spec']:
+        _run_batch_job(db_path, job_id, job['batch_spec'], progress)
+        return
+
+    # 作成開始前のデータバージョンを控える（作成中に記録が変わった場合は、次回の依頼で作り直される）
+    conn = _connect(db_path)
+    try:
+        fingerprint = _data_fingerprint(conn, job['start_date'], job['end_date'])
+    finally:
+        conn.close()
+
+    try:
+        file_path, message = create_report(db_path, job['start_date'], job['end_date'], progress=progress)
+    except ReportCancelled:
+        _finish_job(db_path, job_id, 'cancelled', 'レポート作成を中止しました。')
+        return
+    if file_path == "No data":
+        _finish_job(db_path, job_id, 'no_data', message)
+    elif file_path:
+        conn = _connect(db_path)
+        try:
+            _store_cached_report(conn, job['start_date'], job['end_date'], None, fingerprint, file_path, message)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"[システムログ] 作成したレポートを再利用の対象に登録できませんでした: {e}")
+        finally:
+            conn.close()
+        _finish_job(db_path, job_id, 'done', message, file_path)
+    else:
+        _finish_job(db_path, job_id, 'error', message)
+
+def _run_batch_job(db_path, job_id, items, progress):
+    """一括作成のジョブを実行する。作成したファイルと manifest.json をまとめたZIPファイルをダウンロード対象にする。"""
+    import report_batch
+    from report_generator import ReportCancelled
+
+    try:
+        manifest_path, manifest = report_batch.run_batch(db_path, items, progress=progress)
+        file_path = report_batch.archive_batch(manifest_path)
+    except ReportCancelled:
+        _finish_job(db_path, job_id, 'cancelled', 'レポートの一括作成を中止しました。')
+        return
+    except Exception as e:
+        logger.error(f"[システムログ] レポートの一括作成に失敗しました: {e}", exc_info=True)
+        _finish_job(db_path, job_id, 'error', f'レポートの一括作成中にエラーが発生しました: {e}')
+        return
+    statuses = {report['status'] for report in manifest['reports']}
+    if statuses == {'no_data'}:
+        _finish_job(db_path, job_id, 'no_data', '指定された期間・学年・組のデータはありませんでした。')
+    else:
+        _finish_job(db_path, job_id, 'done', report_batch.summarize(manifest), file_path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_job(sys.argv[1], sys.argv[2])
@@ -0,0 +1,302 @@
+import logging
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+logger = logging.getLogger(__name__)
+
+JST = pytz.timezone('Asia/Tokyo')
+UTC = pytz.utc
+HOUR_NS = 3600 * 10**9
+# 在室時間帯のビット列が表す範囲（入室日の0時から48時間 = 入室日と翌日）。これを超える滞在は元データから集計する
+OCCUPANCY_HOURS = 48
+# 1回のトランザクションで作り直す日数（入退室の書き込みを長く待たせないため）
+REFRESH_BATCH_DAYS = 31
+
+
+def expand_hours(start_hour, end_hour):
+    """
+    区間 [start_hour, end_hour] (時間単位の通し番号) を1時間ずつに展開し、(元の行番号, 時間) の配列を返す。
+    end_hour < start_hour の区間(入室より前の退室など)は展開しない。
+    """
+    repeats = np.clip(end_hour - start_hour + 1, 0, None)
+    rows = np.repeat(np.arange(len(start_hour)), repeats)
+    offsets = np.arange(rows.size) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    return rows, start_hour[rows] + offsets
+
+def stay_hour_range(entry_time, exit_time):
+    """
+    入室・退室時刻(JST)から、在室した時間帯の通し番号(1970-01-01 0時からの時間数)の区間を返す。
+    退室時間がジャスト(例: 10:00:00)の場合は、その時間帯(10時台)には在室していないとみなす。
+    """
+    # JSTの壁時計時刻をナノ秒の整数にする（JSTは夏時間がないため、時間単位の切り捨てがそのまま使える）
+    entry_ns = entry_time.dt.tz_localize(None).to_numpy('datetime64[ns]').view('int64')
+    exit_ns = exit_time.dt.tz_localize(None).to_numpy('datetime64[ns]').view('int64')
+    return entry_ns // HOUR_NS, (exit_ns - 10**9) // HOUR_NS
+
+def expand_occupancy_masks(days, masks):
+    """日付×生徒 の在室時間帯のビット列を展開し、(元の行番号, 時間帯の通し番号) の配列を返す。"""
+    bits = (masks[:, None] >> np.arange(OCCUPANCY_HOURS)) & 1
+    rows, offsets = np.nonzero(bits)
+    return rows, day_start_hour(days[rows]) + offsets
+
+def day_start_hour(days):
+    """'YYYY-MM-DD' の日付の0時を、時間帯の通し番号で返す。"""
+    return pd.to_datetime(days).to_numpy('datetime64[D]').astype('int64') * 24
+
+def parse_log_times(df):
+    """DBの入室・退室時刻(UTCのISO8601文字列)をJSTの日時に変換する。"""
+    # format='ISO8601' を指定して、様々な形式のISO8601文字列に正しく対応する
+    df['entry_time'] = pd.to_datetime(df['entry_time'], format='ISO8601', utc=True).dt.tz_convert(JST)
+    df['exit_time'] = pd.to_datetime(df['exit_time'], errors='coerce', format='ISO8601', utc=True).dt.tz_convert(JST)
+    return df
+
+def _jst_day_bounds(start_day, end_day):
+    start = JST.localize(datetime.datetime.combine(start_day, datetime.time.min)).astimezone(UTC).isoformat()
+    end = JST.localize(datetime.datetime.combine(end_day, datetime.time.max)).astimezone(UTC).isoformat()
+    return start, end
+
+
+# --- 集計済みテーブルの更新 ---
+def refresh_rollups(conn, start_date, end_date):
+    """
+    期間内の日付のうち、前回の集計以降に記録が変わった日付(または未集計の日付)の集計を作り直し、作り直した日数を返す。
+    記録の変更は attendance_day_versions (attendance_logs のトリガーで更新) で判定するため、
+    どの経路で書き込まれた変更も取りこぼさない。
+    """
+    days = [d.strftime('%Y-%m-%d') for d in pd.date_range(start_date, end_date)]
+    if not days:
+        return 0
+    stale = _stale_days(conn, days[0], days[-1], days)
+    for i in range(0, len(stale), REFRESH_BATCH_DAYS):
+        _rebuild_days(conn, stale[i:i + REFRESH_BATCH_DAYS])
+    if stale:
+        logger.info(f"[システムログ] レポート用の集計を更新しました - {len(stale)} 日分 ({stale[0]} ～ {stale[-1]})")
+    return len(stale)
+
+def refresh_all_rollups(conn):
+    """記録のある最初の日から今日までの集計を最新にする（夜間の定期ジョブ用）。"""
+    row = conn.execute('SELECT MIN(entry_time) FROM attendance_logs').fetchone()
+    if not row or not row[0]:
+        return 0
+    first_day = pd.Timestamp(row[0]).tz_convert(JST).date()
+    return refresh_rollups(conn, first_day, datetime.datetime.now(JST).date())
+
+def _stale_days(conn, first_day, last_day, days):
+    versions = dict(conn.execute('SELECT day, version FROM attendance_day_versions WHERE day BETWEEN ? AND ?',
+                                 (first_day, last_day)).fetchall())
+    built = dict(conn.execute('SELECT day, version FROM report_rollup_days WHERE day BETWEEN ? AND ?',
+                              (first_day, last_day)).fetchall())
+    return [day for day in days if built.get(day) != versions.get(day, 0)]
+
+def _rebuild_days(conn, days):
+    # 読み取りから書き込みまでを1つの書き込みトランザクションで行い、途中の変更を取りこぼさない
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        days = _stale_days(conn, days[0], days[-1], days)
+        if not days:
+            conn.rollback()
+            return
+        versions = dict(conn.execute('SELECT day, version FROM attendance_day_versions WHERE day BETWEEN ? AND ?',
+                                     (days[0], days[-1])).fetchall())
+        start_iso, end_iso = _jst_day_bounds(datetime.date.fromisoformat(days[0]), datetime.date.fromisoformat(days[-1]))
+        logs = pd.read_sql_query('''
+            SELECT id, system_id, entry_time, exit_time FROM attendance_logs
+            WHERE entry_time BETWEEN ? AND ? ORDER BY entry_time, id
+        ''', conn, params=(start_iso, end_iso))
+        logs = _with_log_days(logs)
+        logs = logs[logs['day'].isin(days)]
+        daily, hourly = _build_rollups(logs)
+
+        placeholders = ','.join('?' * len(days))
+        conn.execute(f'DELETE FROM report_daily_rollup WHERE day IN ({placeholders})', days)
+        conn.execute(f'DELETE FROM report_hourly_rollup WHERE day IN ({placeholders})', days)
+        conn.executemany('''
+            INSERT INTO report_daily_rollup (day, system_id, checkins, completed, stay_minutes, stay_minutes_raw,
+                first_log_id, first_entry_time, first_exit_time, occupied_hours, occupancy_overflow)
+            VALUES (:day, :system_id, :checkins, :completed, :stay_minutes, :stay_minutes_raw,
+                :first_log_id, :first_entry_time, :first_exit_time, :occupied_hours, :occupancy_overflow)
+        ''', _records(daily))
+        conn.executemany('INSERT INTO report_hourly_rollup (day, system_id, hour, checkins) VALUES (:day, :system_id, :hour, :checkins)',
+                         _records(hourly))
+        conn.executemany('INSERT OR REPLACE INTO report_rollup_days (day, version) VALUES (?, ?)',
+                         [(day, versions.get(day, 0)) for day in days])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def _with_log_days(logs):
+    # _build_rollups に渡す形にする（DBの時刻文字列を残したまま時刻をJSTに変換し、入室日の列を追加する）
+    logs['entry_raw'], logs['exit_raw'] = logs['entry_time'], logs['exit_time']
+    parse_log_times(logs)
+    logs['day'] = logs['entry_time'].dt.strftime('%Y-%m-%d')
+    return logs
+
+def _records(frame):
+    # sqlite3 は NumPy の数値型を扱えないため、Pythonの値に変換して渡す
+    return ({key: (value.item() if isinstance(value, np.generic) else value) for key, value in row.items()}
+            for row in frame.to_dict('records'))
+
+def _build_rollups(logs):
+    """
+    記録を 日付×生徒 と 日付×生徒×入室時間帯 に集計する。
+    滞在時間・在室時間帯は退室済みの記録だけを集計する（未退室の記録の推定はレポートの期間に依存するため）。
+    logs には DB の時刻文字列(entry_raw, exit_raw)と、JSTに変換した時刻(entry_time, exit_time)が必要。
+    """
+    # 同時刻の記録は記録ID順とする（読み込み順を保つ安定ソート）
+    logs = logs.sort_values(by='entry_time', kind='stable')
+    completed = logs['exit_time'].notna()
+    stay_raw = (logs['exit_time'] - logs['entry_time']).dt.total_seconds() / 60
+    logs = logs.assign(
+        completed=completed.astype(int),
+        stay_minutes_raw=stay_raw.where(completed, 0.0),
+        # レポートと同じく、記録ごとに小数第1位で丸めてから合計する
+        stay_minutes=round(stay_raw, 1).where(completed, 0.0),
+    )
+    daily = logs.groupby(['day', 'system_id']).agg(
+        checkins=('system_id', 'size'),
+        completed=('completed', 'sum'),
+        stay_minutes=('stay_minutes', 'sum'),
+        stay_minutes_raw=('stay_minutes_raw', 'sum'),
+    )
+    # その日最初の記録の入室・退室時刻（日報人数カウント用シートに使う）
+    first = logs.drop_duplicates(subset=['day', 'system_id']).set_index(['day', 'system_id'])
+    daily['first_log_id'] = first['id']
+    daily['first_entry_time'] = first['entry_raw']
+    daily['first_exit_time'] = first['exit_raw'].where(first['exit_time'].notna(), None)
+
+    # 在室した時間帯を、入室日の0時からの時間数のビット列にまとめる（同じ時間帯の重複は1回とする）
+    done = logs[completed]
+    start_hour, end_hour = stay_hour_range(done['entry_time'], done['exit_time'])
+    rows, hours = expand_hours(start_hour, end_hour)
+    occupied = pd.DataFrame({
+        'day': done['day'].to_numpy()[rows],
+        'system_id': done['system_id'].to_numpy()[rows],
+        'offset': hours - day_start_hour(done['day'].to_numpy()[rows]),
+    }).drop_duplicates()
+    overflow = occupied['offset'] >= OCCUPANCY_HOURS
+    in_mask = occupied[~overflow]
+    masks = pd.Series(np.left_shift(np.int64(1), in_mask['offset'].to_numpy('int64')),
+                      index=pd.MultiIndex.from_frame(in_mask[['day', 'system_id']]))
+    daily['occupied_hours'] = masks.groupby(level=[0, 1]).sum().reindex(daily.index, fill_value=0).astype('int64')
+    overflow_keys = pd.MultiIndex.from_frame(occupied.loc[overflow, ['day', 'system_id']].drop_duplicates())
+    daily['occupancy_overflow'] = daily.index.isin(overflow_keys).astype(int)
+
+    hourly = logs.assign(hour=logs['entry_time'].dt.hour).groupby(['day', 'system_id', 'hour']).size().rename('checkins')
+    return daily.reset_index(), hourly.reset_index()
+
+
+# --- 集計済みテーブルを使わない集計 ---
+def iter_day_chunks(conn, start_date, end_date, chunk_size):
+    """
+    期間内の記録(生徒情報は結合しない)を入室時刻順に chunk_size 件程度ずつ、_build_rollups に渡せる形で返す。
+    1日分の記録は必ず同じチャンクに入れる（1日の記録が chunk_size 件を超える場合は、その日のチャンクだけ大きくなる）。
+    """
+    start_iso, end_iso = _jst_day_bounds(start_date, end_date)
+    last_entry, last_id = '', 0
+    pending = None
+    while True:
+        chunk = pd.read_sql_query('''
+            SELECT id, system_id, entry_time, exit_time FROM attendance_logs
+            WHERE entry_time BETWEEN ? AND ? AND (entry_time, id) > (?, ?)
+            ORDER BY entry_time, id LIMIT ?
+        ''', conn, params=(start_iso, end_iso, last_entry, last_id, chunk_size))
+        if chunk.empty:
+            break
+        last_entry, last_id = chunk['entry_time'].iloc[-1], int(chunk['id'].iloc[-1])
+        chunk = _with_log_days(chunk)
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        # 最後の日付の記録は次のチャンクに続く可能性があるため、次のチャンクと合わせて返す
+        last_day = chunk['day'].to_numpy() == chunk['day'].iloc[-1]
+        pending = chunk[last_day]
+        if not last_day.all():
+            yield chunk[~last_day]
+    if pending is not None:
+        yield pending
+
+def aggregate_logs(conn, start_date, end_date, chunk_size):
+    """
+    集計済みテーブルを使わず(書き込まず)に、期間内の記録を日付の区切りで chunk_size 件程度ずつ読み込んで集計し、
+    load_daily / load_hourly と同じ形の (daily, hourly) を返す。期間内に記録がない場合は空の DataFrame を返す。
+    保持するのはチャンクごとの集計結果だけなので、読み込み中のメモリ使用量は期間の長さではなくチャンクの大きさで決まる。
+    """
+    daily_parts, hourly_parts = [], []
+    for logs in iter_day_chunks(conn, start_date, end_date, chunk_size):
+        daily, hourly = _build_rollups(logs)
+        daily_parts.append(daily)
+        # 入室時間帯の回数は期間全体の 生徒×時間帯 にまとめるため、チャンクの中でも先に合計しておく
+        hourly_parts.append(hourly.groupby(['system_id', 'hour'])['checkins'].sum())
+    if not daily_parts:
+        return pd.DataFrame(), pd.DataFrame()
+    students = load_students(conn)
+    daily = pd.concat(daily_parts, ignore_index=True).merge(students, on='system_id', how='inner')
+    hourly = pd.concat(hourly_parts).groupby(level=[0, 1]).sum().reset_index()
+    hourly = hourly.merge(students[['system_id', 'grade']], on='system_id', how='inner')
+    return daily, hourly
+
+
+# --- レポート用の読み込み ---
+def load_students(conn):
+    """
+    生徒情報を、記録と結合しても小さく収まる型で読み込む。
+    学年・組・番号は値に合った最小の整数型（欠損がある列はそのまま）、氏名は生徒情報の氏名を値とするカテゴリ型にする。
+    カテゴリは生徒情報全体から作るため、チャンクごとに変換したものを連結してもカテゴリ型のままになる。
+    """
+    students = pd.read_sql_query('SELECT system_id, grade, class, student_number, name FROM students', conn)
+    for column in ('grade', 'class', 'student_number'):
+        students[column] = pd.to_numeric(students[column], downcast='integer')
+    students['name'] = students['name'].astype(pd.CategoricalDtype(sorted(students['name'].dropna().unique())))
+    return students
+
+def load_daily(conn, start_date, end_date):
+    """期間内の 日付×生徒 の集計を、生徒情報と結合して返す（生徒情報にない記録は含めない）。"""
+    # 生徒情報は行ごとに同じ値が並ぶため、SQLで結合せずに読み込んでから pandas で結合する（読み込む値の数を減らす）
+    daily = pd.read_sql_query('SELECT * FROM report_daily_rollup WHERE day BETWEEN ? AND ?',
+                              conn, params=(start_date.isoformat(), end_date.isoformat()))
+    return daily.merge(load_students(conn), on='system_id', how='inner')
+
+def load_hourly(conn, start_date, end_date):
+    return pd.read_sql_query('''
+        SELECT r.system_id, r.hour, SUM(r.checkins) AS checkins, s.grade
+        FROM report_hourly_rollup r JOIN students s ON r.system_id = s.system_id
+        WHERE r.day BETWEEN ? AND ?
+        GROUP BY r.system_id, r.hour
+    ''', conn, params=(start_date.isoformat(), end_date.isoformat()))
+
+def load_logs_for_occupancy(conn, start_date, end_date, include_long_stays=False):
+    """
+    在室時間帯を記録から直接集計する必要があるものを返す。
+    - 未退室の記録（退室時刻の推定がレポートの期間に依存するため）
+    - include_long_stays=True の場合は、24時間を超える退室済みの記録（ビット列の48時間に収まらない可能性があるもの）
+    """
+    start_iso, end_iso = _jst_day_bounds(start_date, end_date)
+    long_stays = "OR julianday(al.exit_time) - julianday(al.entry_time) > 1" if include_long_stays else ""
+    logs = pd.read_sql_query(f'''
+        SELECT al.system_id, s.grade, al.entry_time, al.exit_time
+        FROM attendance_logs al JOIN students s ON al.system_id = s.system_id
+        WHERE al.entry_time BETWEEN ? AND ? AND (al.exit_time IS NULL {long_stays})
+    ''', conn, params=(start_iso, end_iso))
+    return parse_log_times(logs)
+
+def iter_log_chunks(conn, start_date, end_date, chunk_size):
+    """
+    期間内の記録を入室時刻順に chunk_size 件ずつ返す。
+    チャンクごとに別のクエリ(キーセット方式)で読むため、Excelへの書き出し中にDBの読み取りロックを持ち続けない。
+    """
+    start_iso, end_iso = _jst_day_bounds(start_date, end_date)
+    last_entry, last_id = '', 0
+    while True:
+        chunk = pd.read_sql_query('''
+            SELECT al.id, al.system_id, s.grade, s.class, s.student_number, s.name, al.entry_time, al.exit_time
+            FROM attendance_logs al JOIN students s ON al.system_id = s.system_id
+            WHERE al.entry_time BETWEEN ? AND ? AND (al.entry_time, al.id) > (?, ?)
+            ORDER BY al.entry_time, al.id LIMIT ?
+        ''', conn, params=(start_iso, end_iso, last_entry, last_id, chunk_size))
+        if chunk.empty:
+            return
+        last_entry, last_id = chunk['entry_time'].iloc[-1], int(chunk['id'].iloc[-1])
+        yield parse_log_times(chunk.drop(columns=['id']))
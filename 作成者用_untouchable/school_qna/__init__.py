@@ -12,6 +12,8 @@ from . import excel_handler
 from . import category_handler
 from . import database
 from .excel_handler import GRADE_DISPLAY_MAP
+# 【追加】SSE配信用のハブ（メインアプリの py/event_hub.py を共用）
+from event_hub import BroadcastHub
 
 # Blueprintの定義
 school_qna_bp = Blueprint(
@@ -73,6 +75,35 @@ def get_db():
     db.row_factory = sqlite3.Row
     return db
 
+# --- 【追加】更新通知(SSE) ---
+# 新着・対応済み・撤回・削除のたびに、待機人数を添えて接続中の画面へ送る
+qna_hub = BroadcastHub(name='qna', heartbeat_interval=float(os.getenv('SSE_HEARTBEAT_SECONDS', 20)))
+# マルチプロセス構成でイベントバスが有効な場合は、メインアプリから設定される
+qna_event_bus = None
+
+def attach_event_bus(bus):
+    """イベントバス経由で全ワーカーの接続へ通知を届けるように切り替える。"""
+    global qna_event_bus
+    qna_hub.seed_version(bus.latest_version('qna'))
+    bus.subscribe('qna', lambda version, event: qna_hub.broadcast_events([qna_hub.record_event(event, version)[1]]))
+    qna_event_bus = bus
+
+def announce_qna(kind, question_ids, client_id=None):
+    """質問の変化を通知する。kind は new_question / mark_done / retract / delete のいずれか。"""
+    event = {
+        "type": kind,
+        "question_ids": list(question_ids),
+        "client_id": client_id,
+        "pending_count": get_pending_count(),
+    }
+    try:
+        if qna_event_bus:
+            qna_event_bus.publish('qna', event)
+        else:
+            qna_hub.publish_event(event)
+    except Exception as e:
+        current_app.logger.error(f"[通信ログ] 質問の更新通知に失敗しました: {e}")
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -156,6 +187,8 @@ def index():
         
         if status == 'done':
             excel_handler.append_to_history(last_id)
+
+        announce_qna('new_question', [last_id], client_id)
             
         message_type = 'wait' if submission_type == 'wait' else 'immediate'
         return redirect(url_for('school_qna.thanks', question_id=last_id, message_type=message_type, submitted='true'))
@@ -251,8 +284,18 @@ def api_mark_done(question_id):
     db.close()
     excel_handler.append_to_history(question_id)
     new_count = get_pending_count()
+    announce_qna('mark_done', [question_id])
     return jsonify({'success': True, 'new_count': new_count})
 
+# 【追加】待機人数・新着質問の通知を受け取るSSEエンドポイント（ポーリングの代わり）
+@school_qna_bp.route('/api/stream')
+def api_stream():
+    client_id = request.args.get('client_id', 'unknown')
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    sub = qna_hub.subscribe(client_id=client_id, remote_addr=request.remote_addr, last_event_id=last_event_id)
+    return Response(qna_hub.stream(sub), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @school_qna_bp.route('/api/check_new_questions')
 def api_check_new_questions():
     last_id = request.args.get('since_id', 0, type=int)
@@ -305,6 +348,9 @@ def retract_question(question_id):
         # 画像削除ロジックも必要だが省略
         db.commit()
         flash('質問を撤回しました。', 'success')
+        db.close()
+        announce_qna('retract', [question_id])
+        return redirect(url_for('school_qna.index'))
     db.close()
     return redirect(url_for('school_qna.index'))
 
@@ -320,6 +366,7 @@ def delete_selected_questions():
             db.execute("DELETE FROM questions WHERE id = ?", (qid,))
         db.commit()
         db.close()
+        announce_qna('delete', [int(qid) for qid in ids if str(qid).isdigit()])
         flash(f'{len(ids)}件の質問を削除しました。', 'success')
     return redirect(url_for('school_qna.list_view'))
 
@@ -175,13 +175,16 @@ document.addEventListener('DOMContentLoaded', function() {
     const SUB_CATEGORIES = subCategoriesDataElement ? JSON.parse(subCategoriesDataElement.textContent) : {};
 
     // --- 待機人数を定期的に更新する機能 ---
+    // 【追加】表示の書き換えのみ（SSEで人数が届いた場合はこちらを直接呼ぶ）
+    window.setPendingCount = function(count) {
+        if (pendingCountSpan) pendingCountSpan.textContent = count;
+        if (pendingCountSpanList) pendingCountSpanList.textContent = count;
+    }
+
     window.updatePendingCount = function() {
         fetch(`${urlPrefix}/api/count`)
             .then(response => response.json())
-            .then(data => {
-                if (pendingCountSpan) pendingCountSpan.textContent = data.count;
-                if (pendingCountSpanList) pendingCountSpanList.textContent = data.count;
-            })
+            .then(data => window.setPendingCount(data.count))
             .catch(error => console.error('人数取得エラー:', error));
     }
 
@@ -351,10 +354,9 @@ document.addEventListener('DOMContentLoaded', function() {
         window.updateClock();
     }, 1000);
 
-    // 通信を伴う待機人数確認は、負荷軽減のため5秒ごとに変更
-    setInterval(() => {
-        window.updatePendingCount();
-    }, 5000);
+    // 【修正】待機人数はSSEで受け取る（SSEが使えない場合のみ5秒ごとの確認に切り替わる）
+    // 通知機能(initializeNotifier)より先に接続しておく
+    setupQnaStream();
 
     // --- 一覧画面の「済」チェックボックス用 ---
     document.querySelectorAll('.done-checkbox').forEach(checkbox => {
@@ -433,17 +435,91 @@ window.addEventListener('pageshow', function(event) {
     // ページがキャッシュから復元された場合に、通知機能を再初期化する
     if (event.persisted) {
         console.log("ページがキャッシュから復元されたため、通知機能を再初期化します。");
+        setupQnaStream();
         initializeNotifier();
+        if (typeof window.updatePendingCount === "function") window.updatePendingCount();
     }
 });
 
 
+// --- 【追加】サーバーからの更新通知(SSE)の受信 ---
+// 接続できている間は定期的な問い合わせ(ポーリング)を行わず、SSEが使えない場合のみポーリングに切り替える
+let qnaEventSource = null;
+let isQnaPolling = false;
+
+function setupQnaStream() {
+    if (!window.EventSource) {
+        startQnaPolling();
+        return;
+    }
+    if (qnaEventSource) {
+        qnaEventSource.close();
+    }
+    // 【追加】非同期SSEサーバーが起動している場合は、そちらのポートへ直接接続する（Flask側のスレッドを占有しない）
+    const ssePort = document.body.dataset.ssePort;
+    const streamBase = ssePort ? `${location.protocol}//${location.hostname}:${ssePort}` : '';
+    qnaEventSource = new EventSource(`${streamBase}${urlPrefix}/api/stream?client_id=${encodeURIComponent(CLIENT_ID)}`);
+
+    qnaEventSource.onopen = () => {
+        if (isQnaPolling) {
+            stopQnaPolling();
+            // ポーリング中に起きた変化を反映しておく
+            window.updatePendingCount();
+        }
+    };
+
+    qnaEventSource.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        // 取りこぼしが再送できない場合は、人数だけ取り直す
+        if (data.type === 'snapshot') {
+            window.updatePendingCount();
+            return;
+        }
+        if (typeof data.pending_count === 'number' && typeof window.setPendingCount === 'function') {
+            window.setPendingCount(data.pending_count);
+        }
+        // 自分の端末から送った質問は通知しない
+        if (data.type === 'new_question' && data.client_id !== CLIENT_ID && typeof window.notifyNewQuestions === 'function') {
+            window.notifyNewQuestions(data.question_ids);
+        }
+    };
+
+    qnaEventSource.onerror = () => {
+        // 接続が切れた場合はブラウザが自動で再接続する。再接続自体を諦めた場合のみポーリングに切り替える
+        if (qnaEventSource.readyState === EventSource.CLOSED) {
+            startQnaPolling();
+        }
+    };
+}
+
+function startQnaPolling() {
+    if (isQnaPolling) return;
+    isQnaPolling = true;
+    console.warn("更新通知(SSE)が利用できないため、5秒ごとの確認に切り替えます。");
+    window.pendingCountIntervalId = setInterval(() => {
+        window.updatePendingCount();
+    }, 5000);
+    if (typeof window.startNotifierPolling === 'function') window.startNotifierPolling();
+}
+
+function stopQnaPolling() {
+    isQnaPolling = false;
+    clearInterval(window.pendingCountIntervalId);
+    if (window.notifierIntervalId) {
+        clearInterval(window.notifierIntervalId);
+        window.notifierIntervalId = null;
+    }
+}
+
 // --- グローバル通知機能（安定版＋音声機能） ---
 function initializeNotifier() {
     // 既存のタイマーがあれば停止する（二重実行防止）
     if (window.notifierIntervalId) {
         clearInterval(window.notifierIntervalId);
+        window.notifierIntervalId = null;
     }
+    window.notifyNewQuestions = null;
+    window.startNotifierPolling = null;
 
     if (!window.isUserLoggedIn) {
         return; // 未ログイン時は実行しない
@@ -505,25 +581,42 @@ function initializeNotifier() {
                 }
 
                 if (data.new_question_count > 0) {
-                    newQuestionCount += data.new_question_count;
                     lastKnownId = data.latest_id;
-                    
-                    document.title = `新しい質問 (${newQuestionCount})`;
-                    createOrUpdateNotificationBanner();
-                    
-                    //  変更点: グローバル変数を使って再生を試みる 
-                    if (isAudioUnlocked) {
-                        notificationSound.play().catch(error => {
-                            console.warn("音声の再生に失敗しました。", error);
-                        });
-                    } else {
-                        console.log("音声再生がまだ許可されていません。ユーザーによる操作が必要です。");
-                    }
+                    showNewQuestions(data.new_question_count);
                 }
             })
             .catch(error => console.error('新着質問のチェック中にエラー:', error));
     };
 
-    // 通信負荷を抑えるため、チェック間隔を5秒に変更
-    window.notifierIntervalId = setInterval(checkForNewQuestions, 5000);
+    // 【追加】SSE受信時とポーリング時で共通の通知処理
+    const showNewQuestions = (count) => {
+        newQuestionCount += count;
+
+        document.title = `新しい質問 (${newQuestionCount})`;
+        createOrUpdateNotificationBanner();
+
+        //  変更点: グローバル変数を使って再生を試みる 
+        if (isAudioUnlocked) {
+            notificationSound.play().catch(error => {
+                console.warn("音声の再生に失敗しました。", error);
+            });
+        } else {
+            console.log("音声再生がまだ許可されていません。ユーザーによる操作が必要です。");
+        }
+    };
+    window.notifyNewQuestions = (questionIds) => {
+        // ポーリングに切り替わった場合に同じ質問を二重に通知しないよう、既知のIDを進めておく
+        lastKnownId = Math.max(lastKnownId, ...questionIds);
+        showNewQuestions(questionIds.length);
+    };
+
+    // 【修正】定期確認はSSEが使えない場合のみ行う（通信負荷を抑えるため、チェック間隔は5秒）
+    window.startNotifierPolling = () => {
+        if (!window.notifierIntervalId) {
+            window.notifierIntervalId = setInterval(checkForNewQuestions, 5000);
+        }
+    };
+    if (isQnaPolling) {
+        window.startNotifierPolling();
+    }
 }
\ No newline at end of file
@@ -13,8 +13,14 @@ const GRADE_MAP = {
 };
 let allStudents = [];
 let studentsDataNested = {};
+// 【追加】生徒一覧は記録とは別に取得し、名簿バージョンごとにブラウザへ保存して使い回す
+const STUDENTS_CACHE_KEY = 'editStudentsCache';
+let studentsRosterVersion = null;
 let currentPage = 1;
 const logsPerPage = 100;
+// 【追加】キーセット方式のページ送り用カーソル。pageCursors[i] は (i+1) ページ目の取得に使うカーソル
+let pageCursors = [null];
+let nextPageCursor = null;
 let currentSort = { column: 'id', direction: 'desc' };
 let totalLogsCount = 0;
 let entryTimePicker = null;
@@ -50,6 +56,8 @@ const dom = {
     filterBtn: document.getElementById('filter-btn'),
     resetFilterBtn: document.getElementById('reset-filter-btn'),
     addNewLogBtn: document.getElementById('add-new-log-btn'),
+    bulkDeleteBtn: document.getElementById('bulk-delete-btn'),
+    selectAllLogs: document.getElementById('select-all-logs'),
     logsTableBody: document.getElementById('logs-table-body'),
     tableHeaders: document.querySelectorAll('th[data-sort]'),
     pageInfo: document.getElementById('page-info'),
@@ -113,7 +121,7 @@ async function initializeEditPage() {
  * イベントリスナーをまとめて設定
  */
 function setupEventListeners() {
-    dom.filterBtn.addEventListener('click', () => { currentPage = 1; fetchLogs(); });
+    dom.filterBtn.addEventListener('click', () => { resetPaging(); fetchLogs(); });
     dom.resetFilterBtn.addEventListener('click', resetFilters);
     dom.tableHeaders.forEach(header => header.addEventListener('click', handleSort));
     dom.prevPageBtn.addEventListener('click', () => changePage(-1));
@@ -122,6 +130,12 @@ function setupEventListeners() {
     dom.modalCancelBtn.addEventListener('click', closeModal);
     dom.editForm.addEventListener('submit', handleFormSubmit);
     dom.logsTableBody.addEventListener('click', handleTableActions);
+    dom.logsTableBody.addEventListener('change', updateBulkDeleteButton);
+    dom.selectAllLogs.addEventListener('change', () => {
+        dom.logsTableBody.querySelectorAll('.log-select').forEach(box => { box.checked = dom.selectAllLogs.checked; });
+        updateBulkDeleteButton();
+    });
+    dom.bulkDeleteBtn.addEventListener('click', handleBulkDelete);
     dom.modalGradeSelect.addEventListener('change', onModalGradeChange);
     dom.modalClassSelect.addEventListener('change', onModalClassChange);
     dom.modalNumberSelect.addEventListener('change', onModalNumberChange);
@@ -137,7 +151,10 @@ async function fetchLogs() {
     // UI操作を一時的に無効化（オプション）
     dom.logsTableBody.style.opacity = '0.5';
 
-    const params = new URLSearchParams({ page: currentPage, per_page: logsPerPage, sort: currentSort.column, dir: currentSort.direction });
+    const params = new URLSearchParams({ per_page: logsPerPage, sort: currentSort.column, dir: currentSort.direction });
+    // 【修正】ページ番号(OFFSET)ではなく、前のページの最後の行を表すカーソルで続きを取得する
+    const cursor = pageCursors[currentPage - 1];
+    if (cursor) params.append('cursor', cursor);
     const period = dom.filterPeriod.value;
     // 日本語ロケールの区切り文字 " から " を使用
     if (period.includes(' から ')) {
@@ -162,29 +179,67 @@ async function fetchLogs() {
         const response = await fetch(`/api/logs?${params.toString()}`);
         if (!response.ok) throw new Error('サーバーからの応答がありません。');
         const data = await response.json();
-        allStudents = data.students;
-        buildNestedStudentsData(); 
+        // 【修正】生徒一覧は名簿バージョンが変わった時だけ取得する
+        await ensureStudents(data.roster_version);
         renderTable(data.logs);
+        nextPageCursor = data.next_cursor || null;
         updatePagination(data.total);
-        if (dom.filterGrade.options.length <= 1) {
-            populateFilterSelects(data.students);
-        }
     } catch (error) {
         console.error("ログの取得に失敗:", error);
-        dom.logsTableBody.innerHTML = `<tr><td colspan="10" style="text-align:center; color:red;">データの読み込みに失敗しました。</td></tr>`;
+        dom.logsTableBody.innerHTML = `<tr><td colspan="12" style="text-align:center; color:red;">データの読み込みに失敗しました。</td></tr>`;
     } finally {
         isLoading = false;
         dom.logsTableBody.style.opacity = '1';
     }
 }
 
+/**
+ * 生徒一覧を用意する。手元（メモリまたはブラウザ保存）の名簿バージョンが一致すれば通信しない
+ */
+async function ensureStudents(rosterVersion) {
+    if (studentsRosterVersion && studentsRosterVersion === rosterVersion) return;
+
+    let cached = null;
+    try {
+        cached = JSON.parse(localStorage.getItem(STUDENTS_CACHE_KEY));
+    } catch (e) {
+        cached = null;
+    }
+    if (cached && cached.roster_version === rosterVersion) {
+        setStudents(cached.students, cached.roster_version);
+        return;
+    }
+
+    // cache: 'no-cache' でETagによる再検証を行う（変わっていなければ 304 でブラウザのキャッシュを使う）
+    const response = await fetch('/api/students', { cache: 'no-cache' });
+    if (!response.ok) throw new Error('生徒一覧の取得に失敗しました。');
+    const data = await response.json();
+    try {
+        localStorage.setItem(STUDENTS_CACHE_KEY, JSON.stringify({ roster_version: data.roster_version, students: data.students }));
+    } catch (e) {
+        console.warn('生徒一覧をブラウザに保存できませんでした。', e);
+    }
+    setStudents(data.students, data.roster_version);
+}
+
+function setStudents(students, rosterVersion) {
+    allStudents = students;
+    studentsRosterVersion = rosterVersion;
+    buildNestedStudentsData();
+    if (dom.filterGrade.options.length <= 1) {
+        populateFilterSelects(students);
+    }
+}
+
 /**
  * テーブルの描画
  */
 function renderTable(logs) {
     dom.logsTableBody.innerHTML = '';
+    dom.selectAllLogs.checked = false;
+    updateBulkDeleteButton();
     if (logs.length === 0) {
-        dom.logsTableBody.innerHTML = `<tr><td colspan="10" style="text-align:center;">該当する記録はありません。</td></tr>`;
+        dom.logsTableBody.innerHTML = `<tr><td colspan="12" style="text-align:center;">該当する記録はありません。</td></tr>`;
         return;
     }
     logs.forEach(log => {
@@ -201,6 +256,7 @@ function renderTable(logs) {
         // 座席番号がない場合は 'QR' と表示
         const seatDisplay = log.seat_number ? log.seat_number : 'QR';
         row.innerHTML = `
+            <td><input type="checkbox" class="log-select" value="${log.id}"></td>
             <td>${log.id}</td>
             <td>${entryDate ? entryDate.toLocaleDateString('ja-JP') : ''}</td>
             <td>${GRADE_MAP[log.grade] || log.grade || ''}</td>
@@ -227,10 +283,28 @@ function updatePagination(total) {
     const totalPages = Math.ceil(totalLogsCount / logsPerPage) || 1;
     dom.pageInfo.textContent = `${currentPage} / ${totalPages} ページ (${totalLogsCount}件)`;
     dom.prevPageBtn.disabled = currentPage === 1;
-    dom.nextPageBtn.disabled = currentPage >= totalPages;
+    dom.nextPageBtn.disabled = !nextPageCursor;
+}
+
+function changePage(direction) {
+    if (direction > 0) {
+        if (!nextPageCursor) return;
+        // 次のページのカーソルを積んでおき、戻る時はそのまま使う
+        pageCursors[currentPage] = nextPageCursor;
+        pageCursors.length = currentPage + 1;
+    } else if (currentPage === 1) {
+        return;
+    }
+    currentPage += direction;
+    fetchLogs();
 }
 
-function changePage(direction) { currentPage += direction; fetchLogs(); }
+// 【追加】絞り込み・並び替えの変更時は1ページ目から取得し直す
+function resetPaging() {
+    currentPage = 1;
+    pageCursors = [null];
+    nextPageCursor = null;
+}
 function resetFilters() {
     dom.filterPeriod.value = '';
     dom.filterName.value = '';
@@ -240,7 +314,7 @@ function resetFilters() {
     if (dom.filterPeriod._flatpickr) {
         dom.filterPeriod._flatpickr.clear();
     }
-    currentPage = 1;
+    resetPaging();
     fetchLogs();
 }
 function handleSort(event) {
@@ -253,7 +327,7 @@ function handleSort(event) {
     }
     dom.tableHeaders.forEach(h => h.classList.remove('sorted-asc', 'sorted-desc'));
     event.target.classList.add(currentSort.direction === 'asc' ? 'sorted-asc' : 'sorted-desc');
-    currentPage = 1;
+    resetPaging();
     fetchLogs();
 }
 async function handleTableActions(event) {
@@ -277,6 +351,32 @@ async function handleTableActions(event) {
         }
     }
 }
+// 【追加】チェックした記録をまとめて削除する（1回の通信・1つのトランザクションで処理される）
+function getSelectedLogIds() {
+    return Array.from(dom.logsTableBody.querySelectorAll('.log-select:checked')).map(box => Number(box.value));
+}
+function updateBulkDeleteButton() {
+    const count = getSelectedLogIds().length;
+    dom.bulkDeleteBtn.disabled = count === 0;
+    dom.bulkDeleteBtn.textContent = count > 0 ? `選択した記録を削除 (${count}件)` : '選択した記録を削除';
+}
+async function handleBulkDelete() {
+    const logIds = getSelectedLogIds();
+    if (logIds.length === 0) return;
+    if (!confirm(`選択した ${logIds.length} 件の記録を本当に削除しますか？\nこの操作は取り消せません。`)) return;
+    try {
+        const response = await fetch('/api/logs/bulk', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ operations: logIds.map(id => ({ op: 'delete', id })) }),
+        });
+        const result = await response.json();
+        alert(result.message);
+        if (response.ok) fetchLogs();
+    } catch (error) {
+        alert("一括削除中にエラーが発生しました。");
+    }
+}
 //modal関連のヘルパー関数群
 // edit.js
 
@@ -507,11 +607,15 @@ function setupSSE() {
         globalEventSource.close();
     }
     // 【修正】クライアントIDを付与して接続
-    globalEventSource = new EventSource(`/api/stream?client_id=${encodeURIComponent(myClientId)}`);
+    // 【追加】非同期SSEサーバーが起動している場合は、そちらのポートへ直接接続する
+    const ssePort = document.body.dataset.ssePort;
+    const streamBase = ssePort ? `${location.protocol}//${location.hostname}:${ssePort}` : '';
+    globalEventSource = new EventSource(`${streamBase}/api/stream?client_id=${encodeURIComponent(myClientId)}`);
     
     globalEventSource.onmessage = (event) => {
         const data = JSON.parse(event.data);
-        if (data.type === 'update') {
+        // 連続した更新はサーバー側で batch にまとめられるため、再取得は1回で済む
+        if (['update', 'delta', 'snapshot', 'batch'].includes(data.type)) {
             console.log("更新通知を受信。編集画面のリストを更新します。");
             fetchLogs();
         }
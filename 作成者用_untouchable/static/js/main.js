@@ -41,6 +41,10 @@ let syncErrors = JSON.parse(localStorage.getItem('syncErrors')) || [];
 let isSyncing = false;
 // データ取得中かどうかのフラグ
 let isFetching = false;
+// データ取得中に届いた更新通知を、取得完了後に反映するためのフラグ
+let isRefetchRequested = false;
+// 手元のデータがサーバーのどのバージョンまで反映済みか（SSEの差分適用で使用）
+let dataVersion = null;
 // サーバー通信状態のフラグ
 let isServerOnline = true;
 
@@ -239,29 +243,48 @@ function updateTime() {
  * @function fetchInitialData
  * @description サーバーのAPIを叩いて、初期データを取得する
  */
-// 修正: キャッシュ回避のためにタイムスタンプ(?t=...)を付与
+// 【修正】タイムスタンプ(?t=...)によるキャッシュ回避をやめ、ETagによる再検証(304)を利用する
 async function fetchInitialData(ignoreSyncLock = false) {
     // 同期中（かつ強制実行でない場合）、または既に取得中の場合は重複実行を避ける
-    if ((isSyncing && !ignoreSyncLock) || isFetching) return;
+    if (isFetching) {
+        // 取得中のデータに最新の変更が含まれていない可能性があるため、完了後にもう一度取得する
+        isRefetchRequested = true;
+        return;
+    }
+    if (isSyncing && !ignoreSyncLock) return;
     isFetching = true;
+    isRefetchRequested = false;
 
     const controller = new AbortController();
     const timeoutId = setTimeout(() => controller.abort(), 2000); // 2秒でタイムアウト
 
     try {
-        const response = await fetch(`/api/initial_data?t=${new Date().getTime()}`, {
-            signal: controller.signal
+        // 保存済みの名簿が最新なら、サーバーは名簿を省いて在室状況(presence)のみを返す
+        const cachedRoster = localStorage.getItem('cachedStudentsData');
+        const cachedRosterVersion = localStorage.getItem('cachedRosterVersion');
+        const query = (cachedRoster && cachedRosterVersion) ? `?roster_version=${encodeURIComponent(cachedRosterVersion)}` : '';
+        // cache: 'no-cache' で毎回サーバーに再検証させ、変化がなければ 304 でキャッシュを使う
+        const response = await fetch(`/api/initial_data${query}`, {
+            signal: controller.signal,
+            cache: 'no-cache'
         });
         clearTimeout(timeoutId);
 
         if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
         const data = await response.json();
         
-        studentsData = data.students;
+        if (data.students) {
+            studentsData = data.students;
+        } else {
+            studentsData = JSON.parse(cachedRoster);
+            applyPresence(data.presence);
+        }
         currentAttendees = data.attendees;
+        dataVersion = (typeof data.version === 'number') ? data.version : null;
         
         // 【追加】取得成功時にローカルストレージに最新のマスタデータを保存
         localStorage.setItem('cachedStudentsData', JSON.stringify(studentsData));
+        if (data.roster_version) localStorage.setItem('cachedRosterVersion', data.roster_version);
         
         // オフラインキューにある変更を適用して、UIの状態を最新にする
         applyOfflineChanges();
@@ -293,6 +316,28 @@ async function fetchInitialData(ignoreSyncLock = false) {
         }
     } finally {
         isFetching = false;
+        if (isRefetchRequested) {
+            isRefetchRequested = false;
+            fetchInitialData(ignoreSyncLock);
+        }
+    }
+}
+
+/**
+ * @function applyPresence
+ * @description 保存済みの名簿に、サーバーから受け取った在室状況を反映する
+ * @param {Object} presence - { system_id: { is_present, current_log_id } }
+ */
+function applyPresence(presence) {
+    for (const grade in studentsData) {
+        for (const cls in studentsData[grade]) {
+            for (const num in studentsData[grade][cls]) {
+                const s = studentsData[grade][cls][num];
+                const p = presence[s.system_id];
+                s.is_present = p ? p.is_present : false;
+                s.current_log_id = p ? p.current_log_id : null;
+            }
+        }
     }
 }
 
@@ -1040,6 +1085,19 @@ async function handleExitAll() {
     }
 }
 
+// 【追加】この端末から依頼したレポート作成ジョブ（完了通知を表示する対象）
+const myReportJobs = new Set();
+
+/**
+ * @function handleReportJobEvent
+ * @description レポート作成ジョブの終了通知(SSE)を受け取り、この端末から依頼したものであれば結果を表示する
+ */
+function handleReportJobEvent(job) {
+    if (!myReportJobs.has(job.id)) return;
+    myReportJobs.delete(job.id);
+    showToast(job.message || 'レポート作成が終了しました。');
+}
+
 async function handleCreateReport() {
     const dateRange = dom.reportPeriodInput.value;
     if (!dateRange) { return showToast("エラー: 期間を選択してください。"); }
@@ -1053,12 +1111,15 @@ async function handleCreateReport() {
 
     if (confirm(confirmationMessage)) {
         try {
-            const response = await fetch('/api/create_report', {
+            // 【修正】レポートはサーバー側でバックグラウンド作成される。完了はSSE(report_job)で通知される
+            const response = await fetch('/api/reports', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ start_date: startDate, end_date: endDate })
             });
             const result = await response.json();
+            // 作成済みのレポートを再利用した場合は、応答の時点で完了している
+            if (response.ok && result.job && result.job.status !== 'done') myReportJobs.add(result.job.id);
             showToast(result.message);
         } catch (error) {
             console.error('レポート作成エラー:', error);
@@ -1795,13 +1856,27 @@ function setupSSE() {
         globalEventSource.close();
     }
     // クライアントIDを付与して接続
-    globalEventSource = new EventSource(`/api/stream?client_id=${encodeURIComponent(myClientId)}`);
+    // 【追加】非同期SSEサーバーが起動している場合は、そちらのポートへ直接接続する
+    const ssePort = document.body.dataset.ssePort;
+    const streamBase = ssePort ? `${location.protocol}//${location.hostname}:${ssePort}` : '';
+    globalEventSource = new EventSource(`${streamBase}/api/stream?client_id=${encodeURIComponent(myClientId)}`);
     
     globalEventSource.onmessage = (event) => {
         const data = JSON.parse(event.data);
-        if (data.type === 'update') {
-            console.log("更新通知を受信しました。リストを更新します。");
-            fetchInitialData();
+        // 【追加】レポート作成ジョブの終了通知は入退室データのバージョンとは別扱い
+        if (data.type === 'report_job') {
+            handleReportJobEvent(data.job);
+            return;
+        }
+        if (data.type === 'batch') {
+            // 短時間の連続した更新はサーバー側で1件にまとめられて届く
+            for (const item of data.events) {
+                if (!applyServerDelta(item, false)) break;
+            }
+            renderAttendanceTable();
+            refreshManualSelectionUI();
+        } else {
+            applyServerDelta(data);
         }
     };
 
@@ -1811,6 +1886,152 @@ function setupSSE() {
     };
 }
 
+/**
+ * @function applyServerDelta
+ * @description SSEで受け取った差分(入室/退室/記録編集/記録削除)を手元のデータにその場で反映する。
+ * バージョンが連続していない（取りこぼしがある）場合のみ、全件を再取得する。
+ * @returns {boolean} 続けて差分を適用できる場合は true、全件の再取得に切り替えた場合は false
+ */
+function applyServerDelta(delta, render = true) {
+    // 【修正】snapshot はバージョンの比較より先に扱う
+    // (サーバーのバージョンが手元より小さい snapshot は、DBの復元などでバージョンが巻き戻ったことを示す)
+    if (delta.type === 'snapshot') {
+        if (dataVersion !== null && delta.version < dataVersion) {
+            console.log(`サーバーのバージョンが巻き戻ったため全件を再取得します (手元: ${dataVersion}, サーバー: ${delta.version})`);
+            // 手元のバージョンを捨て、以降の差分を古いバージョンとして無視しないようにする
+            dataVersion = null;
+            fetchInitialData();
+            return false;
+        }
+        if (dataVersion !== null && delta.version === dataVersion) return true;
+        // 再接続時の取りこぼしがサーバーの再送バッファを超えていた場合は、変更履歴から追いつく
+        console.log('再送しきれない取りこぼしがあるため、前回以降の変更を取得します。');
+        fetchChanges();
+        return false;
+    }
+
+    // 既に反映済みのバージョンは無視する（自端末の操作結果や、再送と重複した分など）
+    if (dataVersion !== null && delta.version <= dataVersion) return true;
+
+    if (delta.type !== 'delta') {
+        // update: 内容を伴わない更新通知
+        console.log(`更新通知(${delta.type})を受信しました。リストを更新します。`);
+        fetchInitialData();
+        return false;
+    }
+
+    // 初期データ未取得・取得中、未送信のオフライン操作がある場合は全件取得に任せる
+    // (オフライン操作はサーバーデータに重ねて再計算する必要があるため)
+    if (dataVersion === null || isFetching || offlineQueue.length > 0) {
+        console.log(`差分を適用できないため全件を再取得します (手元: ${dataVersion}, 受信: ${delta.version})`);
+        fetchInitialData();
+        return false;
+    }
+    // 【修正】バージョンが飛んでいる場合は、全件ではなく前回以降の変更だけを取得する
+    if (delta.version !== dataVersion + 1) {
+        console.log(`取りこぼしがあるため変更履歴を取得します (手元: ${dataVersion}, 受信: ${delta.version})`);
+        fetchChanges();
+        return false;
+    }
+    dataVersion = delta.version;
+
+    // 1. 本日の入退室リストを更新
+    if (delta.log) {
+        upsertTodayLog(delta.log, delta.kind === 'log_delete');
+    }
+
+    // 2. 生徒の在室状態を更新（入力フォーム側の「入室/退室」判定に使用）
+    applyStudentPresence(delta.students || []);
+
+    if (render) {
+        renderAttendanceTable();
+        refreshManualSelectionUI();
+    }
+    return true;
+}
+
+/**
+ * @function upsertTodayLog
+ * @description 本日の入退室リストに記録を追加・更新する。削除された記録や本日以外の記録はリストから外す
+ */
+function upsertTodayLog(log, isDeleted = false) {
+    const index = currentAttendees.findIndex(a => String(a.log_id) === String(log.log_id));
+    const isTodayLog = !isDeleted && log.entry_time &&
+        new Date(log.entry_time).toDateString() === new Date().toDateString();
+
+    if (isTodayLog) {
+        if (index !== -1) {
+            currentAttendees[index] = log;
+        } else {
+            currentAttendees.push(log);
+        }
+        currentAttendees.sort((a, b) => new Date(a.entry_time) - new Date(b.entry_time));
+    } else if (index !== -1) {
+        // 削除された、または本日以外の日付に編集された記録はリストから外す
+        currentAttendees.splice(index, 1);
+    }
+}
+
+/**
+ * @function applyStudentPresence
+ * @description 生徒の在室状態を手元の名簿データに反映する
+ * @param {Array} students - [{ system_id, is_present, current_log_id }]
+ */
+function applyStudentPresence(students) {
+    students.forEach(p => {
+        const s = findStudentObjectBySystemId(p.system_id);
+        if (s) {
+            s.is_present = p.is_present;
+            s.current_log_id = p.current_log_id;
+        }
+    });
+}
+
+/**
+ * @function fetchChanges
+ * @description 手元のバージョン以降の変更だけをサーバーから取得して反映する（スリープ復帰・通信断からの再開用）。
+ * 変更履歴が圧縮済みで辿れない場合や、未送信のオフライン操作がある場合は全件を再取得する。
+ */
+async function fetchChanges() {
+    if (dataVersion === null || isFetching || offlineQueue.length > 0) {
+        fetchInitialData();
+        return;
+    }
+    isFetching = true;
+    let needsFullFetch = false;
+    try {
+        const response = await fetch(`/api/changes?since=${dataVersion}`, { cache: 'no-store' });
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        const data = await response.json();
+
+        if (data.reset) {
+            needsFullFetch = true;
+            return;
+        }
+        if (data.version > dataVersion) {
+            data.logs.forEach(log => upsertTodayLog(log));
+            data.deleted_log_ids.forEach(logId => upsertTodayLog({ log_id: logId }, true));
+            applyStudentPresence(data.students);
+            dataVersion = data.version;
+            renderAttendanceTable();
+            refreshManualSelectionUI();
+        }
+    } catch (error) {
+        console.error('変更履歴の取得エラー:', error);
+        needsFullFetch = true;
+    } finally {
+        isFetching = false;
+        if (needsFullFetch) {
+            isRefetchRequested = false;
+            fetchInitialData();
+        } else if (isRefetchRequested) {
+            // 取得中に届いた通知は、もう一度変更履歴を取得して反映する
+            isRefetchRequested = false;
+            fetchChanges();
+        }
+    }
+}
+
 /**
  * IDから生徒オブジェクトそのものを検索するヘルパー関数
  * 修正: 学年・組・番号の情報も結合して返す
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# アプリ本体のモジュール(py フォルダ)は平らな import で互いを読み込むため、py フォルダにパスを通す
+PY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py')
+if PY_DIR not in sys.path:
+    sys.path.insert(0, PY_DIR)
@@ -0,0 +1,52 @@
+"""
+更新通知のまとめ配信(event_hub.CoalescingPublisher)で、バージョンの逆順に届いた通知も
+バージョン順の batch として配信され、SSEのイベントID(id:)が最も新しいバージョンになることを確認する。
+"""
+import json
+
+from event_hub import BroadcastHub, CoalescingPublisher
+
+
+def _publisher():
+    hub = BroadcastHub(name='test', heartbeat_interval=20)
+    # 締め切りで自動配信されないよう、まとめる間隔を十分に長くして flush で配信する
+    return hub, CoalescingPublisher(hub, window=60, max_delay=60)
+
+def _notify_out_of_order(publisher):
+    # 変更履歴で採番済みのバージョンが、並行した書き込みにより逆順で通知される場合
+    for version in [6, 5, 7]:
+        publisher.notify({'type': 'delta', 'kind': 'check_in'}, version=version)
+
+
+def test_flush_sends_out_of_order_notifications_in_version_order():
+    hub, publisher = _publisher()
+    sub = hub.subscribe(client_id='test')
+    _notify_out_of_order(publisher)
+    publisher.flush()
+
+    [(event_id, message)] = sub.wait(0)
+    payload = json.loads(message)
+    assert payload['type'] == 'batch'
+    assert [event['version'] for event in payload['events']] == [5, 6, 7]
+    assert payload['version'] == 7
+    assert event_id == 7
+
+def test_listener_receives_newest_version_as_event_id():
+    hub, publisher = _publisher()
+    received = []
+    hub.add_listener(lambda message, event_id: received.append((event_id, json.loads(message))))
+    publisher.notify({'type': 'delta'}, version=9)
+    publisher.notify({'type': 'delta'}, version=8)
+    publisher.flush()
+
+    [(event_id, payload)] = received
+    assert event_id == 9
+    assert [event['version'] for event in payload['events']] == [8, 9]
+
+def test_replay_after_out_of_order_notifications_is_in_version_order():
+    hub, publisher = _publisher()
+    _notify_out_of_order(publisher)
+    publisher.flush()
+
+    sub = hub.subscribe(client_id='test', last_event_id=4)
+    assert [event_id for event_id, _ in sub.wait(0)] == [5, 6, 7]
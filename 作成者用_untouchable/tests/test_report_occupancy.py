@@ -0,0 +1,107 @@
+"""
+「時間帯別在室人数サマリー」の集計(report_generator._occupied_hours / _occupancy_pivot)が、
+滞在ごとに date_range を作って explode していた以前の実装と同じ表を作ることを確認する。
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import report_generator
+from report_generator import GRADE_MAP, JST
+
+ALL_HOURS_JP = [f"{h}時台" for h in range(24)]
+ALL_GRADES_JP = list(GRADE_MAP.values())
+
+
+def _reference_occupancy_pivot(df, all_grades_jp, all_hours_jp):
+    """以前の実装（滞在ごとに在室した時間帯の日時を列挙し、行に展開してクロス集計する）。"""
+    def get_hour_timestamps(row):
+        start = row['entry_time'].floor('h')
+        # 退室時間がジャスト(例: 10:00:00)の場合は、その時間帯(10時台)には在室していないとみなすため1秒引く
+        end = (row['exit_time'] - pd.Timedelta(seconds=1)).floor('h')
+        return pd.date_range(start, end, freq='h').tolist()
+
+    df_occupancy = df[['grade_jp', 'system_id']].copy()
+    df_occupancy['timestamps'] = df.apply(get_hour_timestamps, axis=1)
+    df_exploded = df_occupancy.explode('timestamps')
+    df_exploded = df_exploded.dropna(subset=['timestamps'])
+
+    df_exploded['date_val'] = df_exploded['timestamps'].dt.date
+    df_exploded['hour_val'] = df_exploded['timestamps'].dt.hour
+    df_exploded['hour_str'] = df_exploded['hour_val'].astype(str) + '時台'
+    df_exploded = df_exploded.drop_duplicates(subset=['date_val', 'hour_str', 'system_id'])
+
+    occupancy_pivot = pd.crosstab(df_exploded['hour_str'], df_exploded['grade_jp'])
+    return occupancy_pivot.reindex(index=all_hours_jp, columns=all_grades_jp, fill_value=0)
+
+def _stays(rows):
+    """(system_id, 学年, 入室 'YYYY-MM-DD HH:MM:SS', 退室) の一覧から、前処理後の記録と同じ形の DataFrame を作る。"""
+    df = pd.DataFrame(rows, columns=['system_id', 'grade', 'entry_time', 'exit_time'])
+    for column in ['entry_time', 'exit_time']:
+        df[column] = pd.to_datetime(df[column]).dt.tz_localize(JST)
+    df['grade_jp'] = df['grade'].map(GRADE_MAP)
+    return df
+
+def _random_stays(seed, count=400):
+    """同じ生徒の重複する滞在・日またぎ・ちょうどの時刻の退室などを含む滞在をランダムに作る。"""
+    rng = np.random.default_rng(seed)
+    system_ids = rng.integers(1, 40, count)
+    # 7 は GRADE_MAP にない学年
+    grades = (system_ids % 7) + 1
+    entry = pd.Timestamp('2025-06-02') + pd.to_timedelta(rng.integers(0, 5 * 24 * 3600, count), unit='s')
+    kind = rng.choice(['normal', 'exact_hour', 'zero', 'negative', 'multi_day'], count, p=[0.6, 0.15, 0.08, 0.07, 0.1])
+    minutes = np.select(
+        [kind == 'normal', kind == 'zero', kind == 'negative', kind == 'multi_day'],
+        [rng.integers(1, 6 * 60, count), 0, -rng.integers(1, 180, count), rng.integers(24 * 60, 3 * 24 * 60, count)],
+        default=0)
+    exit_time = entry + pd.to_timedelta(minutes, unit='m')
+    # ちょうどの時刻(XX:00:00)の退室
+    exact = kind == 'exact_hour'
+    exit_time = exit_time.where(~exact, entry.floor('h') + pd.to_timedelta(rng.integers(1, 4, count), unit='h'))
+    return _stays({'system_id': system_ids, 'grade': grades,
+                   'entry_time': entry.astype(str), 'exit_time': exit_time.astype(str)})
+
+def _assert_same_as_reference(df, all_grades_jp=ALL_GRADES_JP):
+    expected = _reference_occupancy_pivot(df, all_grades_jp, ALL_HOURS_JP)
+    occupied = report_generator._occupied_hours(df)
+    actual = report_generator._occupancy_pivot(occupied, all_grades_jp, ALL_HOURS_JP)
+    # 時間帯の見出し(index.name)はシートを作る際に付け直すため比べない
+    pd.testing.assert_frame_equal(actual, expected.rename_axis(index=None))
+
+
+def test_exact_hour_exit_is_not_counted_in_that_hour():
+    df = _stays([(1, 1, '2025-06-02 09:30:00', '2025-06-02 11:00:00')])
+    _assert_same_as_reference(df)
+    pivot = report_generator._occupancy_pivot(report_generator._occupied_hours(df), ALL_GRADES_JP, ALL_HOURS_JP)
+    assert pivot['中1'].loc[['9時台', '10時台', '11時台']].tolist() == [1, 1, 0]
+
+def test_zero_and_negative_durations():
+    df = _stays([
+        (1, 1, '2025-06-02 10:00:00', '2025-06-02 10:00:00'),  # ちょうどの時刻で滞在0分: どの時間帯にも数えない
+        (2, 2, '2025-06-02 10:30:00', '2025-06-02 10:30:00'),  # 途中の時刻で滞在0分: その時間帯に数える
+        (3, 3, '2025-06-02 12:10:00', '2025-06-02 11:50:00'),  # 入室より前の退室: 数えない
+        (4, 4, '2025-06-02 15:00:00', '2025-06-02 15:00:01'),
+    ])
+    _assert_same_as_reference(df)
+
+def test_multi_day_stay_counts_each_day():
+    df = _stays([
+        (1, 4, '2025-06-02 20:15:00', '2025-06-04 08:05:00'),
+        # 同じ日・同じ時間帯の重複する滞在は1回、別の日の同じ時間帯は別に数える
+        (1, 4, '2025-06-03 07:00:00', '2025-06-03 09:00:00'),
+        (2, 5, '2025-06-02 23:59:59', '2025-06-03 00:00:01'),
+    ])
+    _assert_same_as_reference(df)
+
+def test_unmapped_grades_are_left_out():
+    df = _stays([
+        (1, 7, '2025-06-02 10:00:00', '2025-06-02 12:00:00'),  # GRADE_MAP にない学年
+        (2, 6, '2025-06-02 10:00:00', '2025-06-02 12:00:00'),  # 生徒情報にない学年(下の all_grades_jp にない)
+        (3, 1, '2025-06-02 10:00:00', '2025-06-02 12:00:00'),
+    ])
+    _assert_same_as_reference(df)
+    _assert_same_as_reference(df, all_grades_jp=['中1', '中2', '中3', '高1', '高2'])
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_random_stays_match_reference(seed):
+    _assert_same_as_reference(_random_stays(seed))